@@ -1,14 +1,15 @@
+import os
 import sys
 import warnings
 import copy
 import time
-import pathos
 import logging
 import numpy as np
 
 from beluga.utils.logging import logger
 from beluga.release import __splash__
 from beluga.numeric.data_classes.Trajectory import Trajectory
+from beluga.numeric.ivp_solvers import WorkerPool
 from beluga.utils import save, init_logging
 from beluga.symbolic.data_classes.components_structures import getattr_from_list
 from beluga.symbolic.data_classes import make_direct_method, make_indirect_method, make_postprocessor, make_preprocessor
@@ -113,10 +114,6 @@ def solve(
     """
     if n_cpus < 1:
         raise ValueError('Number of cpus must be greater than 1.')
-    if n_cpus > 1:
-        pool = pathos.multiprocessing.Pool(processes=n_cpus)
-    else:
-        pool = None
 
     if ocp is None:
         raise NotImplementedError('\"ocp\" must be defined.')
@@ -127,7 +124,7 @@ def solve(
 
     # f_ocp = compile_direct(ocp)
 
-    logger.debug('Using ' + str(n_cpus) + '/' + str(pathos.multiprocessing.cpu_count()) + ' CPUs. ')
+    logger.debug('Using ' + str(n_cpus) + '/' + str(os.cpu_count()) + ' CPUs. ')
 
     if bvp is None:
         preprocessor = make_preprocessor()
@@ -174,6 +171,15 @@ def solve(
                 (u, bvp.functional_problem.compute_u(solinit.y[ii + 1], solinit.dynamical_parameters, solinit.const)))
         solinit.u = u
 
+    # The workers keep the compiled BVP functions for the whole continuation process
+    if n_cpus > 1:
+        pool = WorkerPool(n_cpus, deriv_func=bvp.functional_problem.deriv_func,
+                          deriv_func_jac=bvp.functional_problem.deriv_func_jac,
+                          switch_event_func=bvp.functional_problem.switch_event_func,
+                          quad_func=bvp.functional_problem.quad_func)
+    else:
+        pool = None
+
     """
     Main continuation process
     """
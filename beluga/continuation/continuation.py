@@ -521,7 +521,13 @@ def run_continuation_set(bvp_algorithm_, steps, sol_guess, bvp: Problem, pool, a
     # Load the derivative function into the prob algorithm
     bvp_algorithm_.set_derivative_function(functional_problem.deriv_func)
     bvp_algorithm_.set_derivative_jacobian(functional_problem.deriv_func_jac)
+    bvp_algorithm_.set_event_function(functional_problem.switch_event_func)
     bvp_algorithm_.set_quadrature_function(functional_problem.quad_func)
+    if bvp_algorithm_.uses_batch_functions:
+        functional_problem.compile_batch_funcs()
+        bvp_algorithm_.set_derivative_function_batch(functional_problem.deriv_func_batch)
+        bvp_algorithm_.set_quadrature_function_batch(functional_problem.quad_func_batch)
+        bvp_algorithm_.set_derivative_jacobian_batch(functional_problem.deriv_func_jac_batch)
     bvp_algorithm_.set_boundarycondition_function(functional_problem.bc_func)
     bvp_algorithm_.set_boundarycondition_jacobian(functional_problem.bc_func_jac)
     bvp_algorithm_.set_inequality_constraint_function(functional_problem.ineq_constraints)
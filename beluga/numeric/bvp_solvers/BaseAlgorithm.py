@@ -10,6 +10,9 @@ class BaseAlgorithm(object):
     # Define class as abstract class
     __metaclass__ = abc.ABCMeta
 
+    # Whether the algorithm evaluates the batch versions of the derivative functions over a whole mesh
+    uses_batch_functions = False
+
     # Define common interface for algorithm classes
     def __init__(self, *args, **kwargs):
 
@@ -23,6 +26,11 @@ class BaseAlgorithm(object):
 
         self.derivative_function_jac = None
         self.boundarycondition_function_jac = None
+        self.event_function = None
+
+        self.derivative_function_batch = None
+        self.quadrature_function_batch = None
+        self.derivative_function_jac_batch = None
 
         if len(args) > 0:
             self.derivative_function = args[0]
@@ -45,13 +53,30 @@ class BaseAlgorithm(object):
 
     def set_derivative_function(self, derivative_function):
         self.derivative_function = derivative_function
+        self.derivative_function_batch = None
         self.stm_ode_func = None
 
+    def set_derivative_function_batch(self, derivative_function_batch):
+        self.derivative_function_batch = derivative_function_batch
+
     def set_derivative_jacobian(self, derivative_jacobian):
         self.derivative_function_jac = derivative_jacobian
+        self.derivative_function_jac_batch = None
+        self.stm_ode_func = None
+
+    def set_derivative_jacobian_batch(self, derivative_jacobian_batch):
+        self.derivative_function_jac_batch = derivative_jacobian_batch
+
+    def set_event_function(self, event_function):
+        self.event_function = event_function
 
     def set_quadrature_function(self, quadrature_function):
         self.quadrature_function = quadrature_function
+        self.quadrature_function_batch = None
+        self.stm_ode_func = None
+
+    def set_quadrature_function_batch(self, quadrature_function_batch):
+        self.quadrature_function_batch = quadrature_function_batch
 
     def set_initial_cost_function(self, initial_cost):
         self.initial_cost_function = initial_cost
@@ -0,0 +1,472 @@
+import copy
+import logging
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import coo_matrix, csc_matrix
+from scipy.sparse.linalg import splu
+
+from beluga.numeric.bvp_solvers import BaseAlgorithm, BVPResult
+from beluga.numeric.data_classes.Trajectory import Trajectory
+from beluga.utils.logging import logger
+
+EPS = np.finfo(float).eps
+
+# Interior nodes of the 5-point Lobatto rule, where the residual of the collocation solution is checked
+LOBATTO_NODES = 0.5 + np.array([-1, 1]) * np.sqrt(21) / 14
+
+MAX_STRUCTURES = 8
+
+# Newton iterations on a mesh before it is refined
+MAX_MESH_ITERATIONS = 8
+
+
+class CollocationStructure(object):
+    r"""
+    Sparsity structure of the collocation Jacobian for a mesh of `m` nodes, `n` states and quads, and `k` parameters.
+
+    The unknowns are the nodes :math:`y_0, \ldots, y_{m-1}` followed by the parameters. Each interval contributes the
+    blocks :math:`\partial r_i / \partial y_i`, :math:`\partial r_i / \partial y_{i+1}` and
+    :math:`\partial r_i / \partial p`, and the boundary conditions those with respect to :math:`y_0`, :math:`y_{m-1}`
+    and :math:`p`. The positions of all entries are worked out once, so assembling a Jacobian only scatters the values
+    of the blocks into a fixed CSC layout.
+
+    The first factorization orders the columns with COLAMD. That ordering is kept, and later Jacobians are assembled
+    with their columns already permuted and factored in their natural order, skipping the ordering step.
+    """
+
+    def __init__(self, m, n, k):
+        self.m, self.n, self.k = m, n, k
+        self.shape = (m * n + k, m * n + k)
+
+        i, a, b = np.meshgrid(np.arange(m - 1), np.arange(n), np.arange(n), indexing='ij')
+        rows_y, cols_y0, cols_y1 = (i * n + a).ravel(), (i * n + b).ravel(), ((i + 1) * n + b).ravel()
+        i, a, c = np.meshgrid(np.arange(m - 1), np.arange(n), np.arange(k), indexing='ij')
+        rows_p, cols_p = (i * n + a).ravel(), (m * n + c).ravel()
+        a, b = np.meshgrid(np.arange(n + k), np.arange(n), indexing='ij')
+        rows_bc_y, cols_bc_ya, cols_bc_yb = ((m - 1) * n + a).ravel(), b.ravel(), ((m - 1) * n + b).ravel()
+        a, c = np.meshgrid(np.arange(n + k), np.arange(k), indexing='ij')
+        rows_bc_p, cols_bc_p = ((m - 1) * n + a).ravel(), (m * n + c).ravel()
+
+        self.rows = np.hstack((rows_y, rows_y, rows_p, rows_bc_y, rows_bc_y, rows_bc_p))
+        self.cols = np.hstack((cols_y0, cols_y1, cols_p, cols_bc_ya, cols_bc_yb, cols_bc_p))
+
+        self.order = None
+        self._set_layout(self.cols)
+
+    def _set_layout(self, cols):
+        # Entries are tagged with their position in the block values, offset by one so none is a structural zero
+        tags = coo_matrix((np.arange(1, self.rows.size + 1), (self.rows, cols)), shape=self.shape).tocsc()
+        self._value_index = tags.data - 1
+        self._indices, self._indptr = tags.indices, tags.indptr
+
+    def assemble(self, values):
+        """
+        Scatters the values of the blocks into a CSC matrix, with its columns permuted by `order` if it is known.
+
+        :param values: Concatenated values of the blocks, each in C order.
+        :return: The Jacobian.
+        """
+        return csc_matrix((values[self._value_index], self._indices, self._indptr), shape=self.shape)
+
+    def factor(self, values):
+        """
+        Factors the Jacobian and returns a function solving the Newton system with it.
+
+        Falls back to a least squares solution if the Jacobian cannot be factored.
+
+        :param values: Concatenated values of the blocks, each in C order.
+        :return: Function called as ``jac_solve(b)``.
+        """
+        jac = self.assemble(values)
+        try:
+            if self.order is None:
+                lu = splu(jac, permc_spec='COLAMD')
+                self.order = np.argsort(lu.perm_c)
+                self._set_layout(np.argsort(self.order)[self.cols])
+                return lu.solve
+
+            lu = splu(jac, permc_spec='NATURAL')
+            order = self.order
+
+            def jac_solve(b):
+                x = np.empty_like(b)
+                x[order] = lu.solve(b)
+                return x
+
+            return jac_solve
+
+        except RuntimeError as error:
+            logging.warning(error)
+            jac = jac.toarray()
+            if self.order is not None:
+                jac = jac[:, np.argsort(self.order)]
+
+            return lambda b: np.linalg.lstsq(jac, b, rcond=None)[0]
+
+
+def collocation_residual(fun, t, y, p):
+    r"""
+    Residuals of the 4th order Lobatto IIIA collocation conditions on every interval of a mesh.
+
+    .. math::
+        r_i = y_{i+1} - y_i - \frac{h_i}{6}\left(f_i + 4 f_{i+1/2} + f_{i+1}\right)
+
+    where :math:`y_{i+1/2} = (y_i + y_{i+1})/2 - h_i (f_{i+1} - f_i)/8` is the midpoint of the cubic through the nodes.
+
+    :param fun: Right-hand side, called as ``fun(y, p)`` on an (n, m) array of nodes.
+    :param t: Mesh of m nodes.
+    :param y: States at the nodes, an (n, m) array.
+    :param p: Parameters.
+    :return: (r, f, y_mid, f_mid) with the (n, m - 1) residuals.
+    """
+    h = np.diff(t)
+    f = fun(y, p)
+    y_mid = 0.5 * (y[:, 1:] + y[:, :-1]) - 0.125 * h * (f[:, 1:] - f[:, :-1])
+    f_mid = fun(y_mid, p)
+    r = y[:, 1:] - y[:, :-1] - h / 6 * (f[:, :-1] + f[:, 1:] + 4 * f_mid)
+    return r, f, y_mid, f_mid
+
+
+def collocation_jacobian_blocks(t, df_dy, df_dp, df_dy_mid, df_dp_mid):
+    r"""
+    Blocks of the Jacobian of `collocation_residual` on every interval, from the Jacobians of the right-hand side at
+    the nodes and midpoints.
+
+    :param t: Mesh of m nodes.
+    :param df_dy: (n, n, m) Jacobians with respect to the states at the nodes.
+    :param df_dp: (n, k, m) Jacobians with respect to the parameters at the nodes.
+    :param df_dy_mid: (n, n, m - 1) Jacobians with respect to the states at the midpoints.
+    :param df_dp_mid: (n, k, m - 1) Jacobians with respect to the parameters at the midpoints.
+    :return: (dr_dy0, dr_dy1, dr_dp) of shapes (m - 1, n, n), (m - 1, n, n) and (m - 1, n, k).
+    """
+    h = np.diff(t)[:, np.newaxis, np.newaxis]
+    eye = np.eye(df_dy.shape[0])
+    df_dy, df_dp = df_dy.transpose(2, 0, 1), df_dp.transpose(2, 0, 1)
+    df_dy_mid, df_dp_mid = df_dy_mid.transpose(2, 0, 1), df_dp_mid.transpose(2, 0, 1)
+
+    dmid_dy0 = 0.5 * eye + 0.125 * h * df_dy[:-1]
+    dmid_dy1 = 0.5 * eye - 0.125 * h * df_dy[1:]
+    dmid_dp = -0.125 * h * (df_dp[1:] - df_dp[:-1])
+
+    dr_dy0 = -eye - h / 6 * (df_dy[:-1] + 4 * np.matmul(df_dy_mid, dmid_dy0))
+    dr_dy1 = eye - h / 6 * (df_dy[1:] + 4 * np.matmul(df_dy_mid, dmid_dy1))
+    dr_dp = -h / 6 * (df_dp[:-1] + df_dp[1:] + 4 * (df_dp_mid + np.matmul(df_dy_mid, dmid_dp)))
+    return dr_dy0, dr_dy1, dr_dp
+
+
+def hermite_cubic(s, t, y, f):
+    r"""
+    Evaluates the collocation solution, the cubic through the nodes matching :math:`f` at both ends of each interval.
+
+    :param s: Fraction of each interval, in [0, 1].
+    :param t: Mesh of m nodes.
+    :param y: States at the nodes, an (n, m) array.
+    :param f: Right-hand side at the nodes, an (n, m) array.
+    :return: (y_s, dy_s), the (n, m - 1) values and derivatives at the fraction `s` of every interval.
+    """
+    h = np.diff(t)
+    y0, y1, f0, f1 = y[:, :-1], y[:, 1:], f[:, :-1], f[:, 1:]
+    y_s = (2*s**3 - 3*s**2 + 1) * y0 + (s**3 - 2*s**2 + s) * h * f0 + (-2*s**3 + 3*s**2) * y1 + (s**3 - s**2) * h * f1
+    dy_s = (6*s**2 - 6*s) * (y0 - y1) / h + (3*s**2 - 4*s + 1) * f0 + (3*s**2 - 2*s) * f1
+    return y_s, dy_s
+
+
+def collocation_rms_residual(fun, t, y, f, p, r, f_mid):
+    r"""
+    RMS of the relative residuals :math:`(S' - f(S)) / (1 + |f(S)|)` of the collocation solution :math:`S` over every
+    interval, estimated with the 5-point Lobatto rule as in `scipy.integrate.solve_bvp`. The residuals vanish at the
+    nodes, and at the midpoints they follow from the collocation residuals `r`.
+
+    :return: The RMS residual of each interval.
+    """
+    h = np.diff(t)
+    r_mid = np.sum((1.5 * r / h / (1 + np.abs(f_mid)))**2, axis=0)
+    r_sides = 0
+    for s in LOBATTO_NODES:
+        y_s, dy_s = hermite_cubic(s, t, y, f)
+        f_s = fun(y_s, p)
+        r_sides = r_sides + np.sum(((dy_s - f_s) / (1 + np.abs(f_s)))**2, axis=0)
+
+    return np.sqrt(0.5 * (32 / 45 * r_mid + 49 / 90 * r_sides))
+
+
+class Collocation(BaseAlgorithm):
+    r"""
+    Sparse collocation for solving boundary value problems.
+
+    The states and quads are collocated with the 4th order Lobatto IIIA scheme of `scipy.integrate.solve_bvp` on the
+    nodes of the mesh of the guess. The collocation conditions and boundary conditions are solved by a damped Newton
+    method for the nodes together with the dynamical and nondynamical parameters. Once they hold to `tolerance`, the
+    residual of the collocation solution is checked between the nodes and every interval where it exceeds
+    `mesh_tolerance` is split in two, until no interval is split or the mesh would grow past `max_nodes`.
+
+    +------------------------+-----------------+-----------------+
+    | Valid kwargs           | Default Value   | Valid Values    |
+    +========================+=================+=================+
+    | tolerance              | 1e-4            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | mesh_tolerance         | 1e-3            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | max_iterations         | 100             | > 0             |
+    +------------------------+-----------------+-----------------+
+    | max_nodes              | 2000            | > 2             |
+    +------------------------+-----------------+-----------------+
+    | reuse_jacobian         | True            | bool            |
+    +------------------------+-----------------+-----------------+
+    | reuse_contraction      | 0.5             | (0, 1)          |
+    +------------------------+-----------------+-----------------+
+
+    The Jacobian of the right-hand side comes from the batch function given to `set_derivative_jacobian_batch`, or
+    from `set_derivative_jacobian` node by node, when there are no quads. Otherwise it is found by finite differences
+    of the batch functions given to `set_derivative_function_batch` and `set_quadrature_function_batch`, each a single
+    call over the whole mesh. The boundary conditions are always finite differenced.
+
+    The collocation Jacobian is kept in sparse form and factored with `splu`. Its structure and fill-reducing column
+    ordering only depend on the size of the mesh, so they are found once and reused by every later Jacobian of the
+    same size, across Newton iterations and calls to `solve`. With `reuse_jacobian`, the LU factors are also kept for
+    as long as each step shrinks the residual by at least `reuse_contraction`, and the last ones of a converged solve
+    seed the next call to `solve` on a mesh of the same size. Neighboring cases of a continuation set then rarely need
+    a new factorization.
+    """
+
+    uses_batch_functions = True
+
+    def __init__(self, *args, **kwargs):
+        BaseAlgorithm.__init__(self, *args, **kwargs)
+
+        self.tolerance = kwargs.get('tolerance', 1e-4)
+        self.mesh_tolerance = kwargs.get('mesh_tolerance', 1e-3)
+        self.max_iterations = kwargs.get('max_iterations', 100)
+        self.max_nodes = kwargs.get('max_nodes', 2000)
+        self.reuse_jacobian = kwargs.get('reuse_jacobian', True)
+        self.reuse_contraction = kwargs.get('reuse_contraction', 0.5)
+
+        self._structures = OrderedDict()
+        self._saved_jacobian = None
+
+    def _structure(self, m, n, k):
+        key = (m, n, k)
+        if key in self._structures:
+            self._structures.move_to_end(key)
+        else:
+            self._structures[key] = CollocationStructure(m, n, k)
+            if len(self._structures) > MAX_STRUCTURES:
+                self._structures.popitem(last=False)
+
+        return self._structures[key]
+
+    def solve(self, solinit, **kwargs):
+
+        solinit = copy.deepcopy(solinit)
+        sol = Trajectory(solinit)
+
+        nstates = solinit.y.shape[1]
+        nquads = solinit.q.shape[1] if solinit.q.size > 0 else 0
+        ndyn = solinit.dynamical_parameters.size
+        nnondyn = solinit.nondynamical_parameters.size
+        n, k = nstates + nquads, ndyn + nnondyn
+        const = np.asarray(solinit.const, dtype=float)
+
+        deriv_batch = self.derivative_function_batch
+        if deriv_batch is None:
+            def deriv_batch(_y, _p, _k):
+                return np.vstack([self.derivative_function(yi, _p, _k) for yi in _y.T]).T
+
+        quad_batch = self.quadrature_function_batch
+        if quad_batch is None and nquads > 0:
+            def quad_batch(_y, _p, _k):
+                return np.vstack([self.quadrature_function(yi, _p, _k) for yi in _y.T]).T
+
+        def _fun(y, p):
+            f = deriv_batch(y[:nstates], p[:ndyn], const)
+            if nquads > 0:
+                f = np.vstack((f, quad_batch(y[:nstates], p[:ndyn], const)))
+
+            return f
+
+        if nquads > 0:
+            def _bc(ya, yb, p):
+                return np.asarray(self.boundarycondition_function(ya[:nstates], ya[nstates:], yb[:nstates],
+                                                                  yb[nstates:], p[:ndyn], p[ndyn:], const))
+        else:
+            def _bc(ya, yb, p):
+                return np.asarray(self.boundarycondition_function(ya, yb, p[:ndyn], p[ndyn:], const))
+
+        def _fun_jac(y, p, f):
+            df_dy = np.zeros((n, n, y.shape[1]))
+            df_dp = np.zeros((n, k, y.shape[1]))
+            if nquads == 0 and self.derivative_function_jac_batch is not None:
+                self.derivative_function_jac_batch(y, p[:ndyn], const, df_dy, df_dp)
+
+            elif nquads == 0 and self.derivative_function_jac is not None:
+                for ii, yi in enumerate(y.T):
+                    _df_dy, _df_dp = self.derivative_function_jac(yi, p[:ndyn], const)
+                    df_dy[:, :, ii] = _df_dy
+                    df_dp[:, :ndyn, ii] = np.reshape(_df_dp, (n, ndyn))
+
+            else:
+                # Quads never enter the right-hand side, so only the states and dynamical parameters are perturbed
+                for jj in range(nstates):
+                    y_new = y.copy()
+                    y_new[jj] += EPS**0.5 * (1 + np.abs(y[jj]))
+                    df_dy[:, jj] = (_fun(y_new, p) - f) / (y_new[jj] - y[jj])
+
+                for jj in range(ndyn):
+                    p_new = p.copy()
+                    p_new[jj] += EPS**0.5 * (1 + np.abs(p[jj]))
+                    df_dp[:, jj] = (_fun(y, p_new) - f) / (p_new[jj] - p[jj])
+
+            return df_dy, df_dp
+
+        def _bc_jac(ya, yb, p, bc0):
+            z = np.hstack((ya, yb, p))
+            dbc_dz = np.empty((bc0.size, z.size))
+            for jj in range(z.size):
+                z_new = z.copy()
+                z_new[jj] += EPS**0.5 * (1 + np.abs(z[jj]))
+                dbc_dz[:, jj] = (_bc(z_new[:n], z_new[n:2*n], z_new[2*n:]) - bc0) / (z_new[jj] - z[jj])
+
+            return dbc_dz[:, :n], dbc_dz[:, n:2*n], dbc_dz[:, 2*n:]
+
+        def _unpack(x, m):
+            return x[:m*n].reshape((m, n)).T, x[m*n:]
+
+        def _residual(t, x):
+            y, p = _unpack(x, t.size)
+            r, f, y_mid, f_mid = collocation_residual(_fun, t, y, p)
+            bc = _bc(y[:, 0], y[:, -1], p)
+            return np.hstack((r.T.ravel(), bc)), (f, y_mid, f_mid, bc)
+
+        def _jacobian_values(t, x, evaluations):
+            y, p = _unpack(x, t.size)
+            f, y_mid, f_mid, bc = evaluations
+            df_dy, df_dp = _fun_jac(y, p, f)
+            df_dy_mid, df_dp_mid = _fun_jac(y_mid, p, f_mid)
+            blocks = collocation_jacobian_blocks(t, df_dy, df_dp, df_dy_mid, df_dp_mid)
+            blocks += _bc_jac(y[:, 0], y[:, -1], p, bc)
+            return np.hstack([block.ravel() for block in blocks])
+
+        t = np.array(solinit.t, dtype=float)
+        if nquads > 0:
+            y_init = np.hstack((solinit.y, solinit.q))
+        else:
+            y_init = solinit.y
+
+        x = np.hstack((np.asarray(y_init, dtype=float).ravel(),
+                       np.asarray(solinit.dynamical_parameters, dtype=float),
+                       np.asarray(solinit.nondynamical_parameters, dtype=float)))
+
+        n_iter = 0
+        converged = False
+        message = 'Max iterations exceeded.'
+        while n_iter < self.max_iterations:
+            structure = self._structure(t.size, n, k)
+
+            jac_solve = None
+            jac_is_fresh = False
+            if self.reuse_jacobian and self._saved_jacobian is not None and self._saved_jacobian[0] is structure:
+                jac_solve = self._saved_jacobian[1]
+                logger.debug('Reusing Jacobian from the previous solve')
+
+            residual, evaluations = _residual(t, x)
+            err = np.linalg.norm(residual)
+
+            # A mesh too coarse to resolve the solution is refined before Newton's method has converged on it
+            n_mesh_iter = 0
+            while err > self.tolerance and n_iter < self.max_iterations and n_mesh_iter < MAX_MESH_ITERATIONS:
+                if any(np.isnan(residual)):
+                    raise RuntimeError("Nan in residual")
+
+                if jac_solve is None:
+                    jac_solve = structure.factor(_jacobian_values(t, x, evaluations))
+                    jac_is_fresh = True
+
+                dx = jac_solve(-residual)
+
+                a = 1e-4
+                reduct = 0.5
+                ll = 1
+                r_try = float('Inf')
+                step = None
+                res_try, eval_try = None, None
+                stalled = True
+
+                # Backtracking is only worth it on a fresh Jacobian. Old factors are rebuilt as soon as the full step
+                # fails to reduce the residual.
+                if jac_is_fresh:
+                    ll_min = 0.05
+                else:
+                    ll_min = 1
+
+                while (r_try >= (1-a*ll) * err) and (r_try > self.tolerance) and ll >= ll_min:
+                    step = ll*dx
+                    res_try, eval_try = _residual(t, x + step)
+                    r_try = np.linalg.norm(res_try)
+                    stalled = (r_try >= (1-a*ll) * err) and (r_try > self.tolerance)
+                    ll *= reduct
+
+                n_iter += 1
+                n_mesh_iter += 1
+
+                if stalled and not jac_is_fresh:
+                    logger.debug('BVP Iter {}\tLine search stalled, rebuilding Jacobian'.format(n_iter))
+                    jac_solve = None
+                    continue
+
+                x = x + step
+                contraction = r_try / err
+                residual, evaluations, err = res_try, eval_try, r_try
+
+                logger.debug('BVP Iter {}\tResidual {:13.8E}\tNodes {}'.format(n_iter, err, t.size))
+
+                if self.reuse_jacobian and contraction <= self.reuse_contraction:
+                    # Modified Newton, keep the factors while they still converge quickly
+                    jac_is_fresh = False
+                else:
+                    jac_solve = None
+
+            if self.reuse_jacobian and err <= self.tolerance and jac_solve is not None:
+                self._saved_jacobian = (structure, jac_solve)
+
+            y, p = _unpack(x, t.size)
+            f, y_mid, f_mid, _ = evaluations
+            r = residual[:(t.size - 1) * n].reshape((t.size - 1, n)).T
+            rms_residuals = collocation_rms_residual(_fun, t, y, f, p, r, f_mid)
+
+            # Intervals are split in two, or in three where the residual is far too large
+            split_2 = np.nonzero((self.mesh_tolerance < rms_residuals) & (rms_residuals <= 100*self.mesh_tolerance))[0]
+            split_3 = np.nonzero(rms_residuals > 100*self.mesh_tolerance)[0]
+            n_new = split_2.size + 2 * split_3.size
+            if n_new == 0:
+                if err <= self.tolerance:
+                    converged = True
+                    message = 'Converged in ' + str(n_iter) + ' iterations.'
+                    break
+
+                continue
+
+            if t.size + n_new > self.max_nodes:
+                message = 'Maximum number of mesh nodes exceeded.'
+                break
+
+            # The new nodes take the values of the collocation solution
+            h = np.diff(t)
+            splits = [(split_2, 1 / 2), (split_3, 1 / 3), (split_3, 2 / 3)]
+            positions = np.hstack([split + 1 for split, _ in splits])
+            t_new = np.hstack([t[split] + s * h[split] for split, s in splits])
+            y_new = np.hstack([hermite_cubic(s, t, y, f)[0][:, split] for split, s in splits])
+            t = np.insert(t, positions, t_new)
+            x = np.hstack((np.insert(y, positions, y_new, axis=1).T.ravel(), p))
+            logger.debug('Split {} intervals, {} nodes'.format(split_2.size + split_3.size, t.size))
+
+        y, p = _unpack(x, t.size)
+        sol.t = t
+        sol.y = y[:nstates].T
+        sol.q = y[nstates:].T
+        sol.dual = np.zeros_like(sol.y)
+        sol.dynamical_parameters = p[:ndyn]
+        sol.nondynamical_parameters = p[ndyn:]
+        sol.converged = converged
+
+        out = BVPResult(sol=sol, success=converged, message=message, niter=n_iter)
+        return out
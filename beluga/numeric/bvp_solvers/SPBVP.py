@@ -17,8 +17,14 @@ class SPBVP(BaseAlgorithm):
     | max_nodes              | 1000            | > 2             |
     +========================+=================+=================+
 
+    When batch versions of the derivative and quadrature functions are set, see `set_derivative_function_batch`, the
+    right-hand side is evaluated on the whole mesh in one call rather than node by node. Likewise, a batch version of
+    the derivative Jacobian, see `set_derivative_jacobian_batch`, fills the Jacobian tensors of the whole mesh in place.
+
     """
 
+    uses_batch_functions = True
+
     def __init__(self, *args, **kwargs):
         BaseAlgorithm.__init__(self, *args, **kwargs)
         self.max_nodes = kwargs.get('max_nodes', 2000)
@@ -42,29 +48,55 @@ class SPBVP(BaseAlgorithm):
         ndyn = solinit.dynamical_parameters.size
         nnondyn = solinit.nondynamical_parameters.size
 
+        # Compiled functions only take float64 constants
+        const = np.asarray(solinit.const, dtype=float)
+
         empty_array = np.array([])
 
+        # The batch versions evaluate every node of the mesh in one call
+        use_batch = self.derivative_function_batch is not None \
+            and (nquads == 0 or self.quadrature_function_batch is not None)
+
         if nquads == 0:
-            # TODO: Try to vectorize
-            def _fun(t, y, params=empty_array, const=solinit.const):
-                return np.vstack([self.derivative_function(yi[:nstates], params[:ndyn], const) for yi in y.T]).T
+            if use_batch:
+                def _fun(t, y, params=empty_array, const=const):
+                    return self.derivative_function_batch(y, params[:ndyn], const)
+            else:
+                def _fun(t, y, params=empty_array, const=const):
+                    return np.vstack([self.derivative_function(yi[:nstates], params[:ndyn], const) for yi in y.T]).T
 
-            def _bc(ya, yb, params=empty_array, const=solinit.const):
+            def _bc(ya, yb, params=empty_array, const=const):
                 return self.boundarycondition_function(ya, yb, params[:ndyn], params[ndyn:ndyn + nnondyn], const)
         else:
-            def _fun(t, y, params=empty_array, const=solinit.const):
-                y = y.T
-                o1 = np.vstack([self.derivative_function(yi[:nstates], params[:ndyn], const) for yi in y])
-                o2 = np.vstack([self.quadrature_function(yi[:nstates], params[:ndyn], const) for yi in y])
-                return np.hstack((o1, o2)).T
+            if use_batch:
+                def _fun(t, y, params=empty_array, const=const):
+                    y = y[:nstates]
+                    return np.vstack((self.derivative_function_batch(y, params[:ndyn], const),
+                                      self.quadrature_function_batch(y, params[:ndyn], const)))
+            else:
+                def _fun(t, y, params=empty_array, const=const):
+                    y = y.T
+                    o1 = np.vstack([self.derivative_function(yi[:nstates], params[:ndyn], const) for yi in y])
+                    o2 = np.vstack([self.quadrature_function(yi[:nstates], params[:ndyn], const) for yi in y])
+                    return np.hstack((o1, o2)).T
 
-            def _bc(ya, yb, params=np.array([]), const=solinit.const):
+            def _bc(ya, yb, params=np.array([]), const=const):
                 return self.boundarycondition_function(ya[:nstates], ya[nstates:nstates+nquads], yb[:nstates],
                                                        yb[nstates:nstates+nquads], params[:ndyn],
                                                        params[ndyn:ndyn+nnondyn], const)
 
-        if self.derivative_function_jac is not None:
-            def _fun_jac(t, y, params=np.array([]), const=solinit.const):
+        if self.derivative_function_jac_batch is not None and nquads == 0:
+            def _fun_jac(t, y, params=np.array([]), const=const):
+                df_dy = np.zeros((nstates, nstates, t.size))
+                df_dp = np.zeros((nstates, ndyn+nnondyn, t.size))
+                self.derivative_function_jac_batch(y, params[:ndyn], const, df_dy, df_dp)
+
+                if ndyn + nnondyn == 0:
+                    return df_dy
+                else:
+                    return df_dy, df_dp
+        elif self.derivative_function_jac is not None:
+            def _fun_jac(t, y, params=np.array([]), const=const):
                 y = y.T
                 df_dy = np.zeros((y[0].size, y[0].size, t.size))
                 df_dp = np.zeros((y[0].size, ndyn+nnondyn, t.size))
@@ -85,14 +117,14 @@ class SPBVP(BaseAlgorithm):
 
         if self.boundarycondition_function_jac is not None:
             if nquads > 0:
-                def _bc_jac(ya, yb, params=np.array([]), const=solinit.const):
+                def _bc_jac(ya, yb, params=np.array([]), const=const):
                     dbc_dya, dbc_dyb, dbc_dp = \
                         self.boundarycondition_function_jac(ya[:nstates], ya[nstates:nstates+nquads], yb[:nstates],
                                                             yb[nstates:nstates+nquads], params[:ndyn],
                                                             params[ndyn:ndyn+nnondyn], const)
                     return dbc_dya, dbc_dyb, dbc_dp
             else:
-                def _bc_jac(ya, yb, params=np.array([]), const=solinit.const):
+                def _bc_jac(ya, yb, params=np.array([]), const=const):
                     dbc_dya, dbc_dyb, dbc_dp = \
                         self.boundarycondition_function_jac(ya, yb, params[:ndyn], params[ndyn:ndyn+nnondyn], const)
                     return dbc_dya, dbc_dyb, dbc_dp
@@ -1,18 +1,22 @@
 import beluga
-import cloudpickle as pickle
 import copy
 import logging
+import warnings
+from collections import OrderedDict
+from functools import partial
 from math import isclose
 import numpy as np
+from numba import njit, float64, errors
 
 from beluga.numeric.bvp_solvers import BaseAlgorithm, BVPResult
-from beluga.numeric.ivp_solvers import Propagator, reconstruct
+from beluga.numeric.ivp_solvers import Propagator, make_stm_ode, make_directional_ode, propagate_task, \
+    propagate_endpoint_task, ship_function
 from beluga.numeric.data_classes.Trajectory import Trajectory
 from beluga.utils.logging import logger
-from scipy.sparse import coo_matrix, csc_matrix
-from scipy.sparse.linalg import splu
-from scipy.optimize.slsqp import approx_jacobian
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix
+from scipy.sparse.linalg import splu, gmres, onenormest, LinearOperator
 from scipy.optimize import minimize, root, fsolve
+from scipy.linalg import lu_factor, lu_solve, get_lapack_funcs, LinAlgWarning
 
 scipy_minimize_algorithms = {'Nelder-Mead', 'Powell', 'CG', 'BFGS', 'Newton-CG', 'L-BFGS-B', 'TNC', 'COBYLA', 'SLSQP',
                              'trust-constr', 'dogleg', 'trust-ncg', 'trust-exact', 'trust-krylov'}
@@ -25,109 +29,59 @@ EPS = np.finfo(float).eps
 def estimate_bc_jac(bc, ya, qa, yb, qb, p, ndp, bc0=None):
     """Estimate derivatives of boundary conditions with forward differences.
 
+    The boundary condition function is called as ``bc(ya, qa, yb, qb, p, ndp)``.
+
     Returns
     -------
-    dbc_dya : ndarray, shape (n + k, n)
+    dbc_dya : ndarray, shape (n_bc, n)
         Derivatives with respect to ya. An element (i, j) corresponds to
         d bc_i / d ya_j.
-    dbc_dyb : ndarray, shape (n + k, n)
+    dbc_dqa : ndarray, shape (n_bc, nq)
+        Derivatives with respect to qa.
+    dbc_dyb : ndarray, shape (n_bc, n)
         Derivatives with respect to yb. An element (i, j) corresponds to
         d bc_i / d yb_j.
-    dbc_dp : ndarray with shape (n + k, k) or None
+    dbc_dqb : ndarray, shape (n_bc, nq)
+        Derivatives with respect to qb.
+    dbc_dp : ndarray, shape (n_bc, k)
         Derivatives with respect to p. An element (i, j) corresponds to
-        d bc_i / d p_j. If `p` is empty, None is returned.
+        d bc_i / d p_j.
+    dbc_dndp : ndarray, shape (n_bc, m)
+        Derivatives with respect to ndp.
     """
-    n = ya.shape[0]
-    k = p.shape[0]
-
     if bc0 is None:
-        bc0 = bc(ya, yb, p, ndp,)
-
-    dtype = ya.dtype
-
-    dbc_dya = np.empty((n, n + k), dtype=dtype)
-    h = EPS**0.5 * (1 + np.abs(ya))
-    for i in range(n):
-        ya_new = ya.copy()
-        ya_new[i] += h[i]
-        hi = ya_new[i] - ya[i]
-        bc_new = bc(ya_new, yb, p, ndp)
-        dbc_dya[i] = (bc_new - bc0) / hi
-    dbc_dya = dbc_dya.T
-
-    h = EPS**0.5 * (1 + np.abs(yb))
-    dbc_dyb = np.empty((n, n + k), dtype=dtype)
-    for i in range(n):
-        yb_new = yb.copy()
-        yb_new[i] += h[i]
-        hi = yb_new[i] - yb[i]
-        bc_new = bc(ya, yb_new, p)
-        dbc_dyb[i] = (bc_new - bc0) / hi
-    dbc_dyb = dbc_dyb.T
-
-    if k == 0:
-        dbc_dp = None
-    else:
-        h = EPS**0.5 * (1 + np.abs(p))
-        dbc_dp = np.empty((k, n + k), dtype=dtype)
-        for i in range(k):
-            p_new = p.copy()
-            p_new[i] += h[i]
-            hi = p_new[i] - p[i]
-            bc_new = bc(ya, yb, p_new)
-            dbc_dp[i] = (bc_new - bc0) / hi
-        dbc_dp = dbc_dp.T
-
-    return dbc_dya, dbc_dyb, dbc_dp
-
-
-def wrap_functions(fun, bc, fun_jac, bc_jac, aux, k, dtype):
-    """Wrap functions for unified usage in the solver."""
-
-    fun_jac_p, fun_jac_wrapped, bc_jac_wrapped = None, None, None
-
-    if k == 0:
-        def fun_p(x, y, _):
-            return np.asarray(fun(x, y), dtype)
-
-        def bc_wrapped(ya, yb, _):
-            return np.asarray(bc(ya, [], [], yb, [], [], _, [], aux), dtype)
-
-        if fun_jac is not None:
-            def fun_jac_p(x, y, _):
-                return np.asarray(fun_jac(x, y), dtype), None
-
-        if bc_jac is not None:
-            def bc_jac_wrapped(ya, yb, _):
-                dbc_dya, dbc_dyb = bc_jac(ya, yb)
-                return (np.asarray(dbc_dya, dtype),
-                        np.asarray(dbc_dyb, dtype), None)
-    else:
-        def fun_p(x, y, p):
-            return np.asarray(fun(x, y, p), dtype)
-
-        empty_array = np.array([])
-
-        def bc_wrapped(ya, yb, p, ndp):
-            return np.asarray(bc(ya, empty_array, empty_array, yb, empty_array, empty_array, p, ndp, aux), dtype)
-
-        if fun_jac is not None:
-            def fun_jac_p(x, y, p):
-                df_dy, df_dp = fun_jac(x, y, p)
-                return np.asarray(df_dy, dtype), np.asarray(df_dp, dtype)
-
-        if bc_jac is not None:
-            def bc_jac_wrapped(ya, yb, p):
-                dbc_dya, dbc_dyb, dbc_dp = bc_jac(ya, yb, p)
-                return (np.asarray(dbc_dya, dtype), np.asarray(dbc_dyb, dtype),
-                        np.asarray(dbc_dp, dtype))
-
-    fun_wrapped = fun_p
-
-    if fun_jac is not None:
-        fun_jac_wrapped = fun_jac_p
-
-    return fun_wrapped, bc_wrapped, fun_jac_wrapped, bc_jac_wrapped
+        bc0 = np.asarray(bc(ya, qa, yb, qb, p, ndp))
+
+    args = [ya, qa, yb, qb, p, ndp]
+    out = []
+
+    for idx, arg in enumerate(args):
+        h = EPS**0.5 * (1 + np.abs(arg))
+        d_arg = np.empty((bc0.size, arg.size), dtype=bc0.dtype)
+        for i in range(arg.size):
+            arg_new = arg.copy()
+            arg_new[i] += h[i]
+            hi = arg_new[i] - arg[i]
+            bc_new = np.asarray(bc(*(args[:idx] + [arg_new] + args[idx + 1:])))
+            d_arg[:, i] = (bc_new - bc0) / hi
+        out.append(d_arg)
+
+    return tuple(out)
+
+
+@njit
+def _multiple_shooting_residual(y0_set, yf_set, bc):
+    n_arcs, n_odes = y0_set.shape
+    n_cont = (n_arcs - 1) * n_odes
+    out = np.empty(n_cont + bc.size)
+    for ii in range(n_arcs - 1):
+        for jj in range(n_odes):
+            out[ii * n_odes + jj] = yf_set[ii, jj] - y0_set[ii + 1, jj]
+
+    for ii in range(bc.size):
+        out[n_cont + ii] = bc[ii]
+
+    return out
 
 
 class Shooting(BaseAlgorithm):
@@ -179,9 +133,105 @@ class Shooting(BaseAlgorithm):
     +------------------------+-----------------+-----------------+
     | num_arcs               | 1               | > 0             |
     +------------------------+-----------------+-----------------+
+    | jacobian_method        | 'stm'           | {'stm', 'fd'}   |
+    +------------------------+-----------------+-----------------+
+    | jacobian_update        | 'full'          | {'full',        |
+    |                        |                 | 'broyden'}      |
+    +------------------------+-----------------+-----------------+
+    | max_condition          | 1e12            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | reuse_jacobian         | False           | bool            |
+    +------------------------+-----------------+-----------------+
+    | reuse_contraction      | 0.5             | (0, 1)          |
+    +------------------------+-----------------+-----------------+
+    | linear_solver          | 'lu'            | {'lu',          |
+    |                        |                 | 'condensed',    |
+    |                        |                 | 'gmres'}        |
+    +------------------------+-----------------+-----------------+
+    | arc_placement          | 'uniform'       | {'uniform',     |
+    |                        |                 | 'adaptive'}     |
+    +------------------------+-----------------+-----------------+
+    | repartition_arcs       | True            | bool            |
+    +------------------------+-----------------+-----------------+
+    | inexact_newton         | False           | bool            |
+    +------------------------+-----------------+-----------------+
+    | ivp_tolerance_factor   | 1e-2            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | max_ivp_tolerance      | 1e-3            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | cache_size             | 4               | >= 0            |
+    +------------------------+-----------------+-----------------+
+    | trust_radius           | None            | > 0             |
+    +------------------------+-----------------+-----------------+
+    | batch_propagation      | False           | bool            |
+    +------------------------+-----------------+-----------------+
 
-    The shooting solver uses 3rd party root-solvers to find numeric solutions. In addition to `Armijo`,
-    the SciPy solvers `scipy.optimize.root`, `scipy.optimize.minimize`, `scipy.optimize.fsolve` are available.
+    The shooting solver uses 3rd party root-solvers to find numeric solutions. In addition to `Armijo` and
+    `TrustRegion`, the SciPy solvers `scipy.optimize.root`, `scipy.optimize.minimize`, `scipy.optimize.fsolve` are
+    available.
+
+    `TrustRegion` takes Powell's dogleg steps between the Newton step and the steepest descent step of the residual
+    norm, inside a radius that grows or shrinks with how well the linear model predicted the last step. The radius is
+    measured in unknowns scaled by the column norms of the Jacobian, as in MINPACK, so poorly scaled unknowns do not
+    dictate the step. It shares the Jacobian, its sparse factors and the residual cache with `Armijo`, and a rejected
+    step only costs one residual. Unlike `Armijo` it never accepts a step that increases the residual. The initial
+    radius is `trust_radius` in scaled unknowns, or the length of the first Newton step if not given. The dogleg needs
+    the factors of a Jacobian built at every accepted point, so `TrustRegion` raises a `ValueError` with
+    `linear_solver` set to 'gmres' or `jacobian_update` set to 'broyden'.
+
+    By default the Jacobian is built from the state-transition matrix of each arc, costing one augmented propagation
+    per arc. `Armijo` keeps it in sparse form and factors the block-bidiagonal system with `splu`. Setting
+    `jacobian_method` to 'fd' instead uses finite differences of the full residual.
+
+    With `jacobian_update` set to 'broyden', `Armijo` builds the Jacobian once and then applies Broyden's "good"
+    rank-one update after every step. The Jacobian is rebuilt only when the line search stalls or the condition
+    number of the updated Jacobian, estimated from its LU factors, exceeds `max_condition`.
+
+    With `reuse_jacobian`, `Armijo` follows a modified Newton policy. A Jacobian and its LU factors are kept for as
+    long as each step shrinks the residual by at least `reuse_contraction`, and the last ones of a converged solve seed
+    the next call to `solve`. Neighboring cases of a continuation set then rarely need a new Jacobian.
+
+    Setting `linear_solver` to 'condensed' makes `Armijo` eliminate the interior arcs from the Newton system with the
+    arc STMs. Only a system the size of one arc's states and the parameters is factored, and the interior corrections
+    are recovered by forward substitution, so the cost grows linearly with `num_arcs`. Chaining the STMs gives up some
+    of the conditioning that many arcs buy, and rank-one updates break the structure it relies on, so it is not used
+    with `jacobian_update` set to 'broyden'.
+
+    Setting `linear_solver` to 'gmres' turns `Armijo` into a Jacobian-free Newton-Krylov method. Newton steps are found
+    by GMRES from products of the Jacobian with a vector, each one propagation per arc of the states together with
+    their derivative along that vector rather than the full STM. The factors of the last Jacobian that was built
+    precondition GMRES, and a new one is only built when GMRES or the line search fails.
+
+    Arcs are spread evenly over the time span by default. With `arc_placement` set to 'adaptive', the STM is propagated
+    once along the guess and the arc boundaries are placed so every arc sees about the same growth of the STM, which
+    puts the arcs in boundary layers instead of smooth stretches. Unless `repartition_arcs` is set, the boundaries found
+    on the first call to `solve` are kept, relative to the time span, for the following cases of a continuation set.
+
+    With `inexact_newton`, `Armijo` loosens the integration tolerances while the residual is large. Each iteration
+    integrates with `abstol` and `reltol` set to `ivp_tolerance_factor` times the residual norm, capped at
+    `max_ivp_tolerance` and never tighter than those in `ivp_args`, so only the last iterations run at full accuracy.
+    Convergence is always confirmed at the tolerances in `ivp_args`. Finite differences are taken at those tolerances
+    as well, since integration errors would swamp them.
+
+    The last `cache_size` residuals are kept, keyed by the exact unknowns and integration tolerances, so the point
+    accepted by a line search is not propagated again at the start of the next iteration. Residuals only propagate
+    the endpoints of the arcs, and the full arcs are propagated once, for the returned solution.
+
+    With `batch_propagation` and no pool, the arcs of an evaluation that share their parameters are propagated as one
+    ensemble by `Propagator.propagate_batch`. This covers the arcs of a residual, their STMs, the perturbed arcs of
+    finite differences, and the arcs of the returned solution. Perturbed and nominal arcs then take the same steps,
+    which also keeps finite differences free of step size noise.
+
+    With `warm_start` in `ivp_args`, the nominal and perturbed arcs each remember their own step sizes. Only arcs
+    propagated without a pool are warm started, since the step sizes found in the workers of a pool are not sent back.
+
+    When `ivp_args` selects an implicit stepper, the arcs are propagated with the Jacobian of the equations of motion
+    given to `set_derivative_jacobian`, so the stepper does not have to finite difference the equations of motion.
+    Ensembles do not use it.
+
+    With `detect_events` in `ivp_args`, the arcs restart at the zero crossings of the function given to
+    `set_event_function`, which the continuation process sets to the conditions of the problem's switches. The STMs
+    and ensembles do not restart at them.
 
     """
     def __init__(self, *args, **kwargs):
@@ -194,40 +244,27 @@ class Shooting(BaseAlgorithm):
         self.max_error = kwargs.get('max_error', 100)
         self.max_iterations = kwargs.get('max_iterations', 100)
         self.num_arcs = kwargs.get('num_arcs', 1)
+        self.jacobian_method = kwargs.get('jacobian_method', 'stm')
+        self.jacobian_update = kwargs.get('jacobian_update', 'full')
+        self.max_condition = kwargs.get('max_condition', 1e12)
+        self.reuse_jacobian = kwargs.get('reuse_jacobian', False)
+        self.reuse_contraction = kwargs.get('reuse_contraction', 0.5)
+        self.linear_solver = kwargs.get('linear_solver', 'lu')
+        self.arc_placement = kwargs.get('arc_placement', 'uniform')
+        self.repartition_arcs = kwargs.get('repartition_arcs', True)
+        self.inexact_newton = kwargs.get('inexact_newton', False)
+        self.ivp_tolerance_factor = kwargs.get('ivp_tolerance_factor', 1e-2)
+        self.max_ivp_tolerance = kwargs.get('max_ivp_tolerance', 1e-3)
+        self.cache_size = kwargs.get('cache_size', 4)
+        self.trust_radius = kwargs.get('trust_radius', None)
+        self.batch_propagation = kwargs.get('batch_propagation', False)
+
+        self._saved_jacobian = None
+        self._arc_fractions = None
 
         self.stm_ode_func = None
         self.bc_func_ms = None
-
-        # Set up the boundary condition function
-        if self.boundarycondition_function is not None:
-            self.bc_func_ms = self._bc_func_multiple_shooting(bc_func=self.boundarycondition_function)
-
-    @staticmethod
-    def _wrap_y0(gamma_set, parameters, nondynamical_parameters):
-        n_odes = len(gamma_set[0].y[0])
-        n_quads = len(gamma_set[0].q[0])
-        n_dynparams = len(parameters)
-        n_nondynparams = len(nondynamical_parameters)
-        out = np.zeros(len(gamma_set) * n_odes + n_quads + n_dynparams + n_nondynparams)
-
-        ii = 0
-        for trajectory in gamma_set:
-            for initial_pt in trajectory.y[0]:
-                out[ii] = initial_pt
-                ii += 1
-
-        for initial_pt in gamma_set[0].q[0]:
-            out[ii] = initial_pt
-            ii += 1
-
-        for initial_pt in parameters:
-            out[ii] = initial_pt
-            ii += 1
-
-        for initial_pt in nondynamical_parameters:
-            out[ii] = initial_pt
-            ii += 1
-        return out
+        self._bc_func_ms_quads = False
 
     @staticmethod
     def _unwrap_y0(xx, n_odes, n_quads, n_dynparams, n_arcs):
@@ -238,193 +275,357 @@ class Shooting(BaseAlgorithm):
         return y0, q0, dparams, dnonparams
 
     @staticmethod
-    def _make_gammas(derivative_function, quadrature_function, gamma_set, dyn_param,
-                     sol, prop, pool, nquads):
-        n_arcs = len(gamma_set)
-        tspan = [None]*n_arcs
-        y0g = [None]*n_arcs
-        q0g = [None]*n_arcs
-        u0g = [None]*n_arcs
-        for ii in range(len(gamma_set)):
-            _y0g, _q0g, _u0g = gamma_set[ii](gamma_set[ii].t[0])
-            tspan[ii] = gamma_set[ii].t
-            y0g[ii] = _y0g
-            q0g[ii] = _q0g
-            u0g[ii] = _u0g
-
-        def preload(args):
-            return prop(derivative_function, quadrature_function, args[0], args[1], args[2],
-                        dyn_param, sol.const)
+    def _make_gammas(derivative_function, quadrature_function, tspan_set, y0_set, q0, dyn_param, const, prop, pool,
+                     nquads, derivative_function_jac=None, event_function=None, batch=False):
+        tasks = [(tspan, y0, q0, dyn_param, const) for tspan, y0 in zip(tspan_set, y0_set)]
+        gamma_set = Shooting._propagate(prop, derivative_function, quadrature_function, tasks, pool, batch=batch,
+                                        eom_func_jac=derivative_function_jac, event_func=event_function)
+        return Shooting._stitch_quads(gamma_set, nquads)
 
-        if pool is not None:
-            gamma_set_new = pool.map(preload, zip(tspan, y0g, q0g))
-        else:
-            gamma_set_new = [preload([T, Y, Q]) for T, Y, Q in zip(tspan, y0g, q0g)]
+    @staticmethod
+    def _stitch_quads(gamma_set, nquads):
+        """
+        Shifts the quads of each arc in place so they continue from the end of the previous arc.
+        """
+        if len(gamma_set) > 1 and nquads > 0:
+            for ii in range(len(gamma_set)-1):
+                qdiff = gamma_set[ii].q[-1] - gamma_set[ii+1].q[0]
+                gamma_set[ii+1].q += qdiff
+
+        return gamma_set
+
+    @staticmethod
+    def _make_stms(stm_ode_func, tspan_set, y0stm_set, dyn_param, const, prop, pool, stmf_set, batch=False):
+        tasks = [(T, Y, [], dyn_param, const) for T, Y in zip(tspan_set, y0stm_set)]
+        return Shooting._propagate_endpoints(prop, stm_ode_func, None, tasks, pool, stmf_set, batch=batch)[0]
+
+    @staticmethod
+    def _place_arcs(stm_ode_func, tn, y0_set, q0, dyn_param, const, prop, pool, n_arcs):
+        r"""
+        Places arc boundaries so the STM grows by about the same amount over every arc.
+
+        The STM is propagated over a set of probe intervals that start from the guess. The growth over each integrator
+        step is measured as :math:`\log\|\Phi_{k+1}\Phi_k^{-1}\|`, plus the fraction of the time span the step
+        covers so smooth stretches still get arcs, and the boundaries equidistribute the accumulated growth.
+
+        :param stm_ode_func: The STM ODE.
+        :param tn: Boundaries of the probe intervals.
+        :param y0_set: Guess states at the start of each probe interval.
+        :param q0: Initial quads, only used for their size.
+        :param n_arcs: Number of arcs to place.
+        :return: The arc boundaries.
+        """
+        n_odes = y0_set.shape[1]
+        n_quads = len(q0)
+        n_aug = n_odes + n_quads
+        n_dynparams = len(dyn_param)
+        stm0 = np.vstack((np.hstack((np.eye(n_odes), np.zeros((n_odes, n_dynparams)))),
+                          np.zeros((n_quads, n_odes + n_dynparams)))).ravel()
+        tasks = [(tn[ii:ii + 2], np.hstack((y0_set[ii], np.zeros(n_quads), stm0)), [], dyn_param, const)
+                 for ii in range(len(tn) - 1)]
+
+        t_all = [tn[:1]]
+        growth = [np.zeros(1)]
+        for gamma in Shooting._propagate(prop, stm_ode_func, None, tasks, pool):
+            phi = np.reshape(gamma.y[:, n_aug:], (-1, n_aug, n_odes + n_dynparams))[:, :n_odes, :n_odes]
+            step_growth = np.empty(len(gamma.t) - 1)
+            for kk in range(len(gamma.t) - 1):
+                phi_step = np.linalg.solve(phi[kk].T, phi[kk + 1].T).T
+                step_growth[kk] = max(np.log(np.linalg.norm(phi_step, 2)), 0)
+
+            t_all.append(gamma.t[1:])
+            growth.append(step_growth + np.diff(gamma.t) / (tn[-1] - tn[0]))
+
+        growth = np.cumsum(np.hstack(growth))
+        tn_arcs = np.interp(np.linspace(0, growth[-1], n_arcs + 1), growth, np.hstack(t_all))
+        tn_arcs[0], tn_arcs[-1] = tn[0], tn[-1]
+        return tn_arcs
+
+    @staticmethod
+    def _batch_groups(tasks):
+        """
+        Groups tasks that share their arguments, so each group can be propagated as one ensemble.
 
-        if n_arcs > 1 and nquads > 0:
-            for ii in range(n_arcs-1):
-                qdiff = gamma_set_new[ii].q[-1] - gamma_set_new[ii+1].q[0]
-                gamma_set_new[ii+1].q += qdiff
+        :param tasks: Tuples of ``(tspan, y0, q0, *args)``.
+        :return: Indices of the tasks in each group.
+        """
+        groups = OrderedDict()
+        for ii, task in enumerate(tasks):
+            groups.setdefault(tuple(np.asarray(arg).tobytes() for arg in task[3:]), []).append(ii)
 
-        return gamma_set_new
+        return list(groups.values())
 
     @staticmethod
-    def _make_gammas_parallel(derivative_function, quadrature_function, gamma_set, dyn_param,
-                              sol, prop, pool, nquads):
-        n_arcs = len(gamma_set)
-        tspan = [None] * n_arcs
-        y0g = [None] * n_arcs
-        q0g = [None] * n_arcs
-        u0g = [None]*n_arcs
-        for ii in range(len(gamma_set)):
-            _y0g, _q0g, _u0g = gamma_set[ii](gamma_set[ii].t[0])
-            tspan[ii] = gamma_set[ii].t
-            y0g[ii] = _y0g
-            q0g[ii] = _q0g
-            u0g[ii] = _u0g
-
-        def preload(args):
-            return prop(pickle.loads(derivative_function), pickle.loads(quadrature_function), args[0], args[1], args[2], args[3],
-                        dyn_param, sol.const)
+    def _propagate(prop, eom_func, quad_func, tasks, pool, batch=False, eom_func_jac=None, event_func=None):
+        """
+        Propagates a set of arcs, over the pool if one is given.
 
+        :param tasks: Tuples of ``(tspan, y0, q0, *args)``.
+        :param batch: Without a pool, propagate the tasks sharing their arguments as one ensemble.
+        :param eom_func_jac: Jacobian of the equations of motion for implicit steppers. Not used by ensembles.
+        :param event_func: Events the propagator restarts at. Not used by ensembles.
+        :return: The propagated arcs.
+        """
+        if pool is None and batch:
+            gamma_set = [None] * len(tasks)
+            for idx in Shooting._batch_groups(tasks):
+                batch_set = prop.propagate_batch(eom_func, quad_func, [tasks[ii][0] for ii in idx],
+                                                 [tasks[ii][1] for ii in idx], [tasks[ii][2] for ii in idx],
+                                                 *tasks[idx[0]][3:])
+                for ii, gamma in zip(idx, batch_set):
+                    gamma_set[ii] = gamma
+
+            return gamma_set
+
+        _propagate_task = partial(propagate_task, prop, eom_func, quad_func, eom_func_jac=eom_func_jac,
+                                  event_func=event_func)
         if pool is not None:
-            gamma_set_new = pool.map(preload, zip(tspan, y0g, q0g, u0g))
+            arcs = pool.map(_propagate_task, tasks)
         else:
-            gamma_set_new = [preload([T, Y, Q, U]) for T, Y, Q, U in zip(tspan, y0g, q0g, u0g)]
+            arcs = map(_propagate_task, tasks)
 
-        if n_arcs > 1 and nquads > 0:
-            for ii in range(n_arcs - 1):
-                qdiff = gamma_set_new[ii].q[-1] - gamma_set_new[ii + 1].q[0]
-                gamma_set_new[ii + 1].q += qdiff
+        return [Trajectory(*arc) for arc in arcs]
+
+    @staticmethod
+    def _propagate_endpoints(prop, eom_func, quad_func, tasks, pool, yf_set, qf_set=None, batch=False,
+                             eom_func_jac=None, event_func=None):
+        """
+        Propagates a set of arcs, over the pool if one is given, and writes their terminal points in place.
+
+        :param tasks: Tuples of ``(tspan, y0, q0, *args)``.
+        :param yf_set: Buffer with one row per task for the terminal states.
+        :param qf_set: Buffer with one row per task for the terminal quads.
+        :param batch: Without a pool, propagate the tasks sharing their arguments as one ensemble.
+        :param eom_func_jac: Jacobian of the equations of motion for implicit steppers. Not used by ensembles.
+        :param event_func: Events the propagator restarts at. Not used by ensembles.
+        :return: (yf_set, qf_set)
+        """
+        if pool is None and batch:
+            for idx in Shooting._batch_groups(tasks):
+                yf, qf = prop.propagate_batch(eom_func, quad_func, [tasks[ii][0] for ii in idx],
+                                              [tasks[ii][1] for ii in idx], [tasks[ii][2] for ii in idx],
+                                              *tasks[idx[0]][3:], endpoints_only=True)
+                yf_set[idx] = yf
+                if qf_set is not None:
+                    qf_set[idx] = qf
+
+            return yf_set, qf_set
+
+        _propagate_task = partial(propagate_endpoint_task, prop, eom_func, quad_func, eom_func_jac=eom_func_jac,
+                                  event_func=event_func)
+        if pool is not None:
+            endpoints = pool.map(_propagate_task, tasks)
+        else:
+            endpoints = map(_propagate_task, tasks)
 
-        return gamma_set_new
+        for ii, (yf, qf) in enumerate(endpoints):
+            yf_set[ii] = yf
+            if qf_set is not None:
+                qf_set[ii] = qf
+
+        return yf_set, qf_set
 
     @staticmethod
-    def _bc_jac(gamma, phi_full, parameters, nondynamical_params, const, quad_func, bc_func, step_size=1e-6):
-        gamma_orig = copy.deepcopy(gamma)
-        h = step_size
-        t0 = gamma_orig.t[0]
-        y0, q0, u0 = gamma_orig(t0)
+    def _factor_jacobian(jac, is_sparse):
+        """
+        Factors the Jacobian and returns a function solving the Newton system with it.
 
-        n_odes = len(y0)
-        n_quads = len(q0)
-        num_arcs = len(gamma_orig)
-        fx = np.asarray(bc_func(gamma_orig.y[0], [], [], gamma_orig.y[-1], [], [], parameters, nondynamical_params, const))
-        n_bcs = len(fx)
+        Falls back to a least squares solution if the Jacobian cannot be factored.
+        """
+        try:
+            if is_sparse:
+                return splu(jac).solve
 
-        m = np.zeros((n_bcs, n_odes))
-        q = np.zeros((n_bcs, n_quads))
-        p1 = np.zeros((n_bcs, parameters.size))
-        p2 = np.zeros((n_bcs, nondynamical_params.size))
+            lu_piv = lu_factor(jac, check_finite=False)
+            if np.any(np.diag(lu_piv[0]) == 0):
+                raise np.linalg.LinAlgError('Singular matrix')
 
-        dx = np.zeros((n_odes + parameters.size))
-        gamma_orig = copy.deepcopy(gamma)
-        for jj in range(n_odes):
-            dx[jj] = dx[jj] + h
-            dy = np.dot(phi_full, dx)
-            p = Trajectory(gamma_orig.t, gamma_orig.y + dy)
-            f = np.asarray(bc_func(p.y[0], [], [], p.y[-1], [], [], parameters, nondynamical_params, const))
-            m[:, jj] = (f-fx)/h
-            dx[jj] = dx[jj] - h
-
-        # dq = np.zeros(n_quads)
-        # for ii in range(n_quads):
-        #     dq[ii] = dq[ii] + h
-        #     gamma_set_perturbed = [Trajectory(g.t, g.y, g.q + dq) for g in gamma_orig]
-        #     f = bc_func(gamma_set_perturbed, parameters, nondynamical_params, const)
-        #     q[:, ii] = (f-fx)/h
-        #     dq[ii] = dq[ii] - h
-
-        for ii in range(parameters.size):
-            raise NotImplementedError
-            gamma_set_perturbed = copy.deepcopy(gamma_orig)
-            parameters[ii] = parameters[ii] + h
-            jj = ii + n_odes
-            dx[jj] = dx[jj] + h
-            for kk, phi in zip(range(len(gamma_orig)), phi_full_list):
-                dy = np.dot(phi, dx)
-                perturbed_trajectory = Trajectory(gamma_orig[kk].t, gamma_orig[kk].y + dy)
-                if n_quads > 0:
-                    if kk > 0:
-                        perturbed_trajectory = reconstruct(quad_func, perturbed_trajectory,
-                                                           gamma_set_perturbed[kk-1].q[-1], parameters, const)
-                    else:
-                        perturbed_trajectory = reconstruct(quad_func, perturbed_trajectory, gamma_orig[kk].q[0],
-                                                           parameters, const)
+            return lambda b: lu_solve(lu_piv, b, check_finite=False)
 
-                gamma_set_perturbed[kk] = perturbed_trajectory
+        except (np.linalg.LinAlgError, RuntimeError, ValueError) as error:
+            logging.warning(error)
+            if is_sparse:
+                jac = jac.toarray()
 
-            f = bc_func(gamma_set_perturbed, parameters, nondynamical_params, const)
-            p1[:, ii] += (f-fx)/h
-            dx[jj] = dx[jj] - h
-            parameters[ii] = parameters[ii] - h
+            return lambda b: np.linalg.lstsq(jac, b, rcond=None)[0]
 
-        for ii in range(nondynamical_params.size):
-            nondynamical_params[ii] = nondynamical_params[ii] + h
-            f = bc_func(gamma_orig, parameters, nondynamical_params, const)
-            p2[:, ii] = (f-fx)/h
-            nondynamical_params[ii] = nondynamical_params[ii] - h
+    @staticmethod
+    def _factor_jacobian_estimate(jac):
+        """
+        Factors a dense Jacobian and estimates its condition number in the 1-norm from the LU factors, which is much
+        cheaper than the SVD behind `np.linalg.cond`.
+
+        :return: (jac_solve, cond), where jac_solve is None and cond infinite if the Jacobian is singular.
+        """
+        with warnings.catch_warnings():
+            # A singular Jacobian is found from rcond below
+            warnings.simplefilter('ignore', LinAlgWarning)
+            lu_piv = lu_factor(jac, check_finite=False)
 
-        jac = np.hstack((m, q, p1, p2))
-        return jac
+        gecon = get_lapack_funcs('gecon', (lu_piv[0],))
+        rcond, info = gecon(lu_piv[0], np.linalg.norm(jac, 1), norm='1')
+        if info != 0 or rcond == 0 or np.any(np.diag(lu_piv[0]) == 0):
+            return None, float('Inf')
+
+        return lambda b: lu_solve(lu_piv, b, check_finite=False), 1 / rcond
 
     @staticmethod
-    def _bc_func_multiple_shooting(bc_func=None):
-        def _bc_func(gamma_set, p_d, p_n, _, k, *args):
-            t0 = gamma_set[0].t[0]
-            y0, q0, u0 = gamma_set[0](t0)
-            tf = gamma_set[-1].t[-1]
-            yf, qf, uf = gamma_set[-1](tf)
-            bc1 = np.asarray(
-                [gamma_set[ii].y[-1] - gamma_set[ii + 1].y[0] for ii in range(len(gamma_set) - 1)]).flatten()
-            if len(q0) > 0:
-                bc2 = np.asarray(bc_func(y0, q0, yf, qf, p_d, p_n, k)).flatten()
-            else:
-                bc2 = np.asarray(bc_func(y0, yf, p_d, p_n, k)).flatten()
-            bc = np.hstack((bc1, bc2))
-            return bc
+    def _condition_estimate(jac, is_sparse):
+        """
+        Estimates the condition number of the Jacobian in the 1-norm for log messages. A sparse Jacobian is estimated
+        from its sparse LU factors, so it is never made dense.
 
-        return _bc_func
+        :return: The estimate, infinite if the Jacobian is singular.
+        """
+        try:
+            if not is_sparse:
+                return Shooting._factor_jacobian_estimate(jac)[1]
 
-    def make_stmode(self, odefn, n_odes, step_size=1e-6):
-        xh = np.eye(n_odes)*step_size
+            jac = csc_matrix(jac)
+            lu = splu(jac)
+            jac_inv = LinearOperator(jac.shape, matvec=lu.solve, rmatvec=lambda b: lu.solve(b, trans='T'),
+                                     dtype=jac.dtype)
+            return onenormest(jac) * onenormest(jac_inv)
 
-        def _stmode_fd(_xx, u, p, const):
-            """ Finite difference version of state transition matrix """
-            n_params = p.size
-            phi = _xx[n_odes:].reshape((n_odes, n_odes + n_params))
-            xx = _xx[0:n_odes]  # Just states
+        except (np.linalg.LinAlgError, RuntimeError, ValueError):
+            return float('Inf')
 
-            fx = np.squeeze([odefn(xx, u, p, const)])
+    @staticmethod
+    def _dogleg_step(step_newton, step_cauchy, radius):
+        """
+        Returns Powell's dogleg step, the point where the path from the Cauchy step to the Newton step leaves the trust
+        region.
 
-            if self.derivative_function_jac is not None:
-                _df_dy, _df_dp = self.derivative_function_jac(xx, [], p, const)
-                if n_odes > 1 and len(_df_dp.shape) == 1:
-                    _df_dp = np.array([_df_dp]).T
+        :param step_newton: Newton step.
+        :param step_cauchy: Minimizer of the linear model along the steepest descent direction.
+        :param radius: Trust region radius.
+        :return: The step.
+        """
+        if np.linalg.norm(step_newton) <= radius:
+            return step_newton
 
-                Z = np.zeros((n_odes, n_params - _df_dp.shape[1]))
-                ff = np.hstack((_df_dy, _df_dp, Z))
-            else:
-                ff = np.empty((n_odes, n_odes+n_params))
+        norm_cauchy = np.linalg.norm(step_cauchy)
+        if norm_cauchy >= radius:
+            return step_cauchy * radius / norm_cauchy
 
+        d_step = step_newton - step_cauchy
+        a = np.dot(d_step, d_step)
+        b = 2 * np.dot(step_cauchy, d_step)
+        c = np.dot(step_cauchy, step_cauchy) - radius ** 2
+        tau = (-b + np.sqrt(b ** 2 - 4 * a * c)) / (2 * a)
+        return step_cauchy + tau * d_step
 
-                for i in range(n_odes):
-                    fxh = odefn(xx + xh[i, :], u, p, const)
-                    ff[:, i] = (fxh-fx) / step_size
+    @staticmethod
+    def _factor_jacobian_condensed(jac, n_odes, n_arcs):
+        r"""
+        Condenses the multiple-shooting Jacobian onto the first arc and the parameters, factors the reduced system and
+        returns a function solving the Newton system with it.
+
+        Continuity rows read :math:`\Phi_i \Delta Y_i + R_i \Delta z - \Delta Y_{i+1} = c_i` where :math:`z` holds the
+        quads and parameters, so every :math:`\Delta Y_i = A_i \Delta Y_1 + B_i \Delta z + d_i`. Substituting into the
+        boundary condition rows leaves a system in :math:`(\Delta Y_1, \Delta z)` only.
+        """
+        if not isinstance(jac, np.ndarray):
+            jac = csr_matrix(jac)
+
+        def block(r0, r1, c0, c1):
+            if isinstance(jac, np.ndarray):
+                return jac[r0:r1, c0:c1]
+            return jac[r0:r1, c0:c1].toarray()
+
+        n_cont = n_odes * (n_arcs - 1)
+        n_y = n_odes * n_arcs
+        n_rows, n_cols = jac.shape
+        n_rest = n_cols - n_y
+
+        phi_set = [block(n_odes * ii, n_odes * (ii + 1), n_odes * ii, n_odes * (ii + 1)) for ii in range(n_arcs - 1)]
+        r_set = [block(n_odes * ii, n_odes * (ii + 1), n_y, n_cols) for ii in range(n_arcs - 1)]
+        m_set = [block(n_cont, n_rows, n_odes * ii, n_odes * (ii + 1)) for ii in range(n_arcs)]
+
+        a_i = np.eye(n_odes)
+        b_i = np.zeros((n_odes, n_rest))
+        k_y = np.dot(m_set[0], a_i)
+        k_z = block(n_cont, n_rows, n_y, n_cols)
+        for ii in range(n_arcs - 1):
+            b_i = np.dot(phi_set[ii], b_i) + r_set[ii]
+            a_i = np.dot(phi_set[ii], a_i)
+            k_y = k_y + np.dot(m_set[ii + 1], a_i)
+            k_z = k_z + np.dot(m_set[ii + 1], b_i)
+
+        reduced_solve = Shooting._factor_jacobian(np.hstack((k_y, k_z)), False)
+
+        def _solve(b):
+            # Particular solution of the continuity rows with the first arc and parameters held fixed
+            d_set = [np.zeros(n_odes)]
+            b_bc = b[n_cont:].copy()
+            for ii in range(n_arcs - 1):
+                d_set.append(np.dot(phi_set[ii], d_set[ii]) - b[n_odes * ii:n_odes * (ii + 1)])
+                b_bc -= np.dot(m_set[ii + 1], d_set[ii + 1])
 
-                for i in range(n_params):
-                    p[i] += step_size
-                    fxh = odefn(xx, u, p, const)
-                    ff[:, i+n_odes] = (fxh - fx) / step_size
-                    p[i] -= step_size
+            dx = np.empty(n_cols)
+            dx_reduced = reduced_solve(b_bc)
+            dx[:n_odes] = dx_reduced[:n_odes]
+            dx[n_y:] = dx_reduced[n_odes:]
 
+            # Forward substitution through the continuity conditions
+            for ii in range(n_arcs - 1):
+                dx[n_odes * (ii + 1):n_odes * (ii + 2)] = \
+                    np.dot(phi_set[ii], dx[n_odes * ii:n_odes * (ii + 1)]) \
+                    + np.dot(r_set[ii], dx[n_y:]) - b[n_odes * ii:n_odes * (ii + 1)]
 
+            return dx
 
-            phi_dot = np.dot(np.vstack((ff, np.zeros((n_params, n_params + n_odes)))),
-                             np.vstack((phi, np.hstack((np.zeros((n_params, n_odes)), np.eye(n_params))))))[:n_odes, :]
-            return np.hstack((fx, np.reshape(phi_dot, (n_odes * (n_odes + n_params)))))
+        return _solve
 
-        return _stmode_fd
+    @staticmethod
+    def _bc_func_multiple_shooting(bc_func=None, use_quads=False):
+        """
+        Makes the multiple-shooting residual, the continuity defects between neighboring arcs followed by the boundary
+        conditions. It is compiled with numba when the boundary condition function can be called from compiled code,
+        and then also accepts arguments of other dtypes.
+
+        :param bc_func: Boundary condition function.
+        :param use_quads: Whether the boundary condition function takes quads.
+        :return: The residual, called as ``bc_func_ms(y0_set, yf_set, q0, qf, p_d, p_n, k)`` with the start and end
+            states of each arc stacked by row.
+        """
+        def _make_bc_func(residual):
+            if use_quads:
+                def _bc_func(y0_set, yf_set, q0, qf, p_d, p_n, k):
+                    bc = np.asarray(bc_func(y0_set[0], q0, yf_set[-1], qf, p_d, p_n, k))
+                    return residual(y0_set, yf_set, bc)
+            else:
+                def _bc_func(y0_set, yf_set, q0, qf, p_d, p_n, k):
+                    bc = np.asarray(bc_func(y0_set[0], yf_set[-1], p_d, p_n, k))
+                    return residual(y0_set, yf_set, bc)
+
+            return _bc_func
+
+        def _residual(y0_set, yf_set, bc):
+            return np.hstack(((yf_set[:-1] - y0_set[1:]).ravel(), bc.ravel()))
+
+        try:
+            # Compiled for float64 up front so that a boundary condition function numba cannot call is found here.
+            # The types of other calls are left to numba to infer.
+            bc_func_ms = njit(_make_bc_func(_multiple_shooting_residual))
+            bc_func_ms.compile((float64[:, :], float64[:, :]) + (float64[:],) * 5)
+            return bc_func_ms
+        except (errors.NumbaError, TypeError):
+            logging.debug('Cannot compile the multiple-shooting residual, using it uncompiled')
+            return _make_bc_func(_residual)
+
+    def make_stmode(self, odefn, quadfn, n_odes, n_quads, step_size=1e-6):
+        r"""
+        Makes the state-transition matrix ODE for a system with (optional) quads. See `ivp_solvers.make_stm_ode`.
+
+        :param odefn: Equations of motion, called as ``odefn(y, p, const)``.
+        :param quadfn: Quadrature equations, called as ``quadfn(y, p, const)``.
+        :param n_odes: Number of states.
+        :param n_quads: Number of quads.
+        :param step_size: Step size used when the Jacobian of the EOMs is estimated by finite differences.
+        :return: The augmented ODE, called as ``stm_ode(xx, p, const)``.
+        """
+        return make_stm_ode(odefn, quadfn, self.derivative_function_jac, n_odes, n_quads, step_size)
 
     def solve(self, solinit, **kwargs):
         """
@@ -445,15 +646,12 @@ class Shooting(BaseAlgorithm):
         sol.q = np.array(sol.q, dtype=beluga.DTYPE)
         sol.dynamical_parameters = np.array(sol.dynamical_parameters, dtype=beluga.DTYPE)
         sol.nondynamical_parameters = np.array(sol.nondynamical_parameters, dtype=beluga.DTYPE)
+        sol.const = np.array(sol.const, dtype=beluga.DTYPE)
 
         # n = sol.y[0].shape[0]
-        k = sol.dynamical_parameters.shape[0]
         # sol.dynamical_parameters = np.hstack((sol.dynamical_parameters, sol.nondynamical_parameters))
         # sol.nondynamical_parameters = np.empty((0,))
 
-        fun_wrapped, bc_wrapped, fun_jac_wrapped, bc_jac_wrapped = wrap_functions(
-            self.derivative_function, self.boundarycondition_function, None, None, sol.const, k, dtype)
-
         pool = kwargs.get('pool', None)
 
         # Extract some info from the guess structure
@@ -474,195 +672,291 @@ class Shooting(BaseAlgorithm):
 
         # Make the state-transition ode matrix
         if self.stm_ode_func is None:
-            self.stm_ode_func = self.make_stmode(self.derivative_function, y0g.shape[0])
+            self.stm_ode_func = self.make_stmode(self.derivative_function, self.quadrature_function, n_odes, n_quads)
 
         # Set up the boundary condition function
-        if self.bc_func_ms is None:
-            self.bc_func_ms = self._bc_func_multiple_shooting(bc_func=self.boundarycondition_function)
-
-        # Build each of the separate arcs for multiple shooting. Uses sol's interpolation style
-        gamma_set = []
-        t0 = sol.t[0]
-        tf = sol.t[-1]
-        tn = np.linspace(t0, tf, self.num_arcs+1)
-        for trajectory_number in range(self.num_arcs):
-            y0t, q0t, u0t = sol(tn[trajectory_number])
-            yft, qft, uft = sol(tn[trajectory_number+1])
-            t_set = np.hstack((tn[trajectory_number], tn[trajectory_number+1]))
-            y_set = np.vstack((y0t, yft))
-            q_set = np.vstack((q0t, qft))
-            u_set = np.vstack((u0t, uft))
-            gamma_set.append(Trajectory(t_set, y_set, q_set, u_set))
-
-        # Initial state of STM is an identity matrix with an additional column of zeros per parameter
-        # stm0 = np.hstack((np.eye(n_odes), np.zeros((n_odes, n_dynparams)))).reshape(n_odes*(n_odes + n_dynparams))
-        # y0stm = np.zeros((len(stm0) + n_odes))
+        if self.bc_func_ms is None or self._bc_func_ms_quads != (n_quads > 0):
+            self.bc_func_ms = self._bc_func_multiple_shooting(bc_func=self.boundarycondition_function,
+                                                              use_quads=n_quads > 0)
+            self._bc_func_ms_quads = n_quads > 0
 
         prop = Propagator(**self.ivp_args)
 
+        # Finite differences always use the requested tolerances, even when the residual is integrated loosely
+        base_abstol, base_reltol = prop.abstol, prop.reltol
+        prop_fd = copy.copy(prop)
+        # Perturbed arcs keep their own step sizes and sparsity patterns, so they do not replace the nominal ones
+        prop_fd._step_history = OrderedDict()
+        prop_fd._sparsity = dict()
+
         converged = False  # Convergence flag
         n_iter = 0  # Initialize iteration counter
         err = -1
 
-        # Set up the initial guess vector
-        x_init = self._wrap_y0(gamma_set, parameter_guess, nondynamical_parameter_guess)
-
-        def quad_wrap(t, xx, p, const):
-            return self.quadrature_function(t, xx[:n_odes], p, const)
-
-        # Pickle the functions for faster execution
+        # Functions resident in the workers are sent by name, others are pickled. The STM ODE is built by each worker.
         if pool is not None:
-            pick_deriv = pickle.dumps(self.derivative_function)
-            pick_quad = pickle.dumps(self.quadrature_function)
-            pick_stm = pickle.dumps(self.stm_ode_func)
-            pick_quad_stm = pickle.dumps(quad_wrap)
-            _gamma_maker = self._make_gammas_parallel
+            pick_deriv = ship_function(pool, self.derivative_function)
+            pick_deriv_jac = ship_function(pool, self.derivative_function_jac)
+            pick_events = ship_function(pool, self.event_function)
+            pick_quad = ship_function(pool, self.quadrature_function)
+            pick_stm = (make_stm_ode, pick_deriv, pick_quad, ship_function(pool, self.derivative_function_jac),
+                        n_odes, n_quads)
         else:
             pick_deriv = self.derivative_function
+            pick_deriv_jac = self.derivative_function_jac
+            pick_events = self.event_function
             pick_quad = self.quadrature_function
             pick_stm = self.stm_ode_func
-            pick_quad_stm = quad_wrap
-            _gamma_maker = self._make_gammas
+
+        # Time spans and initial states of each of the separate arcs for multiple shooting. Uses sol's interpolation
+        # style
+        n_arcs = self.num_arcs
+        if self.arc_placement.lower() == 'uniform':
+            tn = np.linspace(sol.t[0], sol.t[-1], n_arcs+1)
+        elif self.arc_placement.lower() == 'adaptive':
+            if self.repartition_arcs or self._arc_fractions is None or len(self._arc_fractions) != n_arcs + 1:
+                tn_probe = np.linspace(sol.t[0], sol.t[-1], 4*n_arcs+1)
+                y0_probe = np.array([sol(t)[0] for t in tn_probe[:-1]], dtype=dtype)
+                tn = self._place_arcs(pick_stm, tn_probe, y0_probe, q0g, parameter_guess, sol.const, prop, pool,
+                                      n_arcs)
+                self._arc_fractions = (tn - tn[0]) / (tn[-1] - tn[0])
+                logger.debug('Arc boundaries placed at ' + str(tn))
+            else:
+                tn = sol.t[0] + self._arc_fractions * (sol.t[-1] - sol.t[0])
+        else:
+            raise NotImplementedError('Arc placement \'' + self.arc_placement + '\' is not implemented.')
+
+        tspan_set = np.column_stack((tn[:-1], tn[1:]))
+        y0_set = np.array([sol(t)[0] for t in tn[:-1]], dtype=dtype)
+
+        # Set up the initial guess vector
+        x_init = np.hstack((y0_set.ravel(), q0g, parameter_guess, nondynamical_parameter_guess))
+
+        if self.linear_solver.lower() == 'gmres':
+            if pool is not None:
+                pick_directional = (make_directional_ode, pick_deriv, pick_quad,
+                                    ship_function(pool, self.derivative_function_jac), n_odes, n_quads, n_dynparams)
+            else:
+                pick_directional = make_directional_ode(self.derivative_function, self.quadrature_function,
+                                                        self.derivative_function_jac, n_odes, n_quads, n_dynparams)
+
+        # Buffers for the terminal points of each arc, reused by every evaluation. Arcs start their quads from zero so
+        # the terminal quads are the contribution of each arc.
+        n_aug = n_odes + n_quads
+        q_zero = np.zeros(n_quads)
+        yf_set = np.empty((n_arcs, n_odes), dtype=dtype)
+        dqf_set = np.empty((n_arcs, n_quads), dtype=dtype)
+        stmf_set = np.empty((n_arcs, n_aug + n_aug * (n_odes + n_dynparams)), dtype=dtype)
+        n_fd_arcs = n_arcs * (1 + n_odes + n_dynparams)
+        yf_fd_set = np.empty((n_fd_arcs, n_odes), dtype=dtype)
+        dqf_fd_set = np.empty((n_fd_arcs, n_quads), dtype=dtype)
+        directionalf_set = np.empty((n_arcs, 2 * n_aug + n_dynparams), dtype=dtype)
+
+        # Least recently used residuals
+        residual_cache = OrderedDict()
+
+        def _cache_key(xx):
+            return np.asarray(xx).tobytes(), prop.abstol, prop.reltol
 
         # Set up the constraint function
         def _constraint_function(xx, deriv_func, quad_func, n_odes, n_quads, n_dynparams, n_arcs, const):
-            g = copy.deepcopy(gamma_set)
+            key = _cache_key(xx)
+            if key in residual_cache:
+                residual_cache.move_to_end(key)
+                return residual_cache[key].copy()
+
             _y, _q, _params, _nonparams = self._unwrap_y0(xx, n_odes, n_quads, n_dynparams, n_arcs)
-            for ii in range(n_arcs):
-                g[ii].y[0] = _y[ii]
-                if n_quads > 0:
-                    g[ii].q[0] = _q
-            g = _gamma_maker(deriv_func, quad_func, g, _params, sol, prop, pool, n_quads)
-            return self.bc_func_ms(g, _params, _nonparams, k, const)
+            tasks = [(tspan_set[ii], _y[ii], q_zero, _params, const) for ii in range(n_arcs)]
+            self._propagate_endpoints(prop, deriv_func, quad_func, tasks, pool, yf_set, dqf_set,
+                                      batch=self.batch_propagation, eom_func_jac=pick_deriv_jac,
+                                      event_func=pick_events)
+
+            residual = np.asarray(self.bc_func_ms(_y, yf_set, _q, _q + np.sum(dqf_set, axis=0), _params, _nonparams,
+                                                  const))
+            if self.cache_size > 0:
+                residual_cache[key] = residual.copy()
+                if len(residual_cache) > self.cache_size:
+                    residual_cache.popitem(last=False)
+
+            return residual
 
         def _constraint_function_wrapper(X):
-            return _constraint_function(X, pick_deriv, pick_quad, n_odes, n_quads, n_dynparams, self.num_arcs,
-                                        sol.const)
+            return _constraint_function(X, pick_deriv, pick_quad, n_odes, n_quads, n_dynparams, n_arcs, sol.const)
 
         # Set up the jacobian of the constraint function
-        def _jacobian_function(xx, deriv_func, quad_func, n_odes, n_quads, n_dynparams, n_arcs):
-            g = copy.deepcopy(gamma_set)
+        def _jacobian_function(xx, stm_func, n_odes, n_quads, n_dynparams, n_arcs, const):
             _y, _q, _params, _nonparams = self._unwrap_y0(xx, n_odes, n_quads, n_dynparams, n_arcs)
             n_nondyn = _nonparams.shape[0]
-            for ii in range(n_arcs):
-                g[ii].y[0] = _y[ii]
-                if n_quads > 0:
-                    g[ii].q[0] = _q
 
-            phi_full_list = []
-            for ii in range(n_arcs):
-                t0 = g[ii].t[0]
-                _y0g, _q0g, _u0g = g[ii](t0)
-                tf = g[ii].t[-1]
-                _yfg, _qfg, _ufg = g[ii](tf)
-                stm0 = np.hstack((np.eye(n_odes), np.zeros((n_odes, n_dynparams)))).reshape(
-                    n_odes * (n_odes + n_dynparams))
-                y0stm = np.zeros((len(stm0) + n_odes))
-                stmf = np.hstack((np.eye(n_odes), np.zeros((n_odes, n_dynparams)))).reshape(
-                    n_odes * (n_odes + n_dynparams))
-                yfstm = np.zeros((len(stmf) + n_odes))
-                y0stm[:n_odes] = _y0g
-                y0stm[n_odes:] = stm0[:]
-                yfstm[:n_odes] = _yfg
-                yfstm[n_odes:] = stmf[:]
-                g[ii].t = np.hstack((t0, tf))
-                g[ii].y = np.vstack((y0stm, yfstm))
-                g[ii].q = np.vstack((_q0g, _qfg))
-                g[ii].u = np.vstack((_u0g, _ufg))
-
-            gamma_set_new = _gamma_maker(deriv_func, quad_func, g, _params[:n_dynparams], sol, prop, pool, n_quads)
-            for ii in range(len(gamma_set_new)):
-                t_set = gamma_set_new[ii].t
-                temp = gamma_set_new[ii].y
-                y_set = temp[:, :n_odes]
-                q_set = gamma_set_new[ii].q
-                u_set = gamma_set_new[ii].u
-                gamma_set_new[ii] = Trajectory(t_set, y_set, q_set, u_set)
-                phi_temp = np.reshape(temp[:, n_odes:], (len(gamma_set_new[ii].t), n_odes, n_odes + n_dynparams))
-                phi_full_list.append(np.copy(phi_temp))
-
-            dbc_dya, dbc_dyb, dbc_dp = estimate_bc_jac(bc_wrapped, gamma_set_new[0].y[0], [], gamma_set_new[-1].y[-1],
-                                                       [], _params, _nonparams)
-
-            if dbc_dp is None:
-                dbc_dp = np.empty((dbc_dya.shape[0],0))
-
-            values = np.empty((0,))
-            i_jac = np.empty((0,), dtype=int)
-            j_jac = np.empty((0,), dtype=int)
-
-            if n_arcs == 1:
-                jac = np.hstack((dbc_dya, dbc_dp))
-                _phi = np.vstack((phi_full_list[-1][-1], np.zeros((n_dynparams, n_odes + n_dynparams))))
-                jac += np.dot(np.hstack((dbc_dyb, dbc_dp)), _phi)
-
-                i_bc = np.repeat(np.arange(0, n_odes + n_dynparams), n_odes + n_dynparams)
-                j_bc = np.tile(np.arange(n_odes + n_dynparams), n_odes + n_dynparams)
-                values = np.hstack((values, jac.ravel()))
-                i_jac = np.hstack((i_jac, i_bc))
-                j_jac = np.hstack((j_jac, j_bc))
+            # Initial state of STM is an identity matrix with an additional column of zeros per parameter. The quad rows
+            # are zero since quad sensitivities start from nothing on every arc.
+            stm0 = np.vstack((np.hstack((np.eye(n_odes), np.zeros((n_odes, n_dynparams)))),
+                              np.zeros((n_quads, n_odes + n_dynparams)))).ravel()
+            y0stm_set = [np.hstack((_y[ii], q_zero, stm0)) for ii in range(n_arcs)]
+            self._make_stms(stm_func, tspan_set, y0stm_set, _params, const, prop, pool, stmf_set,
+                            batch=self.batch_propagation)
+
+            phi_list = [np.reshape(stmf[n_aug:], (n_aug, n_odes + n_dynparams)) for stmf in stmf_set]
+            qf = _q + np.sum(stmf_set[:, n_odes:n_aug], axis=0)
+
+            if n_quads > 0:
+                def _bc(ya, qa, yb, qb, p, ndp):
+                    return self.boundarycondition_function(ya, qa, yb, qb, p, ndp, const)
             else:
-                p_jac = np.empty((0,n_dynparams))
-                for ii in range(n_arcs-1):
-                    jac = np.dot(np.eye(n_odes), phi_full_list[ii][-1])
-                    i_bc = np.repeat(np.arange(n_odes*ii, n_odes*(ii+1)), n_odes)
-                    j_bc = np.tile(np.arange(0, n_odes), n_odes) + n_odes * ii
-                    values = np.hstack((values, jac[:,:n_odes].ravel()))
-                    i_jac = np.hstack((i_jac, i_bc))
-                    j_jac = np.hstack((j_jac, j_bc))
-
-                    if n_dynparams > 0:
-                        p_jac = np.vstack((p_jac, jac[:, n_odes:]))
-
-                    jac = -np.eye(n_odes)
-                    i_bc = np.repeat(np.arange(n_odes * ii, n_odes * (ii + 1)), n_odes)
-                    j_bc = np.tile(np.arange(0, n_odes), n_odes) + n_odes * (ii + 1)
-                    values = np.hstack((values, jac.ravel()))
-                    i_jac = np.hstack((i_jac, i_bc))
-                    j_jac = np.hstack((j_jac, j_bc))
-
-                if n_dynparams > 0:
-                    values = np.hstack((values, p_jac.ravel()))
-                    i_p = np.repeat(np.arange(0, n_odes*(n_arcs-1)), n_dynparams)
-                    j_p = np.tile(np.arange(0, n_dynparams), n_odes*(n_arcs-1)) + n_odes * n_arcs
-                    i_jac = np.hstack((i_jac, i_p))
-                    j_jac = np.hstack((j_jac, j_p))
-
-                jac = dbc_dya
-                i_bc = np.repeat(np.arange(0, n_odes + n_dynparams), n_odes) + n_odes*(n_arcs - 1)
-                j_bc = np.tile(np.arange(n_odes), n_odes + n_dynparams)
-                values = np.hstack((values, jac.ravel()))
-                i_jac = np.hstack((i_jac, i_bc))
-                j_jac = np.hstack((j_jac, j_bc))
-
-                _phi = np.vstack((phi_full_list[-1][-1], np.zeros((n_dynparams, n_odes + n_dynparams))))
-                jac = np.dot(np.hstack((dbc_dyb, dbc_dp)), _phi)
-                jac[:, n_odes:] += dbc_dp
-                i_bc = np.repeat(np.arange(0, n_odes + n_dynparams), n_odes + n_dynparams) + n_odes * (n_arcs - 1)
-                j_bc = np.tile(np.arange(n_odes + n_dynparams), n_odes + n_dynparams) + n_odes * (n_arcs - 1)
-                values = np.hstack((values, jac.ravel()))
-                i_jac = np.hstack((i_jac, i_bc))
-                j_jac = np.hstack((j_jac, j_bc))
-
-            J = csc_matrix(coo_matrix((values, (i_jac, j_jac))))
+                def _bc(ya, _, yb, __, p, ndp):
+                    return self.boundarycondition_function(ya, yb, p, ndp, const)
+
+            dbc_dya, dbc_dqa, dbc_dyb, dbc_dqb, dbc_dp, dbc_dndp = \
+                estimate_bc_jac(_bc, _y[0], _q, stmf_set[-1, :n_odes], qf, _params, _nonparams)
+
+            n_bcs = dbc_dya.shape[0]
+            n_cont = n_odes * (n_arcs - 1)
+            col_q = n_odes * n_arcs
+            col_p = col_q + n_quads
+            col_ndp = col_p + n_dynparams
+
+            i_jac, j_jac, values = [], [], []
+
+            def add_block(row0, col0, block):
+                i_block, j_block = np.indices(block.shape)
+                i_jac.append(i_block.ravel() + row0)
+                j_jac.append(j_block.ravel() + col0)
+                values.append(block.ravel())
+
+            # Continuity conditions between neighboring arcs
+            for ii in range(n_arcs - 1):
+                phi_y = phi_list[ii][:n_odes]
+                add_block(n_odes * ii, n_odes * ii, phi_y[:, :n_odes])
+                add_block(n_odes * ii, n_odes * (ii + 1), -np.eye(n_odes))
+                add_block(n_odes * ii, col_p, phi_y[:, n_odes:])
+
+            # Boundary conditions. The terminal quads are the sum of every arc's contribution.
+            phi_yf = phi_list[-1][:n_odes]
+            add_block(n_cont, 0, dbc_dya)
+            add_block(n_cont, n_odes * (n_arcs - 1), np.dot(dbc_dyb, phi_yf[:, :n_odes]))
+            add_block(n_cont, col_p, dbc_dp + np.dot(dbc_dyb, phi_yf[:, n_odes:]))
+            add_block(n_cont, col_ndp, dbc_dndp)
+
+            if n_quads > 0:
+                add_block(n_cont, col_q, dbc_dqa + dbc_dqb)
+                for ii in range(n_arcs):
+                    phi_q = phi_list[ii][n_odes:]
+                    add_block(n_cont, n_odes * ii, np.dot(dbc_dqb, phi_q[:, :n_odes]))
+                    add_block(n_cont, col_p, np.dot(dbc_dqb, phi_q[:, n_odes:]))
+
+            shape = (n_cont + n_bcs, col_ndp + n_nondyn)
+            J = csc_matrix(coo_matrix((np.hstack(values), (np.hstack(i_jac), np.hstack(j_jac))), shape=shape))
             return J
 
-        def _jacobian_function_wrapper(X):
-            return approx_jacobian(X, _constraint_function_wrapper, 1e-6)
+        def _jacobian_function_fd(xx, deriv_func, quad_func, n_odes, n_quads, n_dynparams, n_arcs, const,
+                                  step_size=1e-6):
+            _y, _q, _params, _nonparams = self._unwrap_y0(xx, n_odes, n_quads, n_dynparams, n_arcs)
+            h = step_size
 
-        is_sparse = False
+            # Perturbing the start of an arc only changes that arc, while a dynamical parameter changes all of them.
+            # Quads and nondynamical parameters need no propagation at all. Every arc that has to be propagated for
+            # the finite differences is sent off in a single batch.
+            tasks = [(tspan_set[ii], _y[ii], q_zero, _params, const) for ii in range(n_arcs)]
+            for ii in range(n_arcs):
+                for jj in range(n_odes):
+                    y0 = _y[ii].copy()
+                    y0[jj] += h
+                    tasks.append((tspan_set[ii], y0, q_zero, _params, const))
+
+            for jj in range(n_dynparams):
+                params = _params.copy()
+                params[jj] += h
+                for ii in range(n_arcs):
+                    tasks.append((tspan_set[ii], _y[ii], q_zero, params, const))
+
+            self._propagate_endpoints(prop_fd, deriv_func, quad_func, tasks, pool, yf_fd_set, dqf_fd_set,
+                                      batch=self.batch_propagation, eom_func_jac=pick_deriv_jac,
+                                      event_func=pick_events)
+
+            def _residual(y0, yf, q0, dqf, params, nonparams):
+                return self.bc_func_ms(y0, yf, q0, q0 + np.sum(dqf, axis=0), params, nonparams, const)
+
+            yf0 = yf_fd_set[:n_arcs]
+            dqf0 = dqf_fd_set[:n_arcs]
+            f0 = _residual(_y, yf0, _q, dqf0, _params, _nonparams)
+            jac = np.empty((f0.size, xx.size))
+
+            col = 0
+            row = n_arcs
+            for ii in range(n_arcs):
+                for jj in range(n_odes):
+                    y0, yf, dqf = _y.copy(), yf0.copy(), dqf0.copy()
+                    y0[ii, jj] += h
+                    yf[ii] = yf_fd_set[row]
+                    dqf[ii] = dqf_fd_set[row]
+                    jac[:, col] = (_residual(y0, yf, _q, dqf, _params, _nonparams) - f0)/h
+                    col += 1
+                    row += 1
+
+            for jj in range(n_quads):
+                q0 = _q.copy()
+                q0[jj] += h
+                jac[:, col] = (_residual(_y, yf0, q0, dqf0, _params, _nonparams) - f0)/h
+                col += 1
+
+            for jj in range(n_dynparams):
+                params = _params.copy()
+                params[jj] += h
+                yf = yf_fd_set[row:row + n_arcs]
+                dqf = dqf_fd_set[row:row + n_arcs]
+                jac[:, col] = (_residual(_y, yf, _q, dqf, params, _nonparams) - f0)/h
+                col += 1
+                row += n_arcs
+
+            for jj in range(_nonparams.size):
+                nonparams = _nonparams.copy()
+                nonparams[jj] += h
+                jac[:, col] = (_residual(_y, yf0, _q, dqf0, _params, nonparams) - f0)/h
+                col += 1
+
+            return jac
+
+        def _jacobian_vector_product(xx, dx, directional_func, n_odes, n_quads, n_dynparams, n_arcs, const,
+                                     step_size=1e-6):
+            _y, _q, _params, _nonparams = self._unwrap_y0(xx, n_odes, n_quads, n_dynparams, n_arcs)
+            _dy, _dq, _dparams, _dnonparams = self._unwrap_y0(dx, n_odes, n_quads, n_dynparams, n_arcs)
+
+            # Every arc is propagated along with its derivative in the direction of dx
+            tasks = [(tspan_set[ii], np.hstack((_y[ii], q_zero, _dy[ii], q_zero, _dparams)), [], _params, const)
+                     for ii in range(n_arcs)]
+            self._propagate_endpoints(prop_fd, directional_func, None, tasks, pool, directionalf_set,
+                                      batch=self.batch_propagation)
+            yf = directionalf_set[:, :n_odes]
+            dqf = directionalf_set[:, n_odes:n_aug]
+            vf = directionalf_set[:, n_aug:n_aug + n_odes]
+            wf = directionalf_set[:, n_aug + n_odes:2 * n_aug]
+
+            # The continuity conditions are linear, so differencing the residual only approximates the boundary
+            # conditions
+            h = step_size / max(np.linalg.norm(dx), EPS)
+            f0 = self.bc_func_ms(_y, yf, _q, _q + np.sum(dqf, axis=0), _params, _nonparams, const)
+            q0 = _q + h * _dq
+            fh = self.bc_func_ms(_y + h * _dy, yf + h * vf, q0, q0 + np.sum(dqf + h * wf, axis=0),
+                                 _params + h * _dparams, _nonparams + h * _dnonparams, const)
+            return (fh - f0) / h
+
+        if self.jacobian_method.lower() == 'stm':
+            is_sparse = self.algorithm.lower() in {'armijo', 'trustregion'}
+
+            def _jacobian_function_wrapper(X):
+                J = _jacobian_function(X, pick_stm, n_odes, n_quads, n_dynparams, n_arcs, sol.const)
+                if is_sparse:
+                    return J
+                return J.toarray()
 
-        # is_sparse = False
-        # if n_quads == 0 and self.algorithm.lower() == 'armijo':
-        #     is_sparse = True
-        #     def _jacobian_function_wrapper(X):
-        #         return _jacobian_function(X, pick_stm, pick_quad_stm, n_odes, n_quads, n_dynparams, self.num_arcs)
-        # elif n_quads == 0:
-        #     def _jacobian_function_wrapper(X):
-        #         return _jacobian_function(X, pick_stm, pick_quad_stm, n_odes, n_quads, n_dynparams, self.num_arcs).toarray()
-        # else:
-        #     def _jacobian_function_wrapper(X):
-        #         return approx_jacobian(X, _constraint_function_wrapper, 1e-6)
+        elif self.jacobian_method.lower() == 'fd':
+            is_sparse = False
+
+            def _jacobian_function_wrapper(X):
+                return _jacobian_function_fd(X, pick_deriv, pick_quad, n_odes, n_quads, n_dynparams, n_arcs, sol.const)
+
+        else:
+            raise NotImplementedError('Jacobian method \'' + self.jacobian_method + '\' is not implemented.')
 
         constraint = {'type': 'eq', 'fun': _constraint_function_wrapper, 'jac': _jacobian_function_wrapper}
 
@@ -702,6 +996,35 @@ class Shooting(BaseAlgorithm):
 
         elif self.algorithm.lower() == 'armijo':
 
+            use_broyden = self.jacobian_update.lower() == 'broyden'
+            use_condensed = self.linear_solver.lower() == 'condensed' and not use_broyden
+            use_gmres = self.linear_solver.lower() == 'gmres' and not use_broyden
+            if self.linear_solver.lower() not in {'lu', 'condensed', 'gmres'}:
+                raise NotImplementedError('Linear solver \'' + self.linear_solver + '\' is not implemented.')
+            if use_broyden:
+                # Rank-one updates fill in the sparsity pattern, so Broyden's method works on the dense Jacobian
+                is_sparse = False
+
+            jac = None
+            jac_solve = None
+            jac_is_fresh = False
+
+            # Seed the Jacobian and its factors with the last converged solve, typically the previous continuation case
+            if self.reuse_jacobian and self._saved_jacobian is not None \
+                    and self._saved_jacobian[0].shape == (x_init.size, x_init.size) \
+                    and self._saved_jacobian[2] == is_sparse:
+                jac, jac_solve, _ = self._saved_jacobian
+                logger.debug('Reusing Jacobian from the previous solve')
+
+            def _set_ivp_tolerance(residual_norm):
+                prop.abstol = min(max(self.ivp_tolerance_factor * residual_norm, base_abstol),
+                                  max(self.max_ivp_tolerance, base_abstol))
+                prop.reltol = min(max(self.ivp_tolerance_factor * residual_norm, base_reltol),
+                                  max(self.max_ivp_tolerance, base_reltol))
+
+            if self.inexact_newton:
+                _set_ivp_tolerance(float('Inf'))
+
             while not converged and n_iter <= self.max_iterations and err < self.max_error:
                 residual = _constraint_function_wrapper(x_init)
 
@@ -709,41 +1032,215 @@ class Shooting(BaseAlgorithm):
                     raise RuntimeError("Nan in residual")
 
                 err = np.linalg.norm(residual)
-                jac = _jacobian_function_wrapper(x_init)
-                try:
-                    if is_sparse:
-                        LU = splu(jac)
-                        dy0 = LU.solve(-residual)
+                if self.inexact_newton and err <= self.tolerance \
+                        and prop.abstol == base_abstol and prop.reltol == base_reltol:
+                    converged = True
+                    break
+
+                if jac is None:
+                    jac = _jacobian_function_wrapper(x_init)
+                    if use_broyden and not isinstance(jac, np.ndarray):
+                        jac = jac.toarray()
+                    jac_solve = None
+                    jac_is_fresh = True
+
+                if jac_solve is None:
+                    if use_condensed:
+                        jac_solve = self._factor_jacobian_condensed(jac, n_odes, n_arcs)
                     else:
-                        dy0 = np.linalg.solve(jac, -residual)
-                except np.linalg.LinAlgError as error:
-                    logging.warning(error)
-                    dy0, *_ = np.linalg.lstsq(jac, -residual)
+                        jac_solve = self._factor_jacobian(jac, is_sparse)
+
+                krylov_converged = False
+                if use_gmres:
+                    # The Jacobian is only a preconditioner, the step comes from Jacobian-vector products at x_init
+                    x_k = x_init.copy()
+                    n_krylov = [0]
+
+                    def _matvec(v):
+                        return _jacobian_vector_product(x_k, np.ravel(v), pick_directional, n_odes, n_quads,
+                                                        n_dynparams, n_arcs, sol.const)
+
+                    def _count(_):
+                        n_krylov[0] += 1
+
+                    jvp = LinearOperator((x_k.size, x_k.size), matvec=_matvec, dtype=dtype)
+                    precond = LinearOperator((x_k.size, x_k.size), matvec=lambda v: jac_solve(np.ravel(v)), dtype=dtype)
+                    dy0, info = gmres(jvp, -residual, M=precond, tol=min(0.1, err), atol=0, callback=_count,
+                                      callback_type='pr_norm')
+                    krylov_converged = info == 0
+                    logger.debug('BVP Iter {}\tGMRES iterations {}'.format(n_iter + 1, n_krylov[0]))
+                else:
+                    dy0 = jac_solve(-residual)
+
+                # Steps are exact Newton steps up to the linear solve unless the Jacobian is old
+                exact_step = jac_is_fresh or krylov_converged
 
                 a = 1e-4
                 reduct = 0.5
                 ll = 1
                 r_try = float('Inf')
                 step = None
+                res_try = None
+                stalled = True
 
-                while (r_try >= (1-a*ll) * err) and (r_try > self.tolerance) and ll > 0.05:
+                # Backtracking is only worth it on a fresh Jacobian. An old one is rebuilt as soon as the full step
+                # fails to reduce the residual.
+                if exact_step:
+                    ll_min = 0.05
+                else:
+                    ll_min = 1
+
+                # A trial whose residual is not finite, typically from an arc that blew up, always fails
+                while stalled and ll >= ll_min:
                     step = ll*dy0
                     res_try = _constraint_function_wrapper(x_init + step)
                     r_try = np.linalg.norm(res_try)
+                    stalled = not np.isfinite(r_try) or ((r_try >= (1-a*ll) * err) and (r_try > self.tolerance))
                     ll *= reduct
 
+                n_iter += 1
+
+                if stalled and not exact_step:
+                    # An old Jacobian is the likely culprit, so rebuild it at the same point instead of stepping
+                    logger.debug('BVP Iter {}\tLine search stalled, rebuilding Jacobian'.format(n_iter))
+                    jac = None
+                    continue
+
+                if not np.isfinite(r_try):
+                    logger.debug('BVP Iter {}\tNo step with a finite residual'.format(n_iter))
+                    break
+
                 x_init += step
+                contraction = r_try / err if err > 0 else 0
                 err = r_try
-                n_iter += 1
 
-                if err <= self.tolerance:
+                if self.inexact_newton:
+                    # Tighten the tolerances with the residual. Convergence is confirmed at the start of the next
+                    # iteration once the residual is evaluated at the requested tolerances.
+                    if err <= self.tolerance:
+                        prop.abstol, prop.reltol = base_abstol, base_reltol
+                    else:
+                        _set_ivp_tolerance(err)
+                elif err <= self.tolerance:
                     converged = True
-                if is_sparse:
+
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug('BVP Iter {}\tResidual {:13.8E}\tJacobian condition {:13.8E}'
-                                 .format(n_iter, err, np.linalg.cond(jac.toarray())))
+                                 .format(n_iter, err, self._condition_estimate(jac, is_sparse)))
+
+                step_norm2 = np.dot(step, step)
+                if use_broyden and step_norm2 > 0:
+                    # Broyden's "good" update
+                    d_res = res_try - residual
+                    jac = jac + np.outer(d_res - np.dot(jac, step), step) / step_norm2
+                    jac_solve = None
+                    jac_is_fresh = False
+                    if np.isfinite(jac).all():
+                        # The factors behind the estimate are the ones the next step is solved with
+                        jac_solve, broyden_cond = self._factor_jacobian_estimate(jac)
+                        if broyden_cond > self.max_condition:
+                            jac_solve = None
+                            jac = None
+                    else:
+                        jac = None
+                elif self.reuse_jacobian and contraction <= self.reuse_contraction:
+                    # Modified Newton, keep the Jacobian and its factors while they still converge quickly
+                    jac_is_fresh = False
+                elif krylov_converged:
+                    # Keep the preconditioner for as long as GMRES converges with it
+                    jac_is_fresh = False
                 else:
-                    logger.debug('BVP Iter {}\tResidual {:13.8E}\tJacobian condition {:13.8E}'
-                                 .format(n_iter, err, np.linalg.cond(jac)))
+                    jac = None
+
+            if self.reuse_jacobian and converged and jac is not None:
+                self._saved_jacobian = (jac, jac_solve, is_sparse)
+
+            prop.abstol, prop.reltol = base_abstol, base_reltol
+
+        elif self.algorithm.lower() == 'trustregion':
+            if self.linear_solver.lower() == 'gmres':
+                raise ValueError('Linear solver \'gmres\' is not supported by TrustRegion.')
+            if self.linear_solver.lower() not in {'lu', 'condensed'}:
+                raise NotImplementedError('Linear solver \'' + self.linear_solver + '\' is not implemented.')
+            if self.jacobian_update.lower() != 'full':
+                raise ValueError('Jacobian update \'' + self.jacobian_update + '\' is not supported by TrustRegion.')
+
+            use_condensed = self.linear_solver.lower() == 'condensed'
+            radius = self.trust_radius
+            jac = None
+            step_newton, step_cauchy = None, None
+            scale = np.zeros(x_init.size)
+
+            residual = _constraint_function_wrapper(x_init)
+            err = np.linalg.norm(residual)
+            converged = err <= self.tolerance
+
+            # Like Armijo, max_error only applies once steps have been taken
+            while not converged and n_iter <= self.max_iterations and (err < self.max_error or n_iter == 0):
+                if any(np.isnan(residual)):
+                    raise RuntimeError("Nan in residual")
+
+                # The Jacobian and both corner steps of the dogleg only change once a step is accepted
+                if jac is None:
+                    jac = _jacobian_function_wrapper(x_init)
+                    if use_condensed:
+                        jac_solve = self._factor_jacobian_condensed(jac, n_odes, n_arcs)
+                    else:
+                        jac_solve = self._factor_jacobian(jac, is_sparse)
+
+                    # The trust region is measured in unknowns scaled by the largest column norms of the Jacobian so
+                    # far, which makes it insensitive to how the unknowns are scaled
+                    if is_sparse:
+                        col_norms = np.sqrt(np.asarray(jac.multiply(jac).sum(axis=0)).ravel())
+                    else:
+                        col_norms = np.linalg.norm(jac, axis=0)
+                    scale = np.maximum(scale, col_norms)
+                    scale[scale == 0] = 1
+
+                    # Corner steps in the scaled unknowns
+                    step_newton = scale * jac_solve(-residual)
+                    grad = jac.T.dot(residual) / scale
+                    jac_grad = jac.dot(grad / scale)
+                    if np.dot(jac_grad, jac_grad) > 0:
+                        step_cauchy = -np.dot(grad, grad) / np.dot(jac_grad, jac_grad) * grad
+                    else:
+                        step_cauchy = np.zeros_like(grad)
+
+                if radius is None:
+                    radius = np.linalg.norm(step_newton)
+
+                scaled_step = self._dogleg_step(step_newton, step_cauchy, radius)
+                step_norm = np.linalg.norm(scaled_step)
+                step = scaled_step / scale
+                predicted = err ** 2 - np.linalg.norm(residual + jac.dot(step)) ** 2
+
+                res_try = _constraint_function_wrapper(x_init + step)
+                r_try = np.linalg.norm(res_try)
+                if np.isfinite(r_try) and predicted > 0:
+                    rho = (err ** 2 - r_try ** 2) / predicted
+                else:
+                    rho = -1
+
+                n_iter += 1
+
+                if rho < 0.25:
+                    radius = 0.25 * step_norm
+                elif rho > 0.75 and step_norm >= 0.99 * radius:
+                    radius = 2 * radius
+
+                if rho > 1e-4:
+                    x_init += step
+                    residual = res_try
+                    err = r_try
+                    jac = None
+                    if err <= self.tolerance:
+                        converged = True
+
+                logger.debug('BVP Iter {}\tResidual {:13.8E}\tTrust radius {:13.8E}'.format(n_iter, err, radius))
+
+                if radius < EPS * (1 + np.linalg.norm(scale * x_init)):
+                    logger.debug('Trust region collapsed')
+                    break
 
         else:
             raise NotImplementedError('Method \'' + self.algorithm + '\' is not implemented.')
@@ -754,12 +1251,9 @@ class Shooting(BaseAlgorithm):
 
         # Unwrap the solution from the solver to put in a readable format
         y, q, parameter_guess, nondynamical_parameter_guess = self._unwrap_y0(x_init, n_odes, n_quads, n_dynparams,
-                                                                              self.num_arcs)
-        for ii in range(self.num_arcs):
-            gamma_set[ii].y[0] = y[ii]
-            if n_quads > 0:
-                gamma_set[ii].q[0] = q
-        gamma_set = _gamma_maker(pick_deriv, pick_quad, gamma_set, parameter_guess, sol, prop, pool, n_quads)
+                                                                              n_arcs)
+        gamma_set = self._make_gammas(pick_deriv, pick_quad, tspan_set, y, q, parameter_guess, sol.const, prop, pool,
+                                      n_quads, pick_deriv_jac, pick_events, batch=self.batch_propagation)
 
         if err < self.tolerance and converged:
             if n_iter == -1:
@@ -779,7 +1273,7 @@ class Shooting(BaseAlgorithm):
         q_out = gamma_set[0].q
         u_out = gamma_set[0].u
 
-        for ii in range(self.num_arcs - 1):
+        for ii in range(n_arcs - 1):
             t_out = np.hstack((t_out, gamma_set[ii + 1].t[1:]))
             y_out = np.vstack((y_out, gamma_set[ii + 1].y[1:]))
             q_out = np.vstack((q_out, gamma_set[ii + 1].q[1:]))
@@ -1,8 +1,9 @@
 from .BaseAlgorithm import BaseAlgorithm, BVPResult
 from .Shooting import Shooting
 from .SPBVP import SPBVP
+from .Collocation import Collocation
 
-available_algorithms = [Shooting, SPBVP]
+available_algorithms = [Shooting, SPBVP, Collocation]
 
 
 def bvp_algorithm(name, **kwargs):
@@ -13,10 +13,18 @@ References
 
 import pytest
 import itertools
+import sys
 from beluga.numeric.data_classes.Trajectory import Trajectory
 from beluga.numeric.bvp_solvers import Shooting
+from beluga.numeric.ivp_solvers import WorkerPool, Propagator
+from beluga.utils.logging import logger
 import numpy as np
+from numba import njit, float64
 import copy
+import logging
+import pathos
+import warnings
+from scipy.sparse import csc_matrix
 from scipy.special import erf
 
 # Test the shooting solver for each algorithm listed below
@@ -1137,3 +1145,675 @@ def test_shooting_4():
     assert (out.y[0, 1] - 1) < tol
     assert (out.q[0, 0] - 2) < tol
     assert (out.q[-1, 0] - 1) < tol
+
+
+@pytest.mark.parametrize("jacobian_method, num_arcs", itertools.product(['stm', 'fd'], [1, 3]))
+def test_shooting_5(jacobian_method, num_arcs):
+    # This problem contains a quad and a dynamic parameter that only appears in the BCs through the quad. Tests that
+    # both Jacobian methods produce the same sensitivities with single and multiple shooting.
+
+    def odefun(x, p, _):
+        return p[0] * x[1], -p[0] * x[0]
+
+    def quadfun(x, p, _):
+        return p[0] * x[0]
+
+    def bcfun(y0, q0, _, qf, __, ___, ____):
+        return y0[0], y0[1] - 1, q0[0], qf[0] - 1
+
+    algo = Shooting(odefun, quadfun, bcfun, num_arcs=num_arcs, jacobian_method=jacobian_method)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.q = np.array([[0], [0]])
+    solinit.dynamical_parameters = np.array([1])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert out.converged
+    assert abs(out.dynamical_parameters[0] - np.pi / 2) < tol
+    assert abs(out.q[0, 0]) < tol
+    assert abs(out.q[-1, 0] - 1) < tol
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_broyden(jacobian_method, monkeypatch):
+    # Same problem as test_shooting_1, solved with rank-one updates of the Jacobian. Only built Jacobians are factored
+    # by _factor_jacobian, updated ones are factored along with their condition estimate.
+    n_built = [0]
+    n_updated = [0]
+    factor_jacobian = Shooting._factor_jacobian
+    factor_jacobian_estimate = Shooting._factor_jacobian_estimate
+
+    def _factor_jacobian(*args):
+        n_built[0] += 1
+        return factor_jacobian(*args)
+
+    def _factor_jacobian_estimate(*args):
+        n_updated[0] += 1
+        return factor_jacobian_estimate(*args)
+
+    monkeypatch.setattr(Shooting, '_factor_jacobian', staticmethod(_factor_jacobian))
+    monkeypatch.setattr(Shooting, '_factor_jacobian_estimate', staticmethod(_factor_jacobian_estimate))
+
+    def odefun(y, _, __):
+        return y[1], -abs(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0] + 2
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+
+    n_built_set = []
+    for jacobian_update in ['full', 'broyden']:
+        n_built[0] = 0
+        algo = Shooting(odefun, None, bcfun, num_arcs=2, jacobian_method=jacobian_method,
+                        jacobian_update=jacobian_update)
+        out = algo.solve(solinit)['sol']
+        n_built_set.append(n_built[0])
+        assert out.converged
+        assert abs(out.y[0][0]) < tol
+        assert abs(out.y[0][1] - 2.06641646) < tol
+        assert abs(out.y[-1][0] + 2) < tol
+
+    assert n_built_set[1] < n_built_set[0]
+    assert n_updated[0] > 0
+
+    # The estimate from the LU factors is within a small factor of the condition number
+    jac = np.random.RandomState(0).rand(6, 6)
+    cond = factor_jacobian_estimate(jac)[1]
+    assert np.linalg.cond(jac, 1) / 10 < cond <= np.linalg.cond(jac, 1) * (1 + 1e-8)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert factor_jacobian_estimate(np.ones((3, 3)))[0] is None
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_nonfinite_trial(jacobian_method):
+    # The full Newton step from y(0) = 10 ends at y(1) < 0, where the boundary condition is not a number. The line
+    # search has to reject it rather than step there.
+
+    def odefun(_, __, ___):
+        return -1.
+
+    def bcfun(_, yf, __, ___, ____):
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(yf[0]) - 1
+
+    algo = Shooting(odefun, None, bcfun, jacobian_method=jacobian_method)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[10], [9]])
+    solinit.const = np.array([])
+    sol = algo.solve(solinit)['sol']
+    assert sol.converged
+    assert abs(sol.y[0, 0] - 2) < tol
+
+
+def test_shooting_reuse_jacobian(monkeypatch):
+    # Continuation on a parameter of test_t2 where each solve is seeded with the last converged Jacobian. Every STM
+    # Jacobian that is built propagates the STMs once.
+    n_built = [0]
+    make_stms = Shooting._make_stms
+
+    def _make_stms(*args, **kwargs):
+        n_built[0] += 1
+        return make_stms(*args, **kwargs)
+
+    monkeypatch.setattr(Shooting, '_make_stms', staticmethod(_make_stms))
+
+    def odefun(y, _, k):
+        return y[1], y[1] / k[0]
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0] - 1, yf[0]
+
+    n_built_set = []
+    for reuse_jacobian in [False, True]:
+        n_built[0] = 0
+        algo = Shooting(odefun, None, bcfun, num_arcs=2, reuse_jacobian=reuse_jacobian)
+        sol = Trajectory()
+        sol.t = np.linspace(0, 1, 2)
+        sol.y = np.array([[0, 1], [0, 1]])
+        sol.const = np.array([1])
+
+        for c in np.linspace(1, 0.1, 10):
+            sol = copy.deepcopy(sol)
+            sol.const = np.array([c])
+            sol = algo.solve(sol)['sol']
+            assert sol.converged
+
+        n_built_set.append(n_built[0])
+
+    assert algo._saved_jacobian is not None
+    assert n_built_set[1] < n_built_set[0]
+    e1 = (1.e0 - np.exp((sol.t - 1.e0) / sol.const)) / (1.e0 - np.exp(-1.e0 / sol.const))
+    assert all(abs(e1 - sol.y[:, 0]) < tol)
+
+
+@pytest.mark.parametrize("jacobian_method, resident", itertools.product(['stm', 'fd'], [False, True]))
+def test_shooting_pool(jacobian_method, resident):
+    # Same problem as test_shooting_1 with the arcs propagated over a process pool, with and without the equations of
+    # motion kept resident in the workers
+
+    def odefun(y, _, __):
+        return y[1], -abs(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0] + 2
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=2, jacobian_method=jacobian_method)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+    if resident:
+        pool = WorkerPool(2, deriv_func=odefun)
+    else:
+        pool = pathos.multiprocessing.Pool(processes=2)
+
+    try:
+        out = algo.solve(solinit, pool=pool)['sol']
+    finally:
+        pool.close()
+
+    assert out.converged
+    assert abs(out.y[0][0]) < tol
+    assert abs(out.y[0][1] - 2.06641646) < tol
+    assert abs(out.y[-1][0] + 2) < tol
+
+
+def test_shooting_compiled_bc():
+    # Same problem as test_shooting_1 with compiled functions, so the multiple-shooting residual is compiled too
+
+    @njit((float64[:], float64[:], float64[:]))
+    def odefun(y, _, __):
+        return np.array([y[1], -abs(y[0])])
+
+    @njit((float64[:], float64[:], float64[:], float64[:], float64[:]))
+    def bcfun(y0, yf, _, __, ___):
+        return np.array([y0[0], yf[0] + 2])
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=3)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert hasattr(algo.bc_func_ms, 'py_func')
+    assert out.converged
+    assert abs(out.y[0][0]) < tol
+    assert abs(out.y[0][1] - 2.06641646) < tol
+    assert abs(out.y[-1][0] + 2) < tol
+
+
+def test_shooting_compiled_bc_dtypes():
+    # The compiled multiple-shooting residual is not limited to float64 arguments
+
+    @njit
+    def bcfun(y0, yf, _, __, ___):
+        return np.array([y0[0], yf[0] + 2])
+
+    bc_func_ms = Shooting._bc_func_multiple_shooting(bc_func=bcfun)
+    assert hasattr(bc_func_ms, 'py_func')
+
+    y0_set, yf_set = np.array([[0, 1], [2, 3]]), np.array([[1, 2], [3, 4]])
+    empty = np.array([], dtype=np.int64)
+    expected = bc_func_ms(y0_set.astype(float), yf_set.astype(float), *(empty.astype(float),) * 5)
+    assert np.allclose(bc_func_ms(y0_set, yf_set, *(empty,) * 5), expected)
+    assert np.allclose(expected, [-1, -1, 0, 5])
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_condensed(jacobian_method):
+    # x' = p v, v' = p x on many arcs, with the interior arcs condensed out of the Newton system. The quad and the
+    # parameter stay in the reduced system. The quad of x reaches 1 when cosh(p) = 2.
+
+    def odefun(x, p, _):
+        return p[0] * x[1], p[0] * x[0]
+
+    def quadfun(x, p, _):
+        return p[0] * x[0]
+
+    def bcfun(y0, q0, _, qf, __, ___, ____):
+        return y0[0], y0[1] - 1, q0[0], qf[0] - 1
+
+    algo = Shooting(odefun, quadfun, bcfun, num_arcs=6, jacobian_method=jacobian_method, linear_solver='condensed')
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.q = np.array([[0], [0]])
+    solinit.dynamical_parameters = np.array([1])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert out.converged
+    assert abs(out.dynamical_parameters[0] - np.arccosh(2)) < tol
+    assert np.allclose(out.y[:, 0], np.sinh(out.dynamical_parameters[0] * out.t), atol=tol)
+
+    # The condensed solve agrees with a direct solve of the full system
+    jac = np.random.RandomState(0).rand(16, 16)
+    jac[:10, :12] = 0
+    for ii in range(5):
+        jac[2 * ii:2 * ii + 2, 2 * ii:2 * ii + 2] = np.random.RandomState(ii).rand(2, 2)
+        jac[2 * ii:2 * ii + 2, 2 * ii + 2:2 * ii + 4] = -np.eye(2)
+    b = np.arange(16.)
+    assert np.allclose(Shooting._factor_jacobian_condensed(jac, 2, 6)(b), np.linalg.solve(jac, b))
+
+
+@pytest.mark.parametrize("repartition_arcs", [True, False])
+def test_shooting_adaptive_arcs(repartition_arcs):
+    # Continuation on x'' = (1 + k t^4)^2 x, which becomes stiff towards t = 1, with the arcs placed from the STM
+    # growth. Time is carried as the third state.
+
+    def odefun(y, _, k):
+        return y[1], y[0] * (1 + k[0] * y[2] ** 4) ** 2, 1
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0] - 1, yf[0], y0[2]
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=4, arc_placement='adaptive', repartition_arcs=repartition_arcs)
+    sol = Trajectory()
+    sol.t = np.linspace(0, 1, 2)
+    sol.y = np.array([[1, 0, 0], [0, 0, 1]])
+    sol.const = np.array([0])
+
+    arc_fractions = []
+    for c in np.linspace(0, 40, 4):
+        sol = copy.deepcopy(sol)
+        sol.const = np.array([c])
+        sol = algo.solve(sol)['sol']
+        arc_fractions.append(algo._arc_fractions)
+        assert sol.converged
+
+    assert np.allclose(arc_fractions[0], np.linspace(0, 1, 5))
+    if repartition_arcs:
+        # The arcs shrink towards the stiff end
+        assert all(np.diff(np.diff(arc_fractions[-1])) < 0)
+    else:
+        assert all(fractions is arc_fractions[0] for fractions in arc_fractions)
+
+    assert abs(sol.y[0, 0] - 1) < tol
+    assert abs(sol.y[-1, 0]) < tol
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_gmres(jacobian_method, monkeypatch):
+    # Same problem as test_t2 solved by Newton-Krylov, where the Jacobian only preconditions GMRES
+    shooting_module = sys.modules[Shooting.__module__]
+    n_gmres = [0]
+    gmres = shooting_module.gmres
+
+    def _gmres(*args, **kwargs):
+        n_gmres[0] += 1
+        return gmres(*args, **kwargs)
+
+    monkeypatch.setattr(shooting_module, 'gmres', _gmres)
+
+    def odefun(y, _, k):
+        return y[1], y[0] / k[0]
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0] - 1, yf[0]
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=3, jacobian_method=jacobian_method, linear_solver='gmres')
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([0.5])
+    sol = algo.solve(solinit)['sol']
+    assert sol.converged
+    assert n_gmres[0] > 0
+
+    e1 = np.sinh((1 - sol.t) / np.sqrt(sol.const[0])) / np.sinh(1 / np.sqrt(sol.const[0]))
+    assert all(abs(e1 - sol.y[:, 0]) < tol)
+
+
+@pytest.mark.parametrize("jacobian_method, linear_solver",
+                         itertools.product(['stm', 'fd'], ['lu', 'condensed', 'gmres']))
+def test_shooting_condition_logging(jacobian_method, linear_solver, monkeypatch):
+    # Same problem as test_t2. The condition of the Jacobian is only estimated when it is logged, and never from an
+    # SVD, which would cost more than the linear solve itself.
+    n_estimates = [0]
+    condition_estimate = Shooting._condition_estimate
+
+    def _condition_estimate(*args):
+        n_estimates[0] += 1
+        return condition_estimate(*args)
+
+    def _cond(*_, **__):
+        raise AssertionError('Condition number from an SVD')
+
+    monkeypatch.setattr(Shooting, '_condition_estimate', staticmethod(_condition_estimate))
+    monkeypatch.setattr(np.linalg, 'cond', _cond)
+
+    def odefun(y, _, k):
+        return y[1], y[0] / k[0]
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0] - 1, yf[0]
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=3, jacobian_method=jacobian_method, linear_solver=linear_solver)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([0.5])
+
+    level = logger.level
+    try:
+        for debug in [False, True]:
+            logger.setLevel(logging.DEBUG if debug else logging.INFO)
+            n_estimates[0] = 0
+            sol = algo.solve(solinit)['sol']
+            assert sol.converged
+            assert (n_estimates[0] > 0) == debug
+    finally:
+        logger.setLevel(level)
+
+    # A sparse Jacobian is estimated without making it dense
+    def _toarray(*_, **__):
+        raise AssertionError('Sparse Jacobian made dense')
+
+    jac = np.random.RandomState(0).rand(6, 6)
+    monkeypatch.setattr(csc_matrix, 'toarray', _toarray)
+    assert abs(condition_estimate(csc_matrix(jac), True) / condition_estimate(jac, False) - 1) < 1e-8
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_inexact_newton(jacobian_method, monkeypatch):
+    # x' = p v, v' = p x with x(1) = 1 from a poor guess of p, with the integration tolerances following the
+    # residual
+    shooting_module = sys.modules[Shooting.__module__]
+    abstols = []
+    propagate_endpoint_task = shooting_module.propagate_endpoint_task
+
+    def _propagate_endpoint_task(prop, *args, **kwargs):
+        abstols.append(prop.abstol)
+        return propagate_endpoint_task(prop, *args, **kwargs)
+
+    monkeypatch.setattr(shooting_module, 'propagate_endpoint_task', _propagate_endpoint_task)
+
+    def odefun(x, p, _):
+        return p[0] * x[1], p[0] * x[0]
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], y0[1] - 1, yf[0] - 1
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=2, jacobian_method=jacobian_method, inexact_newton=True,
+                    tolerance=1e-6, ivp_args={'abstol': 1e-8, 'reltol': 1e-8})
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.dynamical_parameters = np.array([3])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert out.converged
+    assert abs(out.dynamical_parameters[0] - np.arcsinh(1)) < 1e-5
+    assert abs(out.y[-1, 0] - 1) < 1e-5
+
+    # Loose while far from the solution, and back to the requested tolerance to confirm convergence
+    assert max(abstols) == algo.max_ivp_tolerance
+    assert abstols[-1] == 1e-8
+    assert any(1e-8 < abstol < algo.max_ivp_tolerance for abstol in abstols)
+
+
+def test_shooting_residual_cache(monkeypatch):
+    # Same problem as test_shooting_1, where caching residuals saves propagations without changing the answer
+    n_calls = [0]
+    n_full = [0]
+    propagate = Shooting._propagate
+
+    def _propagate(*args, **kwargs):
+        n_full[0] += 1
+        return propagate(*args, **kwargs)
+
+    monkeypatch.setattr(Shooting, '_propagate', staticmethod(_propagate))
+
+    def odefun(y, _, __):
+        n_calls[0] += 1
+        return y[1], -abs(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0] + 2
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+
+    out_set = []
+    calls_set = []
+    for cache_size in [0, 4]:
+        n_calls[0] = 0
+        n_full[0] = 0
+        algo = Shooting(odefun, None, bcfun, num_arcs=2, jacobian_method='fd', cache_size=cache_size)
+        out_set.append(algo.solve(solinit)['sol'])
+        calls_set.append(n_calls[0])
+
+        # Residuals only propagate endpoints, and full arcs are built once for the solution
+        assert n_full[0] == 1
+
+    assert calls_set[1] < calls_set[0]
+    for out in out_set:
+        assert out.converged
+        assert abs(out.y[0][1] - 2.06641646) < tol
+
+    assert np.allclose(out_set[0].y[-1], out_set[1].y[-1], atol=tol)
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_trust_region(jacobian_method):
+    # Bratu's problem y'' + 3 exp(y) = 0 from a guess far from either solution
+
+    def odefun(y, _, k):
+        return y[1], -k[0] * np.exp(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0]
+
+    algo = Shooting(odefun, None, bcfun, algorithm='TrustRegion', num_arcs=2, jacobian_method=jacobian_method)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 10], [0, 10]])
+    solinit.const = np.array([3])
+    sol = algo.solve(solinit)['sol']
+    assert sol.converged
+    assert abs(sol.y[0, 0]) < tol
+    assert abs(sol.y[-1, 0]) < tol
+    assert abs(sol.y[0, 1] - 6.1034) < tol
+
+
+@pytest.mark.parametrize("options", [{'linear_solver': 'gmres'}, {'jacobian_update': 'broyden'}])
+def test_shooting_trust_region_unsupported(options):
+    # TrustRegion rejects the linear solvers and Jacobian updates of Armijo that it cannot use, instead of ignoring them
+    def odefun(y, _, __):
+        return y[1], -abs(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0] + 2
+
+    algo = Shooting(odefun, None, bcfun, algorithm='TrustRegion', **options)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+    with pytest.raises(ValueError, match='not supported by TrustRegion'):
+        algo.solve(solinit)
+
+    # Armijo takes them
+    algo = Shooting(odefun, None, bcfun, algorithm='Armijo', num_arcs=2, **options)
+    assert algo.solve(solinit)['sol'].converged
+
+
+def test_dogleg_step():
+    step_newton = np.array([3., 4.])
+    step_cauchy = np.array([1., 0.])
+    assert np.allclose(Shooting._dogleg_step(step_newton, step_cauchy, 6), step_newton)
+    assert np.allclose(Shooting._dogleg_step(step_newton, step_cauchy, 0.5), [0.5, 0])
+    step = Shooting._dogleg_step(step_newton, step_cauchy, 2)
+    assert abs(np.linalg.norm(step) - 2) < 1e-12
+    assert np.allclose(np.cross(step - step_cauchy, step_newton - step_cauchy), 0)
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_batch_propagation(jacobian_method, monkeypatch):
+    # Same problem as test_shooting_4 with the arcs propagated as ensembles
+    n_members = []
+    propagate_batch = Propagator.propagate_batch
+
+    def _propagate_batch(self, eom_func, quad_func, tspans, *args, **kwargs):
+        n_members.append(len(tspans))
+        return propagate_batch(self, eom_func, quad_func, tspans, *args, **kwargs)
+
+    monkeypatch.setattr(Propagator, 'propagate_batch', _propagate_batch)
+
+    # Arcs propagated one at a time would go through these
+    shooting_module = sys.modules[Shooting.__module__]
+    n_single = [0]
+
+    def _single_task(*_, **__):
+        n_single[0] += 1
+        raise AssertionError('Arc propagated on its own')
+
+    monkeypatch.setattr(shooting_module, 'propagate_task', _single_task)
+    monkeypatch.setattr(shooting_module, 'propagate_endpoint_task', _single_task)
+
+    def odefun(x, _, __):
+        return -x[1], x[0]
+
+    def quadfun(x, _, __):
+        return x[0]
+
+    def bcfun(y0, _, __, qf, ___, ____, _____):
+        return y0[0], y0[1] - 1, qf[0] - 1.0
+
+    algo = Shooting(odefun, quadfun, bcfun, num_arcs=3, jacobian_method=jacobian_method, batch_propagation=True)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, np.pi / 2, 2)
+    solinit.y = np.array([[1, 0], [1, 0]])
+    solinit.q = np.array([[0], [0]])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert out.converged
+    assert abs(out.y[0, 1] - 1) < tol
+    assert abs(out.q[0, 0] - 2) < tol
+    assert abs(out.q[-1, 0] - 1) < tol
+
+    # Residuals, Jacobians and the arcs of the solution all propagate every arc in one ensemble
+    assert n_single[0] == 0
+    assert len(n_members) > 0
+    assert min(n_members) >= 3
+
+
+@pytest.mark.parametrize("sparse_jacobian", [False, True])
+def test_shooting_implicit_stepper(sparse_jacobian):
+    # Same problem as test_t1 with an implicit stepper that uses the Jacobian of the equations of motion
+    calls = []
+
+    def odefun(y, _, k):
+        calls.append(1)
+        return y[1], y[0] / k[0]
+
+    def odejac(_, __, k):
+        df_dy = np.array([[0, 1], [1 / k[0], 0]])
+        df_dp = np.empty((2, 0))
+        return df_dy, df_dp
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0] - 1, yf[0]
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([1e-1])
+    ivp_args = {'stepper': 'Radau', 'sparse_jacobian': sparse_jacobian}
+
+    algo = Shooting(odefun, None, bcfun, jacobian_method='fd', ivp_args=ivp_args)
+    sol_fd = algo.solve(solinit)['sol']
+    calls_fd = len(calls)
+
+    algo.set_derivative_jacobian(odejac)
+    del calls[:]
+    sol = algo.solve(solinit)['sol']
+    assert sol.converged
+    assert len(calls) < calls_fd
+
+    e1 = (np.exp(-sol.t / np.sqrt(sol.const)) - np.exp((sol.t - 2) / np.sqrt(sol.const))) / (
+                1 - np.exp(-2.e0 / np.sqrt(sol.const)))
+    assert all(abs(e1 - sol.y[:, 0]) < tol)
+    assert abs(sol.y[0, 1] - sol_fd.y[0, 1]) < tol
+
+
+@pytest.mark.parametrize("jacobian_method", ['stm', 'fd'])
+def test_shooting_warm_start(jacobian_method, monkeypatch):
+    # Same problem as test_shooting_1 with the step sizes of each arc carried between propagations
+    ivpsol_module = sys.modules[Propagator.__module__]
+    n_warm = [0]
+    integrate_warm = ivpsol_module._integrate_warm
+
+    def _integrate_warm(*args, **kwargs):
+        # Counts the propagations whose accepted steps are the remembered ones
+        result = integrate_warm(*args, **kwargs)
+        steps = args[6]
+        if len(steps) > 0 and len(result[2]) == len(steps) and np.allclose(result[2], steps):
+            n_warm[0] += 1
+
+        return result
+
+    monkeypatch.setattr(ivpsol_module, '_integrate_warm', _integrate_warm)
+
+    # The step histories that the arcs are propagated with
+    shooting_module = sys.modules[Shooting.__module__]
+    histories = set()
+    propagate_endpoint_task = shooting_module.propagate_endpoint_task
+
+    def _propagate_endpoint_task(prop, *args, **kwargs):
+        histories.add(id(prop._step_history))
+        return propagate_endpoint_task(prop, *args, **kwargs)
+
+    monkeypatch.setattr(shooting_module, 'propagate_endpoint_task', _propagate_endpoint_task)
+
+    def odefun(y, _, __):
+        return y[1], -abs(y[0])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], yf[0] + 2
+
+    algo = Shooting(odefun, None, bcfun, num_arcs=3, jacobian_method=jacobian_method, ivp_args={'warm_start': True})
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 4, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([])
+    out = algo.solve(solinit)['sol']
+    assert out.converged
+    assert n_warm[0] > 0
+
+    # Perturbed arcs of finite differences do not overwrite the step sizes of the nominal arcs
+    assert len(histories) == (2 if jacobian_method == 'fd' else 1)
+    assert abs(out.y[0][1] - 2.06641646) < tol
+    assert abs(out.y[-1][0] + 2) < tol
+
+
+def test_shooting_events():
+    # The growth rate switches halfway, and the arcs restart at the switch
+    def odefun(y, _, k):
+        rate = k[0] if y[0] < 0.5 else k[1]
+        return 1, rate * y[1]
+
+    def eventfun(y, _, __):
+        return np.array([y[0] - 0.5])
+
+    def bcfun(y0, yf, _, __, k):
+        return y0[0], yf[1] - np.exp((k[0] + k[1]) / 2)
+
+    algo = Shooting(odefun, None, bcfun, tolerance=1e-8, ivp_args={'detect_events': True, 'maxstep': np.inf})
+    algo.set_event_function(eventfun)
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 2], [1, 2]])
+    solinit.const = np.array([1, -3])
+    sol = algo.solve(solinit)['sol']
+    assert sol.converged
+    assert abs(sol.y[0, 1] - 1) < 1e-5
+    assert np.any(np.isclose(sol.t, 0.5))
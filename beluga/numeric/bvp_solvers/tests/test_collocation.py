@@ -0,0 +1,164 @@
+import pytest
+from beluga.numeric.data_classes.Trajectory import Trajectory
+from beluga.numeric.bvp_solvers import Collocation, SPBVP, bvp_algorithm
+from beluga.numeric.bvp_solvers.Collocation import CollocationStructure, collocation_residual, \
+    collocation_jacobian_blocks
+from beluga.numeric.compilation import compile_batch_func, compile_batch_jac_func
+from numba import njit, float64
+import numpy as np
+
+tol = 1e-3
+
+
+@njit((float64[:], float64[:], float64[:]))
+def t1_odefun(y, _, k):
+    return np.array([y[1], y[0] / k[0]])
+
+
+@njit((float64[:], float64[:], float64[:]))
+def t1_odejac(_, __, k):
+    return np.array([[0., 1.], [1 / k[0], 0.]]), np.empty((2, 0))
+
+
+def t1_bcfun(y0, yf, _, __, ___):
+    return y0[0] - 1, yf[0]
+
+
+def t1_guess(const):
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[0, 1], [0, 1]])
+    solinit.const = np.array([const])
+    return solinit
+
+
+@pytest.mark.parametrize("jacobian", [None, 'node', 'batch'])
+def test_collocation_t1(jacobian):
+    const = 1e-3
+    algo = Collocation(t1_odefun, None, t1_bcfun)
+    algo.set_derivative_function_batch(compile_batch_func(t1_odefun))
+    if jacobian == 'node':
+        algo.set_derivative_jacobian(t1_odejac)
+    elif jacobian == 'batch':
+        algo.set_derivative_jacobian_batch(compile_batch_jac_func(t1_odejac))
+
+    out = algo.solve(t1_guess(const))
+    sol = out['sol']
+    assert out['success'] and sol.converged
+
+    e1 = (np.exp(-sol.t / np.sqrt(const)) - np.exp((sol.t - 2) / np.sqrt(const))) / (1 - np.exp(-2 / np.sqrt(const)))
+    assert np.allclose(sol.y[:, 0], e1, atol=tol)
+
+    # Matches the solution of solve_bvp
+    sol_spbvp = SPBVP(t1_odefun, None, t1_bcfun).solve(t1_guess(const))['sol']
+    assert np.allclose(sol.y[-1], sol_spbvp.y[-1], atol=tol * np.max(np.abs(sol.y)))
+
+
+def test_collocation_quads():
+    const = 1e-1
+
+    def odefun(y, _, k):
+        return -y[0] / k[0]
+
+    def quadfun(y, _, __):
+        return y[0]
+
+    def bcfun(_, q0, __, qf, ___, ____, k):
+        return q0[0] - 1, qf[0] - np.exp(-1 / k[0])
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[1], [1]])
+    solinit.q = np.array([[0], [0]])
+    solinit.const = np.array([const])
+    sol = Collocation(odefun, quadfun, bcfun).solve(solinit)['sol']
+
+    assert sol.converged
+    assert np.allclose(sol.q[:, 0], np.exp(-sol.t / const), atol=tol)
+    assert np.allclose(sol.y[:, 0], -np.exp(-sol.t / const) / const, atol=tol)
+
+
+def test_collocation_parameters():
+    # A dynamical parameter buried in the ODEs, and a nondynamical one only in the BCs
+    def odefun(_, p, __):
+        return p[0]
+
+    def bcfun(y0, yf, _, ndp, ___):
+        return y0[0], yf[0] - ndp[0], ndp[0] - 2
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 4)
+    solinit.y = np.array([[0], [0], [0], [0]])
+    solinit.dynamical_parameters = np.array([1])
+    solinit.nondynamical_parameters = np.array([0])
+    solinit.const = np.array([])
+    algo = bvp_algorithm('Collocation')
+    algo.set_derivative_function(odefun)
+    algo.set_boundarycondition_function(bcfun)
+    sol = algo.solve(solinit)['sol']
+
+    assert sol.converged
+    assert abs(sol.dynamical_parameters[0] - 2) < tol
+    assert abs(sol.nondynamical_parameters[0] - 2) < tol
+    assert np.allclose(sol.y[:, 0], 2 * sol.t, atol=tol)
+
+
+def test_collocation_structure():
+    # The assembled Jacobian matches finite differences of the residual, before and after the columns are ordered
+    m, n, k = 6, 2, 1
+    t = np.linspace(0, 1, m)
+    y = np.random.rand(n, m)
+    p = np.array([1.5])
+
+    def fun(_y, _p):
+        return np.vstack((_p[0] * _y[1] ** 2, -_p[0] * np.sin(_y[0])))
+
+    def fun_jac(_y, _p):
+        df_dy = np.zeros((n, n, _y.shape[1]))
+        df_dy[0, 1] = 2 * _p[0] * _y[1]
+        df_dy[1, 0] = -_p[0] * np.cos(_y[0])
+        return df_dy, fun(_y, np.ones(1))[:, np.newaxis]
+
+    def residual(x):
+        _y, _p = x[:m * n].reshape((m, n)).T, x[m * n:]
+        r = collocation_residual(fun, t, _y, _p)[0]
+        return np.hstack((r.T.ravel(), _y[:, 0], _y[0, -1] - _p))
+
+    x = np.hstack((y.T.ravel(), p))
+    jac_fd = np.array([(residual(x + 1e-7 * e) - residual(x)) / 1e-7 for e in np.eye(x.size)]).T
+
+    _, f, y_mid, _ = collocation_residual(fun, t, y, p)
+    blocks = collocation_jacobian_blocks(t, *fun_jac(y, p), *fun_jac(y_mid, p))
+    blocks += (np.array([[1, 0], [0, 1], [0, 0]]), np.array([[0, 0], [0, 0], [1, 0]]), np.array([[0], [0], [-1]]))
+    values = np.hstack([block.ravel() for block in blocks])
+
+    structure = CollocationStructure(m, n, k)
+    assert np.allclose(structure.assemble(values).toarray(), jac_fd, atol=1e-5)
+
+    b = np.random.rand(x.size)
+    assert np.allclose(jac_fd @ structure.factor(values)(b), b, atol=1e-4)
+    assert structure.order is not None
+    assert np.allclose(structure.assemble(values).toarray()[:, np.argsort(structure.order)], jac_fd, atol=1e-5)
+    assert np.allclose(jac_fd @ structure.factor(values)(b), b, atol=1e-4)
+
+
+def test_collocation_reuse():
+    # The structure and factors of a converged solve carry over to a neighboring case
+    algo = Collocation(t1_odefun, None, t1_bcfun)
+    algo.set_derivative_function_batch(compile_batch_func(t1_odefun))
+    out = algo.solve(t1_guess(1e-2))
+    assert out['success']
+    assert algo._saved_jacobian is not None
+
+    solinit = out['sol']
+    solinit.const = np.array([1.05e-2])
+    structure = algo._saved_jacobian[0]
+    out = algo.solve(solinit)
+    assert out['success']
+    assert out['sol'].t.size == solinit.t.size
+    assert algo._structure(solinit.t.size, 2, 0) is structure
+
+    const = solinit.const[0]
+    e1 = (np.exp(-out['sol'].t / np.sqrt(const)) - np.exp((out['sol'].t - 2) / np.sqrt(const))) \
+        / (1 - np.exp(-2 / np.sqrt(const)))
+    assert np.allclose(out['sol'].y[:, 0], e1, atol=tol)
@@ -14,6 +14,8 @@ References
 import pytest
 from beluga.numeric.data_classes.Trajectory import Trajectory
 from beluga.numeric.bvp_solvers import SPBVP
+from beluga.numeric.compilation import compile_batch_func, compile_batch_jac_func
+from numba import njit, float64
 import numpy as np
 from scipy.special import erf
 import copy
@@ -1036,6 +1038,109 @@ def test_r18(const):
     assert all(e2 - sol.y[:, 0] < tol)
 
 
+@pytest.mark.parametrize("const", MEDIUM)
+def test_batch_functions(const):
+    # Evaluating the whole mesh in one call gives the same solution as evaluating node by node
+    @njit((float64[:], float64[:], float64[:]))
+    def odefun(y, _, k):
+        return -y[0] / k[0]
+
+    @njit((float64[:], float64[:], float64[:]))
+    def quadfun(y, _, __):
+        return y[0]
+
+    def bcfun(_, q0, __, qf, ___, ____, k):
+        return q0[0] - 1, qf[0] - np.exp(-1 / k[0])
+
+    y = np.random.rand(1, 10)
+    assert np.allclose(compile_batch_func(odefun)(y, np.array([]), np.array([const])), -y / const)
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 2)
+    solinit.y = np.array([[1.], [1.]])
+    solinit.q = np.array([[0.], [0.]])
+    solinit.const = np.array([const])
+
+    algo = SPBVP(odefun, quadfun, bcfun)
+    sol = algo.solve(solinit)['sol']
+    algo.set_derivative_function_batch(compile_batch_func(odefun))
+    algo.set_quadrature_function_batch(compile_batch_func(quadfun))
+    sol_batch = algo.solve(solinit)['sol']
+
+    assert np.allclose(sol_batch.t, sol.t)
+    assert np.allclose(sol_batch.y, sol.y)
+    assert np.allclose(sol_batch.q, sol.q)
+
+
+def test_batch_jacobian():
+    # Filling the Jacobians of the whole mesh in one call gives the same solution as filling them node by node
+    @njit((float64[:], float64[:], float64[:]))
+    def odefun(y, p, _):
+        return np.array([p[0] * y[1], -p[0] * y[0]])
+
+    @njit((float64[:], float64[:], float64[:]))
+    def odejac(y, p, _):
+        return np.array([[0, p[0]], [-p[0], 0]]), np.array([[y[1]], [-y[0]]])
+
+    def bcfun(y0, yf, _, __, ___):
+        return y0[0], y0[1] - 1, yf[0] - 1
+
+    y = np.random.rand(2, 10)
+    p = np.array([2.])
+    df_dy, df_dp = np.zeros((2, 2, 10)), np.ones((2, 2, 10))
+    compile_batch_jac_func(odejac)(y, p, np.array([]), df_dy, df_dp)
+    for ii in range(10):
+        assert np.allclose(df_dy[:, :, ii], odejac(y[:, ii], p, np.array([]))[0])
+        assert np.allclose(df_dp[:, :1, ii], odejac(y[:, ii], p, np.array([]))[1])
+
+    assert np.all(df_dp[:, 1:] == 1)
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 4)
+    solinit.y = np.array([[0., 1.]] * 4)
+    solinit.dynamical_parameters = np.array([1.])
+    solinit.const = np.array([])
+
+    algo = SPBVP(odefun, None, bcfun)
+    algo.set_derivative_jacobian(odejac)
+    sol = algo.solve(solinit)['sol']
+    algo.set_derivative_jacobian_batch(compile_batch_jac_func(odejac))
+    sol_batch = algo.solve(solinit)['sol']
+
+    assert abs(sol_batch.dynamical_parameters[0] - np.pi / 2) < 1e-2
+    assert np.allclose(sol_batch.t, sol.t)
+    assert np.allclose(sol_batch.y, sol.y)
+    assert np.allclose(sol_batch.dynamical_parameters, sol.dynamical_parameters)
+
+
+def test_batch_integer_constants():
+    # Integer constants reach the batch functions, which are compiled for float64, as floats
+    @njit((float64[:], float64[:], float64[:]))
+    def odefun(y, _, k):
+        return np.array([-k[0] * y[0]])
+
+    @njit((float64[:], float64[:], float64[:]))
+    def odejac(_, __, k):
+        return np.array([[-k[0]]]), np.empty((1, 0))
+
+    def bcfun(y0, _, __, ___, ____):
+        return np.array([y0[0] - 1])
+
+    solinit = Trajectory()
+    solinit.t = np.linspace(0, 1, 4)
+    solinit.y = np.array([[1.]] * 4)
+    solinit.const = np.array([2])
+
+    algo = SPBVP(odefun, None, bcfun)
+    algo.set_derivative_function_batch(compile_batch_func(odefun))
+    algo.set_derivative_jacobian_batch(compile_batch_jac_func(odejac))
+    sol = algo.solve(solinit)['sol']
+
+    assert sol.converged
+    assert np.allclose(sol.y[:, 0], np.exp(-2 * sol.t), atol=tol)
+    assert sol.const.dtype == solinit.const.dtype
+
+
 def test_spbvp_1():
     # Full 2PBVP test problem
     # This is the simplest BVP
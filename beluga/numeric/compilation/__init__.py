@@ -1,3 +1,3 @@
 from .jit import jit_compile_func, jit_lambdify, jit_compile_func_num_args
 from .LocalCompiler import LocalCompiler
-from .component_compilation import compile_control
+from .component_compilation import compile_control, compile_batch_func, compile_batch_jac_func
@@ -1,4 +1,6 @@
+import logging
 import numpy as np
+from numba import njit, float64, errors
 from scipy.integrate import simps
 
 from beluga.numeric.compilation import jit_lambdify, jit_compile_func
@@ -37,6 +39,61 @@ def compile_control(control_options, args, ham_func, lambdify_func=jit_lambdify)
     return jit_compile_func(calc_u, args, func_name='control_function')
 
 
+def compile_batch_func(func, func_name=None):
+    """
+    Compiles a function of a single node, called as ``func(y, p, k)``, into one that evaluates every node of a mesh in
+    one call.
+
+    :param func: Function of a single node returning a 1D array.
+    :param func_name: Name used in log messages.
+    :return: Function called as ``batch_func(y, p, k)`` where `y` is an (n_states, n_nodes) array, returning the
+        (n_outputs, n_nodes) array of the outputs at every node.
+    """
+
+    def batch_func(_y, _p, _k):
+        _f0 = np.asarray(func(_y[:, 0], _p, _k))
+        out = np.empty((_f0.size, _y.shape[1]))
+        out[:, 0] = _f0
+        for ii in range(1, _y.shape[1]):
+            out[:, ii] = np.asarray(func(_y[:, ii], _p, _k))
+
+        return out
+
+    try:
+        return njit((float64[:, :], float64[:], float64[:]))(batch_func)
+
+    except errors.NumbaError as e:
+        logging.debug('Cannot Compile FunctionComponent: {}\n\tError: {}'.format(func_name, e))
+        return batch_func
+
+
+def compile_batch_jac_func(func_jac, func_name=None):
+    """
+    Compiles a Jacobian of a single node, called as ``func_jac(y, p, k)`` and returning ``(df_dy, df_dp)``, into one
+    that fills the Jacobians at every node of a mesh in one call.
+
+    :param func_jac: Jacobian of a single node.
+    :param func_name: Name used in log messages.
+    :return: Function called as ``batch_jac_func(y, p, k, df_dy, df_dp)`` where `y` is an (n_states, n_nodes) array.
+        The Jacobians are written into the preallocated (n_states, n_states, n_nodes) array `df_dy` and the leading
+        columns of the (n_states, n_params, n_nodes) array `df_dp`. Any further columns of `df_dp` are left untouched.
+    """
+
+    def batch_jac_func(_y, _p, _k, _df_dy, _df_dp):
+        for ii in range(_y.shape[1]):
+            _jac_y, _jac_p = func_jac(_y[:, ii], _p, _k)
+            _df_dy[:, :, ii] = np.asarray(_jac_y)
+            _jac_p = np.asarray(_jac_p).reshape((_y.shape[0], -1))
+            _df_dp[:, :_jac_p.shape[1], ii] = _jac_p
+
+    try:
+        return njit((float64[:, :], float64[:], float64[:], float64[:, :, :], float64[:, :, :]))(batch_jac_func)
+
+    except errors.NumbaError as e:
+        logging.debug('Cannot Compile FunctionComponent: {}\n\tError: {}'.format(func_name, e))
+        return batch_jac_func
+
+
 def compile_cost(symbolic_cost: CostStruct, dynamic_args, bc_args, lambdify_func=jit_lambdify):
 
     compute_initial_cost = lambdify_func(bc_args, symbolic_cost.initial)
@@ -2,7 +2,8 @@ import numpy as np
 import copy
 
 from beluga.numeric.data_classes.Trajectory import Trajectory
-from beluga.numeric.compilation import LocalCompiler, jit_compile_func, compile_control
+from beluga.numeric.compilation import LocalCompiler, jit_compile_func, compile_control, compile_batch_func, \
+    compile_batch_jac_func
 from beluga.symbolic.data_classes.components_structures import extract_syms, getattr_from_list
 from beluga.utils.helper_functions import max_mag
 
@@ -27,6 +28,12 @@ class NumericProblem:
         self.deriv_func = None
         self.quad_func = None
         self.deriv_func_jac = None
+        self.switch_event_func = None
+        self.deriv_func_batch = None
+        self.quad_func_batch = None
+        self.deriv_func_jac_batch = None
+        self._deriv_func_takes_control = False
+        self._deriv_func_jac_takes_control = False
 
         self.compute_initial_bc = None
         self.compute_terminal_bc = None
@@ -103,6 +110,7 @@ class NumericProblem:
         self.compile_bc(use_quad_arg=use_quad_arg)
         self.compile_cost(use_quad_arg=use_quad_arg, use_control_arg=use_control_arg)
         self.compile_deriv_jac_func()
+        self.compile_switch_events()
         self.compile_bc_jac_func(use_quad_arg=use_quad_arg)
         self.compile_scaling()
 
@@ -116,6 +124,9 @@ class NumericProblem:
         sym_eom = getattr_from_list(self.prob.states, 'eom')
         sym_eom_q = getattr_from_list(self.prob.quads, 'eom')
 
+        self.deriv_func_batch, self.quad_func_batch = None, None
+        self._deriv_func_takes_control = self.compute_u is None and use_control_arg
+
         if self.compute_u is None:
             if use_control_arg:
                 _args = self._dynamic_args_w_controls
@@ -153,6 +164,26 @@ class NumericProblem:
 
         return self.deriv_func, self.quad_func
 
+    def compile_batch_funcs(self):
+        """
+        Compiles versions of `deriv_func`, `quad_func` and `deriv_func_jac` that take the states at every node of a
+        mesh as an (n_states, n_nodes) array and return the derivatives, or their Jacobians, at every node in one call.
+
+        Only the collocation solvers use them, so they are not compiled by `compile_problem` but on the first call
+        here. Functions that take the controls as an argument have no batch version.
+        """
+        if self.deriv_func_batch is None and not self._deriv_func_takes_control:
+            self.deriv_func_batch = compile_batch_func(self.deriv_func, func_name='deriv_func_batch')
+
+            if self.quad_func is not None:
+                self.quad_func_batch = compile_batch_func(self.quad_func, func_name='quad_func_batch')
+
+        if self.deriv_func_jac_batch is None and self.deriv_func_jac is not None \
+                and not self._deriv_func_jac_takes_control:
+            self.deriv_func_jac_batch = compile_batch_jac_func(self.deriv_func_jac, func_name='deriv_func_jac_batch')
+
+        return self.deriv_func_batch, self.quad_func_batch, self.deriv_func_jac_batch
+
     def compile_bc(self, use_quad_arg=False):
 
         sym_initial_bc = getattr_from_list(self.prob.constraints['initial'], 'expr')
@@ -231,6 +262,9 @@ class NumericProblem:
 
     def compile_deriv_jac_func(self, use_control_arg=False):
 
+        self.deriv_func_jac_batch = None
+        self._deriv_func_jac_takes_control = use_control_arg
+
         if self.prob.func_jac['df_dy'] is None:
             return None
 
@@ -269,6 +303,42 @@ class NumericProblem:
 
         return self.deriv_func_jac
 
+    def compile_switch_events(self):
+        """
+        Compiles the conditions of the switches into one event function, whose entries cross zero where a switch
+        changes its active function. Conditions that only differ by their sign share an event.
+        """
+        conditions = []
+        pending = [switch.conditions for switch in self.prob.switches]
+        while len(pending) > 0:
+            item = pending.pop(0)
+            if isinstance(item, (list, tuple)):
+                pending = list(item) + pending
+            elif item not in conditions and -item not in conditions:
+                conditions.append(item)
+
+        if len(conditions) == 0:
+            return None
+
+        elif self.compute_u is not None:
+            compute_conditions = self.lambdify(self._dynamic_args_w_controls, conditions)
+            compute_u = self.compute_u
+
+            def switch_event_func(_y, _p, _k):
+                _u = compute_u(_y, _p, _k)
+                return np.array(compute_conditions(_y, _u, _p, _k))
+
+        else:
+            compute_conditions = self.lambdify(self._dynamic_args, conditions)
+
+            def switch_event_func(_y, _p, _k):
+                return np.array(compute_conditions(_y, _p, _k))
+
+        self.switch_event_func = jit_compile_func(switch_event_func, self._dynamic_args,
+                                                  func_name='switch_event_func')
+
+        return self.switch_event_func
+
     def compile_bc_jac_func(self, use_quad_arg=False):
 
         if self.prob.bc_jac['initial']['dbc_dy'] is None:
@@ -1,4 +1,6 @@
-from .ivpsol import (Propagator, Algorithm, reconstruct, integrate_quads)
+from .ivpsol import (Propagator, Algorithm, reconstruct, integrate_quads, cumulative_simpson, make_stm_ode,
+                     make_directional_ode)
+from .workers import (WorkerPool, load_function, propagate_task, propagate_endpoint_task, ship_function)
 from ..data_classes.Trajectory import Trajectory
 
 import os
@@ -1,9 +1,11 @@
 import beluga
 import numpy as np
-from scipy.integrate import solve_ivp, simps
+from scipy.integrate import solve_ivp, simps, RK23, RK45, DOP853, Radau, BDF, LSODA
+from scipy.sparse import csc_matrix
 import copy
+from collections import OrderedDict
 
-from liepack.flow import RKMK, Flow
+from liepack.flow import RKMK, Flow, Method
 from liepack.domain.hspaces import HManifold
 from liepack.domain.liegroups import RN
 from liepack.domain.liealgebras import rn
@@ -11,6 +13,13 @@ from liepack import exp
 from liepack.field import VectorField
 
 from beluga.numeric.data_classes.Trajectory import Trajectory
+from beluga.numeric.ivp_solvers.numba_rk import rk_integrate, tableaus
+
+# Steppers of solve_ivp that use the Jacobian of the equations of motion, by their upper case names
+implicit_steppers = {'BDF': 'BDF', 'RADAU': 'Radau', 'LSODA': 'LSODA'}
+
+# Step size histories kept by a warm started propagator
+MAX_STEP_HISTORIES = 64
 
 
 class Algorithm(object):
@@ -48,16 +57,65 @@ class Propagator(Algorithm):
         +------------------------+-----------------+--------------------+
         | reltol                 | 1e-6            |  > 0               |
         +------------------------+-----------------+--------------------+
-        | program                | 'scipy'         |  {'scipy', 'lie'}  |
+        | program                | 'scipy'         |  {'scipy', 'lie',  |
+        |                        |                 |  'numba'}          |
         +------------------------+-----------------+--------------------+
         | method                 | 'RKMK'          |  {'RKMK'}          |
         +------------------------+-----------------+--------------------+
         | quick_reconstruct      | False           |  bool              |
         +------------------------+-----------------+--------------------+
+        | augment_quads          | False           |  bool              |
+        +------------------------+-----------------+--------------------+
+        | quad_error_control     | True            |  bool              |
+        +------------------------+-----------------+--------------------+
+        | sparse_jacobian        | False           |  bool              |
+        +------------------------+-----------------+--------------------+
+        | warm_start             | False           |  bool              |
+        +------------------------+-----------------+--------------------+
+        | detect_events          | False           |  bool              |
+        +------------------------+-----------------+--------------------+
         | stepper                | 'RK45'          |  see ivp methods   |
         +------------------------+-----------------+--------------------+
         | variable_step          | True            |  bool              |
         +------------------------+-----------------+--------------------+
+
+        The 'numba' program integrates with a compiled RK45 or DOP853 stepper, set by `stepper`, so that the whole
+        integration runs in nopython mode together with the equations of motion. It needs equations of motion
+        compiled with numba and falls back to 'scipy' for anything else.
+
+        The 'lie' program integrates on :math:`\\mathbb{R}^n` with the RKMK stepper named by `stepper`, as in
+        `liepack`. The group action is then a translation, so explicit steppers run on plain arrays with the same steps
+        and step size control as `liepack`, and only implicit steppers go through its manifold objects.
+
+        With `augment_quads` set, quads are integrated together with the states in a single pass instead of being
+        reconstructed from the trajectory afterwards. Turning `quad_error_control` off then leaves the quads out of the
+        step size control, so problems with quads take the same steps as those without. The 'lie' program always
+        controls the error of the quads.
+
+        The implicit steppers 'BDF', 'Radau' and 'LSODA' of the 'scipy' program use the Jacobian of the equations of
+        motion passed to the call as `eom_func_jac`, instead of finite differencing the equations of motion. With
+        `sparse_jacobian` set, the sparsity pattern of that Jacobian is found once for each set of equations of motion
+        and reused by every later call. The Jacobian is then handed to the stepper as a sparse matrix so its
+        factorizations are sparse, or without `eom_func_jac` the pattern cuts the cost of finite differencing. 'LSODA'
+        only takes dense Jacobians and ignores `sparse_jacobian`.
+
+        Passing `t_eval` to a call stores the trajectory at those times only, so memory no longer grows with the number
+        of steps. Quads are then always integrated with the states. The 'numba' program integrates from one requested
+        time to the next, and the 'lie' program interpolates its steps.
+
+        With `warm_start`, the 'scipy' program remembers the accepted step sizes of the last propagation over each time
+        span, keyed by the equations of motion and tolerances. The next propagation over the same span starts from its
+        first step instead of the initial step heuristic, and the explicit Runge-Kutta steppers try the remembered steps
+        in turn, leaving the error control to only shrink those that fail. Newton iterations and finite differences
+        then retrace nearly the same steps without rediscovering them. The step sizes are kept by the propagator that
+        took them, so a propagator pickled to the workers of a pool leaves its own copy untouched and warm starting
+        only applies to serial runs.
+
+        With `detect_events`, the 'scipy' program stops at every zero crossing of the `event_func` passed to a call,
+        located by root finding on the dense output, and restarts from there with a fresh initial step. Switches then
+        only need small steps right at the transition, rather than a small `maxstep` along the whole trajectory. The
+        'numba' program falls back to 'scipy' when there are events to detect, the 'lie' program ignores them, and
+        they take precedence over `warm_start`.
         """
 
         obj = super().__new__(cls, *args, **kwargs)
@@ -67,6 +125,13 @@ class Propagator(Algorithm):
         obj.program = kwargs.get('program', 'scipy').lower()
         obj.method = kwargs.get('method', 'RKMK').upper()
         obj.quick_reconstruct = kwargs.get('quick_reconstruct', False)
+        obj.augment_quads = kwargs.get('augment_quads', False)
+        obj.quad_error_control = kwargs.get('quad_error_control', True)
+        obj.sparse_jacobian = kwargs.get('sparse_jacobian', False)
+        obj._sparsity = dict()
+        obj.warm_start = kwargs.get('warm_start', False)
+        obj._step_history = OrderedDict()
+        obj.detect_events = kwargs.get('detect_events', False)
         obj.stepper = kwargs.get('stepper', 'RK45').upper()
         obj.variable_step = kwargs.get('variable_step', True)
         return obj
@@ -81,34 +146,131 @@ class Propagator(Algorithm):
         :param y0: Initial state position.
         :param q0: Initial quad position.
         :param args: Additional arguments required by EOM files.
-        :param kwargs: Unused.
+        :param kwargs: `eom_func_jac`, the Jacobian of the equations of motion returning ``(df_dy, df_dp)``, used by
+            implicit steppers. `t_eval`, times in the direction of integration at which to store the trajectory
+            instead of every step. `event_func`, called as ``event_func(y, *args)``, whose entries cross zero at
+            switches.
         :return: A full reconstructed trajectory, :math:`\gamma`.
         """
         y0 = np.array(y0, dtype=beluga.DTYPE)
+        n_odes = len(y0)
+
+        # Only the requested times are kept, so quads cannot be reconstructed afterwards and are integrated with the
+        # states
+        t_eval = kwargs.get('t_eval', None)
+        if t_eval is not None:
+            t_eval = np.atleast_1d(np.asarray(t_eval, dtype=float))
+
+        augment = (self.augment_quads or t_eval is not None) and quad_func is not None and len(q0) != 0
+        if augment:
+            x0 = np.hstack((y0, np.array(q0, dtype=beluga.DTYPE)))
+
+            def ode_func(_xx, *_args):
+                return np.hstack((eom_func(_xx[:n_odes], *_args), quad_func(_xx[:n_odes], *_args)))
+        else:
+            x0 = y0
+            ode_func = eom_func
+
+        event_func = kwargs.get('event_func', None) if self.detect_events else None
+
+        program = self.program
+        if program == 'numba' and event_func is not None:
+            program = 'scipy'
+
+        if program == 'numba':
+            numba_args = _numba_args(eom_func, x0, self.stepper, args, quad_func=quad_func if augment else None)
+            if numba_args is None:
+                program = 'scipy'
+
+        if program == 'numba':
+            n_err = len(x0) if self.quad_error_control else n_odes
+            rk_args = (self.reltol, self.abstol, self.maxstep, self.variable_step)
+            if t_eval is None:
+                t, x = rk_integrate(eom_func, quad_func if augment else eom_func, n_odes, n_err, float(tspan[0]),
+                                    float(tspan[-1]), x0, *numba_args, *rk_args, True, *tableaus[self.stepper])
+            else:
+                # Integrated piece by piece between the requested times, keeping only the end of each piece
+                t, x = [], []
+                t_piece, x_piece = float(tspan[0]), x0
+                for t_next in t_eval:
+                    t_steps, x_steps = rk_integrate(eom_func, quad_func if augment else eom_func, n_odes, n_err,
+                                                    t_piece, float(t_next), x_piece, *numba_args, *rk_args, False,
+                                                    *tableaus[self.stepper])
+                    if t_steps[-1] != t_next:
+                        break
+
+                    t_piece, x_piece = t_steps[-1], x_steps[-1]
+                    t.append(t_piece)
+                    x.append(x_piece)
+
+                t, x = np.array(t), np.reshape(np.array(x), (len(t), len(x0)))
+
+            gamma = Trajectory(t, x[:, :n_odes])
+
+        elif program == 'scipy':
+            rtol, atol = self._tolerances(n_odes, len(x0) - n_odes)
+            if self.stepper in implicit_steppers:
+                method = implicit_steppers[self.stepper]
+                jac_kwargs = self._jacobian_kwargs(eom_func, ode_func, kwargs.get('eom_func_jac', None),
+                                                   quad_func if augment else None, n_odes, x0, args)
+            else:
+                method = self.stepper
+                jac_kwargs = dict()
 
-        if self.program == 'scipy':
             if self.variable_step is True:
-                int_sol = solve_ivp(lambda t, _y: eom_func(_y, *args), [tspan[0], tspan[-1]], y0,
-                                    rtol=self.reltol, atol=self.abstol, max_step=self.maxstep, method=self.stepper)
+                T = t_eval
+                step_kwargs = {'max_step': self.maxstep}
             else:
-                T = np.arange(tspan[0], tspan[-1], self.maxstep)
-                if T[-1] != tspan[-1]:
-                    T = np.hstack((T, tspan[-1]))
-                int_sol = solve_ivp(lambda t, _y: eom_func(_y, *args), [tspan[0], tspan[-1]], y0,
-                                    rtol=self.reltol, atol=self.abstol, method=self.stepper, t_eval=T)
-            gamma = Trajectory(int_sol.t, int_sol.y.T)
-
-        elif self.program == 'lie':
-            dim = y0.shape[0]
+                if t_eval is not None:
+                    T = t_eval
+                else:
+                    T = np.arange(tspan[0], tspan[-1], self.maxstep)
+                    if T[-1] != tspan[-1]:
+                        T = np.hstack((T, tspan[-1]))
+                step_kwargs = dict()
+
+            if event_func is not None:
+                t, x = _integrate_events(lambda t, _y: ode_func(_y, *args), tspan[0], tspan[-1], x0, method, T,
+                                         lambda _y: event_func(_y[:n_odes], *args), rtol=rtol, atol=atol,
+                                         **step_kwargs, **jac_kwargs)
+            elif self.warm_start:
+                key = (eom_func, quad_func if augment else None, float(tspan[0]), float(tspan[-1]), len(x0),
+                       self.reltol, self.abstol)
+                t, x, steps = _integrate_warm(lambda t, _y: ode_func(_y, *args), tspan[0], tspan[-1], x0, method,
+                                              T, self._step_history.get(key, ()), rtol=rtol, atol=atol,
+                                              **step_kwargs, **jac_kwargs)
+                self._step_history[key] = steps
+                self._step_history.move_to_end(key)
+                if len(self._step_history) > MAX_STEP_HISTORIES:
+                    self._step_history.popitem(last=False)
+            else:
+                int_sol = solve_ivp(lambda t, _y: ode_func(_y, *args), [tspan[0], tspan[-1]], x0, rtol=rtol,
+                                    atol=atol, method=method, t_eval=T, **step_kwargs, **jac_kwargs)
+                t, x = int_sol.t, int_sol.y.T
+
+            gamma = Trajectory(t, x[:, :n_odes])
+
+        elif program == 'lie' and self.method == 'RKMK' and Method(self.stepper).RKtype == 'explicit':
+            # On RN the group action is a translation and dexpinv is the identity, so RKMK is an ordinary RK step
+            ti, x = _integrate_rkmk_rn(lambda _x: ode_func(_x, *args), tspan[0], tspan[-1], x0, Method(self.stepper),
+                                       Flow(variablestep=self.variable_step), self.maxstep)
+            if t_eval is not None:
+                gamma_full = Trajectory(ti, x)
+                ti, x = t_eval, np.array([gamma_full(time)[0] for time in t_eval])
+
+            gamma = Trajectory(ti, x[:, :n_odes])
+
+        elif program == 'lie':
+            dim = x0.shape[0]
             g = rn(dim+1)
-            g.set_vector(y0)
+            g.set_vector(x0)
             y = HManifold(RN(dim+1, exp(g)))
             vf = VectorField(y)
             vf.set_equationtype('general')
 
             def M2g(t, y):
                 vec = y[:-1, -1]
-                out = eom_func(vec, *args)
+                out = ode_func(vec, *args)
                 g = rn(dim+1)
                 g.set_vector(out)
                 return g
@@ -122,12 +284,20 @@ class Propagator(Algorithm):
             ts.setmethod(self.stepper)
             f = Flow(ts, vf, variablestep=self.variable_step)
             ti, yi = f(y, tspan[0], tspan[-1], self.maxstep)
-            gamma = Trajectory(ti, np.vstack([_[:-1, -1] for _ in yi]))  # Hardcoded assuming RN
+            x = np.vstack([_[:-1, -1] for _ in yi])  # Hardcoded assuming RN
+            if t_eval is not None:
+                # The flow keeps every step, so the requested times are interpolated from them
+                gamma_full = Trajectory(ti, x)
+                ti, x = t_eval, np.array([gamma_full(time)[0] for time in t_eval])
+
+            gamma = Trajectory(ti, x[:, :n_odes])
 
         else:
             raise NotImplementedError
 
-        if quad_func is not None and len(q0) != 0:
+        if augment:
+            gamma.q = x[:, n_odes:]
+        elif quad_func is not None and len(q0) != 0:
             if self.quick_reconstruct:
                 qf = integrate_quads(quad_func, tspan, gamma, *args)
                 gamma.q = np.vstack((q0, np.zeros((len(gamma.t)-2, len(q0))), qf+q0))
@@ -136,6 +306,436 @@ class Propagator(Algorithm):
 
         return gamma
 
+    def propagate_batch(self, eom_func, quad_func, tspans, y0_set, q0_set, *args, endpoints_only=False):
+        r"""
+        Propagates an ensemble of initial states that share the equations of motion and their arguments.
+
+        With the 'scipy' program the members are stacked into a single system and advanced together by one call to
+        `solve_ivp`. Every member runs over its own time span through the normalized time :math:`\tau \in [0, 1]`
+        with :math:`t = t_0 + \tau (t_f - t_0)`, and quads are integrated alongside the states, under error control
+        unless `quad_error_control` is off. The members then share steps. `solve_ivp` controls the RMS norm of the error
+        over the whole stacked system, which would let the error of a single member grow by the square root of the
+        ensemble size, so the tolerances are tightened by that factor. Each member is then held at least as tightly as
+        on its own, and more tightly when many members are active. Other programs propagate the members one at a time.
+
+        :param eom_func: FunctionComponent representing the equations of motion.
+        :param quad_func: FunctionComponent representing the quadratures.
+        :param tspans: Time interval of each member, one row per member.
+        :param y0_set: Initial states, one row per member.
+        :param q0_set: Initial quads, one row per member.
+        :param args: Additional arguments required by EOM files, shared by all members.
+        :param endpoints_only: Only return the terminal points.
+        :return: The trajectory of each member, or the terminal states and quads :math:`(y_f, q_f)` with one row per
+            member if `endpoints_only` is set.
+        """
+        y0_set = np.array(y0_set, dtype=beluga.DTYPE)
+        n_members, n_odes = y0_set.shape
+        q0_set = np.array(q0_set, dtype=beluga.DTYPE)
+        if quad_func is None or q0_set.size == 0:
+            q0_set = np.empty((n_members, 0))
+        else:
+            q0_set = np.reshape(q0_set, (n_members, -1))
+
+        n_quads = q0_set.shape[1]
+
+        if self.program != 'scipy' or n_members == 0:
+            gamma_set = [self(eom_func, quad_func, tspan, y0, q0, *args)
+                         for tspan, y0, q0 in zip(tspans, y0_set, q0_set)]
+            if not endpoints_only:
+                return gamma_set
+
+            qf_set = np.array([gamma.q[-1] if n_quads > 0 else np.empty((0,)) for gamma in gamma_set])
+            return np.array([gamma.y[-1] for gamma in gamma_set]), np.reshape(qf_set, (n_members, n_quads))
+
+        t0_set = np.array([tspan[0] for tspan in tspans], dtype=beluga.DTYPE)
+        dt_set = np.array([tspan[-1] for tspan in tspans], dtype=beluga.DTYPE) - t0_set
+        n_aug = n_odes + n_quads
+
+        def _batch_ode(_, _xx):
+            xx = np.reshape(_xx, (n_members, n_aug))
+            dxx = np.empty_like(xx)
+            for ii in range(n_members):
+                dxx[ii, :n_odes] = eom_func(xx[ii, :n_odes], *args)
+                if n_quads > 0:
+                    dxx[ii, n_odes:] = quad_func(xx[ii, :n_odes], *args)
+
+            return (dxx * dt_set[:, np.newaxis]).ravel()
+
+        # The longest time span sets the step limit in normalized time
+        max_step = self.maxstep / max(np.max(np.abs(dt_set)), np.finfo(float).eps)
+        x0 = np.hstack((y0_set, q0_set)).ravel()
+        rtol, atol = self._tolerances(n_odes, n_quads)
+        # The RMS norm over N members bounds the norm of any one of them only to within a factor of sqrt(N)
+        rtol, atol = rtol / np.sqrt(n_members), np.asarray(atol) / np.sqrt(n_members)
+        if np.ndim(atol) > 0:
+            atol = np.tile(atol, n_members)
+
+        if self.variable_step is True:
+            int_sol = solve_ivp(_batch_ode, [0, 1], x0, rtol=rtol, atol=atol, max_step=max_step,
+                                method=implicit_steppers.get(self.stepper, self.stepper),
+                                t_eval=[0, 1] if endpoints_only else None)
+        else:
+            T = np.arange(0, 1, max_step)
+            if T[-1] != 1:
+                T = np.hstack((T, 1))
+            int_sol = solve_ivp(_batch_ode, [0, 1], x0, rtol=rtol, atol=atol,
+                                method=implicit_steppers.get(self.stepper, self.stepper), t_eval=T)
+
+        xx_set = np.reshape(int_sol.y.T, (-1, n_members, n_aug))
+        if endpoints_only:
+            if int_sol.t[-1] != 1:
+                # Stopped short, so like `propagate_endpoint_task` the terminal points are reported at infinity
+                return np.full((n_members, n_odes), np.inf), np.full((n_members, n_quads), np.inf)
+
+            return xx_set[-1, :, :n_odes].copy(), xx_set[-1, :, n_odes:].copy()
+
+        gamma_set = []
+        for ii in range(n_members):
+            gamma = Trajectory(t0_set[ii] + int_sol.t * dt_set[ii], xx_set[:, ii, :n_odes])
+            if n_quads > 0:
+                gamma.q = xx_set[:, ii, n_odes:]
+            gamma_set.append(gamma)
+
+        return gamma_set
+
+    def _jacobian_kwargs(self, eom_func, ode_func, eom_func_jac, quad_func, n_odes, x0, args):
+        """
+        Returns the Jacobian arguments of `solve_ivp` for an implicit stepper.
+
+        :param eom_func: Equations of motion.
+        :param ode_func: The equations of motion being integrated, with any quads appended.
+        :param eom_func_jac: Jacobian of the equations of motion returning ``(df_dy, df_dp)``, or None.
+        :param quad_func: Quadrature equations when they are integrated with the states, otherwise None.
+        :param n_odes: Number of states.
+        :param x0: Initial point, states followed by any quads.
+        :param args: Additional arguments required by EOM files.
+        :return: Keyword arguments for `solve_ivp`.
+        """
+        # LSODA only takes dense Jacobians
+        sparse = self.sparse_jacobian and self.stepper != 'LSODA'
+        if eom_func_jac is None:
+            if not sparse:
+                return dict()
+
+            def jac_dense(_xx):
+                return _jacobian_fd(ode_func, _xx, args)
+        else:
+            def jac_dense(_xx):
+                jac = np.zeros((len(_xx), len(_xx)))
+                jac[:n_odes, :n_odes] = eom_func_jac(_xx[:n_odes], *args)[0]
+                if quad_func is not None:
+                    # Quads do not depend on themselves, so only their derivatives by the states are needed
+                    jac[n_odes:, :n_odes] = _jacobian_fd(quad_func, _xx[:n_odes], args)
+                return jac
+
+        if not sparse:
+            return {'jac': lambda t, _xx: jac_dense(_xx)}
+
+        key = (eom_func, eom_func_jac, quad_func, len(x0))
+        if key not in self._sparsity:
+            self._sparsity[key] = _jacobian_sparsity(jac_dense, x0)
+
+        rows, cols = self._sparsity[key]
+        if eom_func_jac is None:
+            return {'jac_sparsity': csc_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(x0), len(x0)))}
+
+        return {'jac': lambda t, _xx: csc_matrix((jac_dense(_xx)[rows, cols], (rows, cols)),
+                                                 shape=(len(x0), len(x0)))}
+
+    def _tolerances(self, n_odes, n_quads):
+        """
+        Returns the relative and absolute tolerances of `solve_ivp` for states followed by quads.
+
+        When the quads are left out of the error control their absolute tolerance is infinite, so they drop out of the
+        RMS error norm. The tolerances of the states are scaled so that the norm is still taken over the states alone.
+        """
+        if self.quad_error_control or n_quads == 0:
+            return self.reltol, self.abstol
+
+        scale = np.sqrt(n_odes / (n_odes + n_quads))
+        return self.reltol * scale, np.hstack((np.full(n_odes, self.abstol * scale), np.full(n_quads, np.inf)))
+
+
+def _integrate_warm(fun, t0, tf, x0, method, t_eval, steps, **options):
+    """
+    Integrates like `solve_ivp`, starting from a known sequence of step sizes.
+
+    :param fun: Right-hand side, called as ``fun(t, x)``.
+    :param t0: Initial time.
+    :param tf: Final time.
+    :param x0: Initial point.
+    :param method: Name of the stepper of `solve_ivp`.
+    :param t_eval: Times to store the solution at, or None to store every step.
+    :param steps: Step sizes to try. Explicit Runge-Kutta steppers try each of them in turn, others only the first.
+    :param options: Options of the stepper.
+    :return: (t, x, steps) where `steps` are the step sizes accepted.
+    """
+    solvers = {'RK23': RK23, 'RK45': RK45, 'DOP853': DOP853, 'Radau': Radau, 'BDF': BDF, 'LSODA': LSODA}
+    steps = [step for step in steps if step > 0]
+    if len(steps) > 0:
+        options['first_step'] = min(steps[0], abs(tf - t0))
+
+    solver = solvers[method](fun, t0, x0, tf, **options)
+    follow_steps = isinstance(solver, (RK23, RK45, DOP853))
+
+    if t_eval is None:
+        t, x = [t0], [x0]
+    else:
+        t, x = [], []
+        direction = 1 if tf >= t0 else -1
+        t_eval_ii = 0
+
+    accepted = []
+    while solver.status == 'running':
+        t_old = solver.t
+        solver.step()
+        if solver.status == 'failed':
+            break
+
+        accepted.append(abs(solver.t - t_old))
+        if t_eval is None:
+            t.append(solver.t)
+            x.append(solver.y.copy())
+        else:
+            t_eval_next = np.searchsorted(direction * t_eval, direction * solver.t, side='right')
+            if t_eval_next > t_eval_ii:
+                t_step = t_eval[t_eval_ii:t_eval_next]
+                t.extend(t_step)
+                x.extend(solver.dense_output()(t_step).T)
+                t_eval_ii = t_eval_next
+
+        if follow_steps and len(accepted) < len(steps):
+            solver.h_abs = steps[len(accepted)]
+
+    return np.array(t), np.reshape(np.array(x), (len(t), len(x0))), np.array(accepted)
+
+
+def _integrate_rkmk_rn(fun, t0, tf, x0, method, flow, dt):
+    r"""
+    Integrates with an explicit RKMK method on :math:`\mathbb{R}^n` using plain arrays.
+
+    Takes the same steps as `liepack.flow.Flow` with an `RKMK` time stepper, but without building an algebra element
+    for every evaluation of the right-hand side. The time starts at `t0` rather than zero, and the last step is clipped
+    to `tf` again when it is rejected, so the trajectory always ends at `tf`.
+
+    :param fun: Right-hand side, called as ``fun(x)``.
+    :param t0: Initial time.
+    :param tf: Final time.
+    :param x0: Initial point.
+    :param method: `liepack.flow.Method` holding the tableau.
+    :param flow: `liepack.flow.Flow` holding the step size control settings.
+    :param dt: Initial step size.
+    :return: (t, x) at every step taken.
+    """
+    if flow.variablestep and not method.variable_step:
+        raise NotImplementedError(method.name + ' does not support variable stepsize.')
+
+    x0 = np.array(x0, dtype=np.float64)
+    a, b, bhat = method.RKa, method.RKb, method.RKbhat
+    k = np.empty((method.RKns, x0.size))
+    t, x = [t0], [x0]
+    if t0 + dt > tf:
+        dt = tf - t0
+
+    converged = False
+    while not converged:
+        while True:
+            converged = t[-1] + dt >= tf
+            if converged:
+                dt = tf - t[-1]
+
+            k[0] = fun(x[-1])
+            for ii in range(1, method.RKns):
+                k[ii] = fun(x[-1] + dt*np.dot(a[ii, :ii], k[:ii]))
+
+            u_low = dt*np.dot(b, k)
+            if not flow.variablestep:
+                x_new, dt_new = x[-1] + u_low, dt
+                break
+
+            u_high = dt*np.dot(bhat, k)
+            x_new = x[-1] + u_high
+            errest = np.linalg.norm(u_low - u_high)
+            with np.errstate(divide='ignore'):
+                dt_new = flow.pessimist*(flow.tol/errest)**(1/(method.RKord + 1))*dt
+
+            dt_new = min(max(min(dt_new, flow.large*dt), flow.small*dt), flow.dt_max)
+            if flow.accept*flow.tol - errest > 0:
+                break
+
+            dt = dt_new
+
+        t.append(t[-1] + dt)
+        x.append(x_new)
+        dt = dt_new
+
+    return np.array(t), np.vstack(x)
+
+
+def _integrate_events(fun, t0, tf, x0, method, t_eval, event_func, **options):
+    """
+    Integrates with `solve_ivp`, restarting at every zero crossing of the events.
+
+    The step that crosses an event has already mixed the dynamics on both sides of it, so the trajectory is integrated
+    again from the start of that step to just short of the event. A trapezoidal step then bridges the event, and
+    integration restarts just past it with a fresh step size. Neither side ever evaluates the dynamics right on the
+    switch. Once an event has crossed zero, its next crossing must go the other way.
+
+    :param fun: Right-hand side, called as ``fun(t, x)``.
+    :param t0: Initial time.
+    :param tf: Final time.
+    :param x0: Initial point.
+    :param method: Name of the stepper of `solve_ivp`.
+    :param t_eval: Times to store the solution at, or None to store every step.
+    :param event_func: Events, called as ``event_func(x)``.
+    :param options: Options of the stepper.
+    :return: (t, x)
+    """
+    n_events = np.size(event_func(x0))
+    directions = np.zeros(n_events)
+    direction = 1 if tf >= t0 else -1
+    bridge = 1e-8 * abs(tf - t0)
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval)
+
+    def make_event(ii):
+        def event(_, _x):
+            return event_func(_x)[ii]
+
+        event.terminal = True
+        event.direction = directions[ii]
+        return event
+
+    t_set, x_set = [np.array([t0])], [np.array([x0])]
+    if t_eval is not None:
+        t_set, x_set = [], []
+        n_stored = 0
+
+    t_start, x_start = t0, np.asarray(x0)
+    while True:
+        events = [make_event(ii) for ii in range(n_events)]
+        int_sol = solve_ivp(fun, [t_start, tf], x_start, method=method,
+                            t_eval=None if t_eval is None else t_eval[n_stored:], events=events,
+                            dense_output=t_eval is not None, **options)
+
+        if int_sol.status != 1:
+            if t_eval is None:
+                t_set.append(int_sol.t[1:])
+                x_set.append(int_sol.y.T[1:])
+            else:
+                t_set.append(int_sol.t)
+                x_set.append(int_sol.y.T)
+            break
+
+        fired = [ii for ii in range(n_events) if len(int_sol.t_events[ii]) > 0][0]
+        t_event = int_sol.t_events[fired][-1]
+        if directions[fired] != 0:
+            directions[fired] = -directions[fired]
+        else:
+            directions[fired] = np.sign(event_func(x_start)[fired])
+
+        t_left = t_event - direction * bridge
+        if (t_left - t_start) * direction < 0:
+            t_left = t_start
+
+        t_right = t_event + direction * bridge
+        if (t_right - tf) * direction > 0:
+            t_right = tf
+
+        # Redo the step that crossed the event, stopping short of it
+        if t_eval is None:
+            before = (int_sol.t - t_left) * direction < 0
+            t_set.append(int_sol.t[1:][before[1:]])
+            x_set.append(int_sol.y.T[1:][before[1:]])
+            if t_left != t_start:
+                t_step, x_step = int_sol.t[before][-1], int_sol.y[:, before][:, -1]
+        else:
+            t_set.append(int_sol.t)
+            x_set.append(int_sol.y.T)
+            n_stored += len(int_sol.t)
+            if t_left != t_start:
+                ts = np.asarray(int_sol.sol.ts)
+                t_step = ts[(ts - t_left) * direction < 0][-1]
+                x_step = int_sol.sol(t_step)
+
+        if t_left == t_start:
+            t_step, x_step = t_start, x_start
+
+        if t_left != t_step:
+            x_left = solve_ivp(fun, [t_step, t_left], x_step, method=method, **options).y[:, -1]
+        else:
+            x_left = x_step
+
+        f_left = np.asarray(fun(t_left, x_left))
+        f_right = np.asarray(fun(t_right, x_left + (t_right - t_left) * f_left))
+        x_right = x_left + (t_right - t_left) * (f_left + f_right) / 2
+
+        if t_eval is None:
+            if t_left != t_start:
+                t_set.append(np.array([t_left]))
+                x_set.append(np.array([x_left]))
+            t_set.append(np.array([t_right]))
+            x_set.append(np.array([x_right]))
+        else:
+            # Requested times within the bridge take its far end
+            bridged = (t_eval[n_stored:] - t_right) * direction <= 0
+            t_set.append(t_eval[n_stored:][bridged])
+            x_set.append(np.tile(x_right, (np.count_nonzero(bridged), 1)))
+            n_stored += np.count_nonzero(bridged)
+
+        if t_right == tf:
+            break
+
+        t_start, x_start = t_right, x_right
+
+    return np.hstack(t_set), np.vstack(x_set)
+
+
+def _jacobian_fd(func, x, args, step_size=1e-6):
+    """
+    Jacobian of ``func(x, *args)`` by forward differences.
+    """
+    fx = np.asarray(func(x, *args))
+    jac = np.empty((len(fx), len(x)))
+    for ii in range(len(x)):
+        xh = x.copy()
+        xh[ii] += step_size
+        jac[:, ii] = (np.asarray(func(xh, *args)) - fx) / step_size
+
+    return jac
+
+
+def _jacobian_sparsity(jac_func, x0, n_samples=3):
+    """
+    Estimates the sparsity pattern of a Jacobian from its nonzeros at the initial point and at nearby random points.
+
+    :param jac_func: Dense Jacobian, called as ``jac_func(x)``.
+    :param x0: Initial point.
+    :param n_samples: Number of points sampled.
+    :return: (rows, cols) of the structural nonzeros.
+    """
+    rng = np.random.RandomState(0)
+    pattern = np.asarray(jac_func(x0)) != 0
+    for _ in range(n_samples - 1):
+        x = x0 + 1e-2 * (1 + np.abs(x0)) * rng.standard_normal(x0.shape)
+        pattern |= np.asarray(jac_func(x)) != 0
+
+    return np.nonzero(pattern)
+
+
+def _numba_args(eom_func, y0, stepper, args, quad_func=None):
+    """
+    Returns the parameters and constants as arrays for the compiled integrator, or None if it cannot be used.
+    """
+    if not hasattr(eom_func, 'py_func') or stepper not in tableaus or len(args) != 2 \
+            or np.iscomplexobj(y0) or (quad_func is not None and not hasattr(quad_func, 'py_func')):
+        return None
+
+    try:
+        return tuple(np.asarray(arg, dtype=np.float64).ravel() for arg in args)
+    except (TypeError, ValueError):
+        return None
+
 
 def reconstruct(quadfun, gamma, q0, *args):
     r"""
@@ -155,13 +755,11 @@ def reconstruct(quadfun, gamma, q0, *args):
     """
     gamma = copy.copy(gamma)
 
-    # gam_len = len(gamma)
-    temp_q = np.zeros_like(q0)
-
-    dq = np.array([quadfun(gamma(time)[0], *args) for time in gamma.t])
+    # The quads are evaluated at the stored points, so nothing needs to be interpolated
+    dq = np.reshape(np.array([quadfun(y, *args) for y in gamma.y]), (len(gamma.t), -1))
 
     # Integrate the quad func using numeric quadrature
-    qf_m0 = np.vstack([temp_q] + [simps(dq[:ii+2].T, x=gamma.t[:ii+2]) for ii in range(len(gamma.t)-1)])
+    qf_m0 = cumulative_simpson(dq, gamma.t)
 
     # Add the initial state to get the final state.
     if len(q0) == 0:
@@ -171,6 +769,49 @@ def reconstruct(quadfun, gamma, q0, *args):
     return gamma
 
 
+def cumulative_simpson(y, x):
+    r"""
+    Cumulative integral of samples on a possibly uneven grid in linear time.
+
+    Pairs of intervals are integrated with Simpson's rule, so the integral at every other point is that of the composite
+    rule. The integral at the points in between comes from the same quadratics, and the last interval of an odd count
+    shares the quadratic of the one before it. Two samples fall back to the trapezoidal rule.
+
+    :param y: Samples, one row per point.
+    :param x: Points, in increasing or decreasing order.
+    :return: :math:`\int_{x_0}^{x_i} y dx` for every point, with the same shape as `y`.
+    """
+    y = np.asarray(y)
+    x = np.asarray(x, dtype=beluga.DTYPE)
+    out = np.zeros(y.shape, dtype=np.result_type(y, x))
+    n = len(x)
+    if n < 2:
+        return out
+
+    h = np.diff(x)
+    if y.ndim > 1:
+        h = np.reshape(h, (-1,) + (1,) * (y.ndim - 1))
+
+    if n == 2:
+        out[1] = h[0] * (y[0] + y[1]) / 2
+        return out
+
+    # Integrals over [x_i, x_i+1] and [x_i+1, x_i+2] of the quadratic through x_i, x_i+1 and x_i+2
+    h1, h2 = h[:-1], h[1:]
+    hs = h1 + h2
+    first = h1 / 6 * ((3 - h1 / hs) * y[:-2] + (3 + h1 / h2) * y[1:-1] - h1 ** 2 / (hs * h2) * y[2:])
+    second = h2 / 6 * (-h2 ** 2 / (hs * h1) * y[:-2] + (3 + h2 / h1) * y[1:-1] + (3 - h2 / hs) * y[2:])
+
+    increments = np.empty((n - 1,) + y.shape[1:], dtype=out.dtype)
+    increments[0:n - 2:2] = first[0::2]
+    increments[1::2] = second[0::2]
+    if n % 2 == 0:
+        increments[-1] = second[-1]
+
+    out[1:] = np.cumsum(increments, axis=0)
+    return out
+
+
 def integrate_quads(quadfun, tspan, gamma, *args):
     r"""
     Integrates quadratures over a trajectory base space. Only returns the terminal point.
@@ -223,3 +864,123 @@ def integrate_quads(quadfun, tspan, gamma, *args):
 
     qf = qf_m0 + q0
     return qf
+
+
+def make_stm_ode(eom_func, quad_func, eom_func_jac, n_odes, n_quads, step_size=1e-6):
+    r"""
+    Makes the state-transition matrix ODE for a system with (optional) quads.
+
+    The augmented state is :math:`[\mathbf{y}, \mathbf{q}, \Delta]` where :math:`\Delta` has one row per state and
+    quad and one column per state and dynamical parameter. Quads do not appear in their own sensitivities, so their
+    rows are driven by the states and parameters only.
+
+    :param eom_func: Equations of motion, called as ``eom_func(y, p, const)``.
+    :param quad_func: Quadrature equations, called as ``quad_func(y, p, const)``.
+    :param eom_func_jac: Jacobian of the equations of motion returning ``(df_dy, df_dp)``. Estimated by finite
+        differences if None.
+    :param n_odes: Number of states.
+    :param n_quads: Number of quads.
+    :param step_size: Step size used when Jacobians are estimated by finite differences.
+    :return: The augmented ODE, called as ``stm_ode(xx, p, const)``.
+    """
+    xh = np.eye(n_odes)*step_size
+    n_aug = n_odes + n_quads
+
+    def _stmode_fd(_xx, p, const):
+        """ Finite difference version of state transition matrix """
+        n_params = p.size
+        phi = _xx[n_aug:].reshape((n_aug, n_odes + n_params))
+        xx = _xx[0:n_odes]  # Just states
+
+        fx = np.asarray(eom_func(xx, p, const))
+        ff = np.empty((n_aug, n_odes + n_params))
+
+        if eom_func_jac is not None:
+            _df_dy, _df_dp = eom_func_jac(xx, p, const)
+            ff[:n_odes, :n_odes] = _df_dy
+            if n_params > 0:
+                ff[:n_odes, n_odes:] = np.reshape(_df_dp, (n_odes, n_params))
+        else:
+            for i in range(n_odes):
+                fxh = np.asarray(eom_func(xx + xh[i, :], p, const))
+                ff[:n_odes, i] = (fxh - fx) / step_size
+
+            for i in range(n_params):
+                ph = p.copy()
+                ph[i] += step_size
+                fxh = np.asarray(eom_func(xx, ph, const))
+                ff[:n_odes, i + n_odes] = (fxh - fx) / step_size
+
+        if n_quads > 0:
+            gx = np.asarray(quad_func(xx, p, const))
+            for i in range(n_odes):
+                gxh = np.asarray(quad_func(xx + xh[i, :], p, const))
+                ff[n_odes:, i] = (gxh - gx) / step_size
+
+            for i in range(n_params):
+                ph = p.copy()
+                ph[i] += step_size
+                gxh = np.asarray(quad_func(xx, ph, const))
+                ff[n_odes:, i + n_odes] = (gxh - gx) / step_size
+        else:
+            gx = np.empty((0,))
+
+        phi_dot = np.dot(ff[:, :n_odes], phi[:n_odes, :])
+        phi_dot[:, n_odes:] += ff[:, n_odes:]
+        return np.hstack((fx, gx, np.reshape(phi_dot, (n_aug * (n_odes + n_params)))))
+
+    return _stmode_fd
+
+
+def make_directional_ode(eom_func, quad_func, eom_func_jac, n_odes, n_quads, n_params, step_size=1e-6):
+    r"""
+    Makes the ODE for the derivative of a trajectory along one direction, the product of the state-transition matrix
+    with a vector, without forming the matrix.
+
+    The augmented state is :math:`[\mathbf{y}, \mathbf{q}, \mathbf{v}, \mathbf{w}, \delta\mathbf{p}]` where
+    :math:`\mathbf{v}` and :math:`\mathbf{w}` are the directional derivatives of the states and quads and
+    :math:`\delta\mathbf{p}` is the constant direction of the dynamical parameters. It costs one extra evaluation of the
+    equations of motion per step instead of one per state and parameter.
+
+    :param eom_func: Equations of motion, called as ``eom_func(y, p, const)``.
+    :param quad_func: Quadrature equations, called as ``quad_func(y, p, const)``.
+    :param eom_func_jac: Jacobian of the equations of motion returning ``(df_dy, df_dp)``. Estimated by finite
+        differences if None.
+    :param n_odes: Number of states.
+    :param n_quads: Number of quads.
+    :param n_params: Number of dynamical parameters.
+    :param step_size: Step size used when derivatives are estimated by finite differences.
+    :return: The augmented ODE, called as ``directional_ode(xx, p, const)``.
+    """
+    n_aug = n_odes + n_quads
+
+    def _directional_ode(_xx, p, const):
+        xx = _xx[:n_odes]
+        v = _xx[n_aug:n_aug + n_odes]
+        dp = _xx[2*n_aug:]
+
+        fx = np.asarray(eom_func(xx, p, const))
+        if n_quads > 0:
+            gx = np.asarray(quad_func(xx, p, const))
+        else:
+            gx = np.empty((0,))
+
+        # Finite differences are scaled to the direction so the perturbation itself stays at step_size
+        h = step_size / max(np.sqrt(np.dot(v, v) + np.dot(dp, dp)), np.finfo(float).eps)
+
+        if eom_func_jac is not None:
+            _df_dy, _df_dp = eom_func_jac(xx, p, const)
+            v_dot = np.dot(_df_dy, v)
+            if n_params > 0:
+                v_dot += np.dot(np.reshape(_df_dp, (n_odes, n_params)), dp)
+        else:
+            v_dot = (np.asarray(eom_func(xx + h*v, p + h*dp, const)) - fx) / h
+
+        if n_quads > 0:
+            w_dot = (np.asarray(quad_func(xx + h*v, p + h*dp, const)) - gx) / h
+        else:
+            w_dot = np.empty((0,))
+
+        return np.hstack((fx, gx, v_dot, w_dot, np.zeros(n_params)))
+
+    return _directional_ode
@@ -0,0 +1,253 @@
+import numpy as np
+from numba import njit
+from scipy.integrate._ivp.rk import RK45, DOP853
+
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+
+
+def _make_tableau(method):
+    if method is DOP853:
+        n_stages = method.n_stages
+        return (np.ascontiguousarray(method.A[:n_stages, :n_stages]), method.B, method.E5, method.E3, True,
+                method.error_estimator_order)
+
+    return method.A, method.B, method.E, np.zeros_like(method.E), False, method.error_estimator_order
+
+
+# Butcher tableaus of the embedded pairs, laid out as (A, B, E, E3, two_error_estimates, error_estimator_order). The
+# equations of motion are autonomous, so the nodes are not needed.
+tableaus = {'RK45': _make_tableau(RK45), 'DOP853': _make_tableau(DOP853)}
+
+
+@njit
+def _rms(x):
+    total = 0.0
+    for i in range(x.size):
+        total += x[i] * x[i]
+    return np.sqrt(total / x.size)
+
+
+@njit
+def _eval(eom_func, quad_func, n_odes, y, p, k):
+    if n_odes == y.size:
+        return np.asarray(eom_func(y, p, k))
+
+    # The quads trail the states and are driven by them alone
+    x = y[:n_odes].copy()
+    f = np.empty(y.size)
+    fx = np.asarray(eom_func(x, p, k))
+    for i in range(n_odes):
+        f[i] = fx[i]
+
+    gx = np.asarray(quad_func(x, p, k))
+    for i in range(y.size - n_odes):
+        f[n_odes + i] = gx[i]
+
+    return f
+
+
+@njit
+def _set_row(K, s, f):
+    # Explicit loops compile much faster than slice assignment
+    for i in range(f.size):
+        K[s, i] = f[i]
+
+
+@njit
+def _rk_step(eom_func, quad_func, n_odes, y, f, h, p, k, A, B, K):
+    n = y.size
+    _set_row(K, 0, f)
+    y_stage = np.empty(n)
+    for s in range(1, B.size):
+        for i in range(n):
+            dy = 0.0
+            for j in range(s):
+                dy += A[s, j] * K[j, i]
+            y_stage[i] = y[i] + h * dy
+        _set_row(K, s, _eval(eom_func, quad_func, n_odes, y_stage, p, k))
+
+    y_new = np.empty(n)
+    for i in range(n):
+        dy = 0.0
+        for s in range(B.size):
+            dy += B[s] * K[s, i]
+        y_new[i] = y[i] + h * dy
+
+    f_new = _eval(eom_func, quad_func, n_odes, y_new, p, k)
+    _set_row(K, B.size, f_new)
+    return y_new, f_new
+
+
+@njit
+def _error_norm(K, h, scale, E, E3, two_error_estimates):
+    err = np.zeros(scale.size)
+    for i in range(scale.size):
+        for s in range(E.size):
+            err[i] += E[s] * K[s, i]
+        err[i] /= scale[i]
+
+    if not two_error_estimates:
+        return _rms(h * err)
+
+    err3 = np.zeros(scale.size)
+    for i in range(scale.size):
+        for s in range(E3.size):
+            err3[i] += E3[s] * K[s, i]
+        err3[i] /= scale[i]
+
+    err_norm_2 = np.sum(err * err)
+    err3_norm_2 = np.sum(err3 * err3)
+    if err_norm_2 == 0 and err3_norm_2 == 0:
+        return 0.0
+
+    return np.abs(h) * err_norm_2 / np.sqrt((err_norm_2 + 0.01 * err3_norm_2) * scale.size)
+
+
+@njit
+def _initial_step(eom_func, quad_func, n_odes, n_err, y0, f0, p, k, direction, order, rtol, atol):
+    scale = atol + np.abs(y0[:n_err]) * rtol
+    d0 = _rms(y0[:n_err] / scale)
+    d1 = _rms(f0[:n_err] / scale)
+    if d0 < 1e-5 or d1 < 1e-5:
+        h0 = 1e-6
+    else:
+        h0 = 0.01 * d0 / d1
+
+    f1 = _eval(eom_func, quad_func, n_odes, y0 + h0 * direction * f0, p, k)
+    d2 = _rms((f1[:n_err] - f0[:n_err]) / scale) / h0
+
+    if d1 <= 1e-15 and d2 <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** (1 / (order + 1))
+
+    return min(100 * h0, h1)
+
+
+@njit
+def rk_integrate(eom_func, quad_func, n_odes, n_err, t0, tf, y0, p, k, rtol, atol, max_step, variable_step, store_steps,
+                 A, B, E, E3, two_error_estimates, order):
+    r"""
+    Integrates equations of motion with an embedded explicit Runge-Kutta pair, entirely in compiled code.
+
+    The step size control follows `scipy.integrate.solve_ivp`. With `variable_step` off, steps of `max_step` are taken
+    without error control. Quads may be integrated alongside the states by placing them after the states in `y0`.
+
+    :param eom_func: Compiled equations of motion, called as ``eom_func(y, p, k)``.
+    :param quad_func: Compiled quadrature equations, called as ``quad_func(y, p, k)``. Only called when `y0` holds more
+        than `n_odes` entries, so any compiled function with the same signature will do without quads.
+    :param n_odes: Number of states. The remaining entries of `y0` are quads.
+    :param n_err: Number of leading entries of `y0` that are subject to error control.
+    :param t0: Initial time.
+    :param tf: Final time.
+    :param y0: Initial state, followed by the initial quads.
+    :param p: Dynamical parameters.
+    :param k: Constants.
+    :param rtol: Relative tolerance.
+    :param atol: Absolute tolerance.
+    :param max_step: Largest step allowed.
+    :param variable_step: Whether the step size is adapted to the error estimate.
+    :param store_steps: Whether every step is kept, or only the initial and terminal points.
+    :param A: Coefficients of the stages.
+    :param B: Weights of the stages in the solution.
+    :param E: Weights of the stages in the error estimate.
+    :param E3: Weights of the stages in the secondary error estimate of DOP853.
+    :param two_error_estimates: Whether both error estimates are combined, as in DOP853.
+    :param order: Order of the error estimate.
+    :return: :math:`(t, y)` at every step taken, or at the initial and terminal points without `store_steps`.
+    """
+    n = y0.size
+    direction = 1.0 if tf >= t0 else -1.0
+    K = np.empty((B.size + 1, n))
+    scale = np.empty(n_err)
+    error_exponent = -1 / (order + 1)
+
+    capacity = 64
+    t_out = np.empty(capacity)
+    y_out = np.empty((capacity, n))
+    t_out[0] = t0
+    _set_row(y_out, 0, y0)
+    n_out = 1
+
+    t = t0
+    y = y0.copy()
+    f = _eval(eom_func, quad_func, n_odes, y, p, k)
+
+    if variable_step:
+        h_abs = min(_initial_step(eom_func, quad_func, n_odes, n_err, y, f, p, k, direction, order, rtol, atol),
+                    max_step)
+    else:
+        h_abs = max_step
+
+    while direction * (tf - t) > 0:
+        min_step = 10 * np.abs(np.nextafter(t, direction * np.inf) - t)
+        h_abs = min(max(h_abs, min_step), max_step)
+
+        step_accepted = False
+        step_rejected = False
+        while not step_accepted:
+            if h_abs < min_step:
+                # Like solve_ivp, give back what was integrated so far
+                if not store_steps:
+                    t_out[1] = t
+                    _set_row(y_out, 1, y)
+                    n_out = 2
+                return t_out[:n_out], y_out[:n_out]
+
+            t_new = t + h_abs * direction
+            if direction * (t_new - tf) > 0:
+                t_new = tf
+
+            h = t_new - t
+            y_new, f_new = _rk_step(eom_func, quad_func, n_odes, y, f, h, p, k, A, B, K)
+
+            if not variable_step:
+                break
+
+            for i in range(n_err):
+                scale[i] = atol + max(abs(y[i]), abs(y_new[i])) * rtol
+            error_norm = _error_norm(K, h, scale, E, E3, two_error_estimates)
+
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = MAX_FACTOR
+                else:
+                    factor = min(MAX_FACTOR, SAFETY * error_norm ** error_exponent)
+
+                if step_rejected:
+                    factor = min(1, factor)
+
+                h_abs = np.abs(h) * factor
+                step_accepted = True
+            else:
+                h_abs = np.abs(h) * max(MIN_FACTOR, SAFETY * error_norm ** error_exponent)
+                step_rejected = True
+
+        t = t_new
+        y = y_new
+        f = f_new
+
+        if not store_steps:
+            continue
+
+        if n_out == capacity:
+            capacity *= 2
+            t_grown = np.empty(capacity)
+            y_grown = np.empty((capacity, n))
+            for ii in range(n_out):
+                t_grown[ii] = t_out[ii]
+                _set_row(y_grown, ii, y_out[ii])
+            t_out, y_out = t_grown, y_grown
+
+        t_out[n_out] = t
+        _set_row(y_out, n_out, y)
+        n_out += 1
+
+    if not store_steps:
+        t_out[1] = t
+        _set_row(y_out, 1, y)
+        n_out = 2
+
+    return t_out[:n_out], y_out[:n_out]
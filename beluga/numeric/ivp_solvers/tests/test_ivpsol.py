@@ -1,7 +1,19 @@
-from beluga.numeric.ivp_solvers import Propagator, integrate_quads
+from beluga.numeric.ivp_solvers import Propagator, integrate_quads, WorkerPool, propagate_task, ship_function, \
+    make_stm_ode, make_directional_ode, cumulative_simpson, reconstruct, propagate_endpoint_task, load_function
+from beluga.numeric.ivp_solvers import workers
 from beluga.numeric.data_classes.Trajectory import Trajectory
 import numpy as np
+from scipy.integrate import simps
+import pytest
+from functools import partial
+from numba import njit, float64
 from math import pi
+from liepack.flow import RKMK, Flow
+from liepack.domain.hspaces import HManifold
+from liepack.domain.liegroups import RN
+from liepack.domain.liealgebras import rn
+from liepack.field import VectorField
+from liepack import exp
 
 tol = 1e-3
 
@@ -122,3 +134,422 @@ def test_integrate_quads():
     assert integrate_quads(quadfun, np.array([0, 2 * np.pi]) + 2, gam)[1] < 1e-3
     assert integrate_quads(quadfun, np.array([0, 1 * np.pi]) + 0, gam)[0] - 2 < 1e-3
     assert integrate_quads(quadfun, np.array([0, 1 * np.pi]) + 0, gam)[1] < 1e-3
+
+
+def test_worker_pool():
+    def odefn(x, _, __):
+        return -x
+
+    y0_set = [1.0, 2.0, 3.0]
+    tasks = [(np.array([0, 1.0]), np.array([y0]), np.array([]), np.array([]), np.array([])) for y0 in y0_set]
+    pool = WorkerPool(2, deriv_func=odefn)
+    try:
+        assert ship_function(pool, odefn) == 'deriv_func'
+        out = pool.map(partial(propagate_task, Propagator(), 'deriv_func', None), tasks)
+    finally:
+        pool.close()
+
+    for (t, y, _), y0 in zip(out, y0_set):
+        assert abs(t[-1] - 1) < tol
+        assert abs(y[-1, 0] - y0*np.exp(-1)) < tol
+
+
+def test_load_function_cache(monkeypatch):
+    # Functions sent by value stay cached until enough newer ones push them out
+    monkeypatch.setattr(workers, 'MAX_LOADED_FUNCTIONS', 3)
+    monkeypatch.setattr(workers, '_loaded_functions', type(workers._loaded_functions)())
+
+    shipped = [ship_function(None, partial(np.multiply, ii)) for ii in range(5)]
+    first = load_function(shipped[0])
+    for ii, function in enumerate(shipped[1:]):
+        assert load_function(function)(2) == 2 * (ii + 1)
+        # The first function is used again each time, so it is never the least recently used
+        assert load_function(shipped[0]) is first
+
+    assert len(workers._loaded_functions) == 3
+    assert shipped[0] in workers._loaded_functions
+    assert shipped[1] not in workers._loaded_functions
+
+
+def test_directional_ode():
+    # The derivative of a trajectory along a direction matches the STM applied to that direction
+    def odefun(x, p, _):
+        return np.array([p[0] * x[1], -p[0] * x[0]])
+
+    def quadfun(x, p, _):
+        return np.array([p[0] * x[0]])
+
+    tspan = np.array([0, 1.0])
+    y0 = np.array([0.5, 1.0])
+    q0 = np.zeros(1)
+    p = np.array([1.2])
+    direction = np.array([0.3, -0.7, 2.0])
+    prop = Propagator()
+
+    stm0 = np.vstack((np.eye(2, 3), np.zeros((1, 3)))).ravel()
+    stm_ode = make_stm_ode(odefun, quadfun, None, 2, 1)
+    phi = np.reshape(prop(stm_ode, None, tspan, np.hstack((y0, q0, stm0)), [], p, []).y[-1, 3:], (3, 3))
+
+    directional_ode = make_directional_ode(odefun, quadfun, None, 2, 1, 1)
+    yf = prop(directional_ode, None, tspan, np.hstack((y0, q0, direction[:2], q0, direction[2:])), [], p, []).y[-1]
+
+    assert np.allclose(yf[3:6], np.dot(phi, direction), atol=tol)
+    assert np.allclose(yf[6:], direction[2:])
+
+
+def pendulum(x, _, k):
+    return np.array([x[1], -k[0] * np.sin(x[0])])
+
+
+# Compiled once for all steppers
+pendulum_jit = njit((float64[:], float64[:], float64[:]))(pendulum)
+
+
+@pytest.mark.parametrize("stepper", ['RK45', 'DOP853'])
+def test_propagator_numba(stepper):
+    # The compiled integrator takes the same steps as solve_ivp
+    odefun = pendulum_jit
+    odefun_py = pendulum
+
+    y0 = np.array([1.0, 0.0])
+    tspan = np.array([0, 10.0])
+    k = np.array([2.0])
+    gamma_scipy = Propagator(stepper=stepper)(odefun, None, tspan, y0, [], np.array([]), k)
+    gamma_numba = Propagator(program='numba', stepper=stepper)(odefun, None, tspan, y0, [], np.array([]), k)
+    assert np.allclose(gamma_numba.t, gamma_scipy.t)
+    assert np.allclose(gamma_numba.y, gamma_scipy.y)
+
+    # Functions that are not compiled fall back to solve_ivp
+    gamma_py = Propagator(program='numba', stepper=stepper)(odefun_py, None, tspan, y0, [], np.array([]), k)
+    assert np.allclose(gamma_py.y, gamma_scipy.y)
+
+    # Fixed steps
+    gamma_fixed = Propagator(program='numba', stepper=stepper, variable_step=False, maxstep=0.05)(
+        odefun, None, tspan, y0, [], np.array([]), k)
+    assert np.allclose(np.diff(gamma_fixed.t), 0.05)
+    assert np.allclose(gamma_fixed.y[-1], gamma_scipy.y[-1], atol=tol)
+
+
+@pytest.mark.parametrize("stepper, variable_step", [('RK45', True), ('DOPRI54', True), ('RK4', False)])
+def test_propagator_lie(stepper, variable_step):
+    # The array based RKMK steps agree with those of liepack on RN
+    y0 = np.array([1.0, 0.0])
+    tspan = np.array([0, 10.0])
+    k = np.array([2.0])
+    gamma = Propagator(program='lie', stepper=stepper, variable_step=variable_step)(
+        pendulum_jit, None, tspan, y0, [], np.array([]), k)
+
+    g = rn(3)
+    g.set_vector(y0)
+    vf = VectorField(HManifold(RN(3, exp(g))))
+    vf.set_equationtype('general')
+
+    def m2g(_, y):
+        out = rn(3)
+        out.set_vector(pendulum_jit(y[:-1, -1], np.array([]), k))
+        return out
+
+    vf.set_M2g(m2g)
+    ts = RKMK()
+    ts.setmethod(stepper)
+    ti, yi = Flow(ts, vf, variablestep=variable_step)(HManifold(RN(3, exp(g))), tspan[0], tspan[-1], 0.1)
+    assert np.allclose(gamma.t, ti, rtol=1e-8, atol=1e-8)
+    assert np.allclose(gamma.y, np.vstack([_[:-1, -1] for _ in yi]), rtol=1e-8, atol=1e-8)
+
+    # The trajectory starts at the initial time
+    gamma = Propagator(program='lie', stepper=stepper, variable_step=variable_step)(
+        pendulum_jit, None, tspan + 1, y0, [], np.array([]), k)
+    assert gamma.t[0] == 1 and np.isclose(gamma.t[-1], 11)
+    assert np.allclose(gamma.y[-1], np.vstack([_[:-1, -1] for _ in yi])[-1], atol=tol)
+
+
+def pendulum_quad(x, _, __):
+    return np.array([x[1] ** 2])
+
+
+pendulum_quad_jit = njit((float64[:], float64[:], float64[:]))(pendulum_quad)
+
+
+@pytest.mark.parametrize("program", ['scipy', 'numba'])
+def test_propagator_augment_quads(program):
+    # Quads integrated with the states agree with those reconstructed afterwards
+    y0 = np.array([1.0, 0.0])
+    q0 = np.array([0.5])
+    tspan = np.array([0, 10.0])
+    k = np.array([2.0])
+    gamma_reconstructed = Propagator()(pendulum_jit, pendulum_quad_jit, tspan, y0, q0, np.array([]), k)
+    gamma = Propagator(program=program, augment_quads=True)(pendulum_jit, pendulum_quad_jit, tspan, y0, q0,
+                                                            np.array([]), k)
+    assert gamma.q.shape == (len(gamma.t), 1)
+    assert np.allclose(gamma.q[0], q0)
+    assert np.allclose(gamma.q[-1], gamma_reconstructed.q[-1], atol=tol)
+
+    # Without error control on the quads, the steps are those taken without quads
+    gamma_free = Propagator(program=program)(pendulum_jit, None, tspan, y0, [], np.array([]), k)
+    gamma = Propagator(program=program, augment_quads=True, quad_error_control=False)(
+        pendulum_jit, pendulum_quad_jit, tspan, y0, q0, np.array([]), k)
+    assert np.allclose(gamma.t, gamma_free.t)
+    assert np.allclose(gamma.y, gamma_free.y)
+    assert np.allclose(gamma.q[-1], gamma_reconstructed.q[-1], atol=tol)
+
+
+@pytest.mark.parametrize("program", ['scipy', 'numba'])
+def test_propagator_t_eval(program):
+    # Only the requested times are stored, quads included
+    y0 = np.array([1.0, 0.0])
+    q0 = np.array([0.5])
+    tspan = np.array([0, 10.0])
+    k = np.array([2.0])
+    prop = Propagator(program=program)
+    gamma_full = prop(pendulum_jit, pendulum_quad_jit, tspan, y0, q0, np.array([]), k)
+
+    gamma = prop(pendulum_jit, pendulum_quad_jit, tspan, y0, q0, np.array([]), k, t_eval=tspan)
+    assert np.allclose(gamma.t, tspan)
+    assert np.allclose(gamma.y[0], y0)
+    assert np.allclose(gamma.y[-1], gamma_full.y[-1], atol=tol)
+    assert np.allclose(gamma.q[-1], gamma_full.q[-1], atol=tol)
+
+    t_eval = np.array([2.5, 5, 7.5])
+    gamma = prop(pendulum_jit, None, tspan, y0, [], np.array([]), k, t_eval=t_eval)
+    assert np.allclose(gamma.t, t_eval)
+    assert np.allclose(gamma.y, np.array([prop(pendulum_jit, None, [0, time], y0, [], np.array([]), k).y[-1]
+                                          for time in t_eval]), atol=tol)
+
+
+@pytest.mark.parametrize("stepper", ['BDF', 'Radau', 'LSODA'])
+def test_propagator_implicit(stepper):
+    # A stiff chain of decays. The Jacobian spares the finite differences of the equations of motion.
+    rates = np.array([1e4, 1e2, 1.0, 1e-2])
+    calls = []
+
+    def odefun(x, _, __):
+        calls.append(1)
+        return np.hstack((-rates[0] * x[0], rates[:-1] * x[:-1] - rates[1:] * x[1:]))
+
+    def odefun_jac(_, __, ___):
+        return np.diag(-rates) + np.diag(rates[:-1], -1), np.zeros((4, 0))
+
+    def quadfun(x, _, __):
+        return np.array([x[-1]])
+
+    y0 = np.array([1.0, 0, 0, 0])
+    q0 = np.array([0.0])
+    tspan = np.array([0, 5.0])
+    expected = Propagator(stepper=stepper, maxstep=np.inf)(odefun, None, tspan, y0, [], [], [])
+    calls_fd = len(calls)
+
+    for kwargs in [dict(), dict(sparse_jacobian=True)]:
+        prop = Propagator(stepper=stepper, maxstep=np.inf, **kwargs)
+        del calls[:]
+        gamma = prop(odefun, None, tspan, y0, [], [], [], eom_func_jac=odefun_jac)
+        assert len(calls) < calls_fd
+        assert np.allclose(gamma.y[-1], expected.y[-1], atol=tol)
+
+        # Quads integrated with the states take their rows of the Jacobian by finite differences
+        prop.augment_quads = True
+        gamma = prop(odefun, quadfun, tspan, y0, q0, [], [], eom_func_jac=odefun_jac)
+        assert np.allclose(gamma.y[-1], expected.y[-1], atol=tol)
+
+    if stepper == 'LSODA':
+        return
+
+    # The sparsity pattern is found once and reused
+    assert len(prop._sparsity) == 2
+    prop(odefun, quadfun, tspan, y0, q0, [], [], eom_func_jac=odefun_jac)
+    assert len(prop._sparsity) == 2
+
+    # Without a Jacobian the pattern still serves the finite differences
+    prop = Propagator(stepper=stepper, maxstep=np.inf, sparse_jacobian=True)
+    gamma = prop(odefun, None, tspan, y0, [], [], [])
+    assert len(prop._sparsity) == 1
+    assert np.allclose(gamma.y[-1], expected.y[-1], atol=tol)
+
+
+@pytest.mark.parametrize("stepper", ['RK45', 'DOP853', 'BDF'])
+def test_propagator_warm_start(stepper):
+    # A nearby propagation over the same time span retraces the remembered steps
+    calls = []
+
+    def odefun(x, _, k):
+        calls.append(1)
+        return np.array([x[1], -k[0] * np.sin(x[0])])
+
+    y0 = np.array([1.0, 0.0])
+    tspan = np.array([0, 10.0])
+    k = np.array([2.0])
+    prop_cold = Propagator(stepper=stepper)
+    prop = Propagator(stepper=stepper, warm_start=True)
+
+    gamma_reference = prop(odefun, None, tspan, y0, [], [], k)
+    assert np.allclose(gamma_reference.y, prop_cold(odefun, None, tspan, y0, [], [], k).y)
+
+    y0_nearby = y0 + 1e-6
+    del calls[:]
+    gamma_cold = prop_cold(odefun, None, tspan, y0_nearby, [], [], k)
+    calls_cold = len(calls)
+    del calls[:]
+    gamma = prop(odefun, None, tspan, y0_nearby, [], [], k)
+    assert len(calls) < calls_cold
+    assert np.allclose(gamma.y[-1], gamma_cold.y[-1], atol=tol)
+    if stepper != 'BDF':
+        assert np.allclose(gamma.t, gamma_reference.t)
+
+    # Requested times only
+    gamma = prop(odefun, None, tspan, y0_nearby, [], [], k, t_eval=[0, 5, 10])
+    assert np.allclose(gamma.t, [0, 5, 10])
+    assert np.allclose(gamma.y[-1], gamma_cold.y[-1], atol=tol)
+
+
+def test_propagator_warm_start_pool():
+    # Step sizes found in the workers of a pool stay there, only serial propagations are warm started
+    def odefn(x, _, __):
+        return -x
+
+    tasks = [(np.array([0, 1.0]), np.array([y0]), np.array([]), np.array([]), np.array([])) for y0 in [1.0, 2.0]]
+    prop = Propagator(warm_start=True)
+    pool = WorkerPool(2, deriv_func=odefn)
+    try:
+        out = pool.map(partial(propagate_task, prop, 'deriv_func', None), tasks)
+    finally:
+        pool.close()
+
+    assert all(abs(y[-1, 0] - task[1][0] * np.exp(-1)) < tol for (_, y, _), task in zip(out, tasks))
+    assert len(prop._step_history) == 0
+
+    propagate_task(prop, odefn, None, tasks[0])
+    assert len(prop._step_history) == 1
+
+
+def test_propagator_events():
+    # The growth rate switches at s = 1 and s = 2. Restarting there keeps the large steps accurate.
+    def odefun(x, _, k):
+        rate = k[0] if x[0] < 1 or x[0] > 2 else k[1]
+        return np.array([1, rate * x[1]])
+
+    def eventfun(x, _, __):
+        return np.array([x[0] - 1, x[0] - 2])
+
+    y0 = np.array([0, 1.0])
+    tspan = np.array([0, 3.0])
+    k = np.array([1.0, -2.0])
+    expected = np.exp(2 * k[0] + k[1])
+
+    gamma = Propagator(maxstep=np.inf)(odefun, None, tspan, y0, [], [], k, event_func=eventfun)
+    error_plain = abs(gamma.y[-1, 1] - expected)
+
+    prop = Propagator(maxstep=np.inf, detect_events=True)
+    gamma = prop(odefun, None, tspan, y0, [], [], k, event_func=eventfun)
+    assert abs(gamma.y[-1, 1] - expected) < error_plain / 10
+    assert np.any(np.isclose(gamma.t, 1)) and np.any(np.isclose(gamma.t, 2))
+    assert np.all(np.diff(gamma.t) > 0)
+
+    # Backwards
+    gamma = prop(odefun, None, tspan[::-1], gamma.y[-1], [], [], k, event_func=eventfun)
+    assert np.allclose(gamma.y[-1], y0, atol=1e-5)
+
+    # Starting on a switch
+    gamma = prop(odefun, None, [1, 3], np.array([1, 1.0]), [], [], k, event_func=eventfun)
+    assert abs(gamma.y[-1, 1] - np.exp(k[0] + k[1])) < error_plain / 10
+    assert np.all(np.diff(gamma.t) > 0)
+
+    gamma = prop(odefun, None, tspan, y0, [], [], k, event_func=eventfun, t_eval=[0, 1, 1.5, 3])
+    assert np.allclose(gamma.t, [0, 1, 1.5, 3])
+    assert abs(gamma.y[-1, 1] - expected) < error_plain / 10
+
+
+def test_propagate_batch():
+    # An ensemble over different time spans agrees with propagating each member on its own
+    def odefun(x, _, __):
+        return -x[1], x[0]
+
+    def quadfun(x, _, __):
+        return x[0]
+
+    tspans = np.array([[0, pi / 2], [0, 1], [1, 3], [pi, 0]])
+    y0_set = np.array([[1, 0], [0, 1], [2, 0], [1, 1]])
+    q0_set = np.array([[0], [1], [0], [2]])
+    prop = Propagator()
+
+    yf_set, qf_set = prop.propagate_batch(odefun, quadfun, tspans, y0_set, q0_set, [], [], endpoints_only=True)
+    gamma_set = prop.propagate_batch(odefun, quadfun, tspans, y0_set, q0_set, [], [])
+    assert yf_set.shape == (4, 2)
+    assert qf_set.shape == (4, 1)
+
+    for tspan, y0, q0, yf, qf, gamma in zip(tspans, y0_set, q0_set, yf_set, qf_set, gamma_set):
+        gamma_single = prop(odefun, quadfun, tspan, y0, q0, [], [])
+        assert np.allclose(yf, gamma_single.y[-1], atol=tol)
+        assert np.allclose(qf, gamma_single.q[-1], atol=tol)
+        assert abs(gamma.t[0] - tspan[0]) < 1e-12 and abs(gamma.t[-1] - tspan[-1]) < 1e-12
+        assert np.allclose(gamma.y[-1], yf)
+        assert np.allclose(gamma.q[-1], qf)
+
+
+def test_propagate_batch_ensemble():
+    # A large ensemble with few active members holds each member to the accuracy it gets on its own
+    def odefun(x, _, __):
+        return -x[1], x[0]
+
+    n_members = 60
+    rs = np.random.RandomState(0)
+    y0_set = np.full((n_members, 2), 1e-6)
+    y0_set[::15] = rs.rand(4, 2) * 10
+    tspans = np.zeros((n_members, 2))
+    tspans[:, 1] = 2 + rs.rand(n_members) * 8
+    prop = Propagator(reltol=1e-4, abstol=1e-6, maxstep=10)
+
+    yf_set, _ = prop.propagate_batch(odefun, None, tspans, y0_set, [], [], [], endpoints_only=True)
+    for tspan, y0, yf in zip(tspans, y0_set, yf_set):
+        c, s = np.cos(tspan[-1]), np.sin(tspan[-1])
+        expected = np.array([c * y0[0] - s * y0[1], s * y0[0] + c * y0[1]])
+        gamma_single = prop(odefun, None, tspan, y0, [], [], [])
+        assert np.linalg.norm(yf - expected) <= 2 * np.linalg.norm(gamma_single.y[-1] - expected) + 1e-8
+
+
+def test_propagate_endpoints_blowup():
+    # x' = x^2 from x = 1 blows up at t = 1, so there is no terminal point at t = 2
+    def odefun(x, _, __):
+        return x[0] ** 2, 1
+
+    def quadfun(x, _, __):
+        return x[0]
+
+    prop = Propagator()
+    yf, qf = propagate_endpoint_task(prop, odefun, quadfun, (np.array([0, 2]), np.array([1, 0]), np.array([0]), [], []))
+    assert np.all(np.isinf(yf)) and yf.shape == (2,)
+    assert np.all(np.isinf(qf)) and qf.shape == (1,)
+
+    yf, qf = propagate_endpoint_task(prop, odefun, None, (np.array([0, 0.5]), np.array([1, 0]), [], [], []))
+    assert np.allclose(yf, [2, 0.5], atol=tol) and qf.shape == (0,)
+
+    yf_set, qf_set = prop.propagate_batch(odefun, quadfun, [[0, 2], [0, 0.5]], [[1, 0], [1, 0]], [[0], [0]], [], [],
+                                          endpoints_only=True)
+    assert np.all(np.isinf(yf_set)) and yf_set.shape == (2, 2)
+    assert np.all(np.isinf(qf_set)) and qf_set.shape == (2, 1)
+
+
+def test_cumulative_simpson():
+    x = np.sort(np.random.RandomState(0).rand(50)) * 3
+    y = np.column_stack((np.sin(x), x ** 2))
+    q = cumulative_simpson(y, x)
+    assert q.shape == y.shape
+    assert np.allclose(q[:, 0], np.cos(x[0]) - np.cos(x), atol=1e-3)
+    assert np.allclose(q[:, 1], (x ** 3 - x[0] ** 3) / 3)
+
+    # Every other point is the composite Simpson's rule
+    for ii in range(2, len(x), 2):
+        assert np.allclose(q[ii], simps(y[:ii + 1].T, x=x[:ii + 1]))
+
+    assert np.allclose(cumulative_simpson(np.ones(2), np.array([0, 2])), [0, 2])
+    assert np.allclose(cumulative_simpson(np.ones(1), np.array([0])), [0])
+
+
+def test_reconstruct():
+    t = np.linspace(0, pi, 2001)
+    gamma = Trajectory(t, np.column_stack((np.sin(t), np.cos(t))))
+
+    def quadfun(y, _, __):
+        return y[0], y[1] ** 2
+
+    gamma = reconstruct(quadfun, gamma, np.array([1, 0]), [], [])
+    assert np.allclose(gamma.q[:, 0], 2 - np.cos(t), atol=1e-8)
+    assert np.allclose(gamma.q[:, 1], t / 2 + np.sin(2 * t) / 4, atol=1e-8)
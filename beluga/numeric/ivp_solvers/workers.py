@@ -0,0 +1,164 @@
+import collections
+
+import cloudpickle as pickle
+import numpy as np
+import pathos
+
+# Functions sent by value are cached per process, keyed by their pickled bytes. The least recently used ones are
+# dropped past this many, since each continuation step sends new ones.
+MAX_LOADED_FUNCTIONS = 32
+
+_resident_functions = dict()
+_loaded_functions = collections.OrderedDict()
+
+
+def _init_worker(pickled_functions):
+    """
+    Loads the resident functions of a worker process. Runs once when the worker starts.
+
+    :param pickled_functions: Dictionary of pickled functions keyed by name.
+    """
+    _resident_functions.clear()
+    _loaded_functions.clear()
+    for name, pickled_function in pickled_functions.items():
+        _resident_functions[name] = pickle.loads(pickled_function)
+
+
+def load_function(function):
+    """
+    Returns a function that was sent to a worker process.
+
+    A function is sent as one of
+
+    * the name of a function kept resident by the worker,
+    * pickled bytes, which are only loaded the first time a process sees them, see `MAX_LOADED_FUNCTIONS`,
+    * a tuple ``(factory, *args)``, built once per process from ``factory(*args)`` where each argument is loaded the
+      same way,
+    * the function itself.
+
+    :param function: A function, or a reference to one.
+    :return: The function.
+    """
+    if isinstance(function, str):
+        return _resident_functions[function]
+
+    if isinstance(function, (bytes, tuple)):
+        if function in _loaded_functions:
+            _loaded_functions.move_to_end(function)
+        else:
+            if isinstance(function, bytes):
+                _loaded_functions[function] = pickle.loads(function)
+            else:
+                _loaded_functions[function] = function[0](*[load_function(arg) for arg in function[1:]])
+
+            while len(_loaded_functions) > MAX_LOADED_FUNCTIONS:
+                _loaded_functions.popitem(last=False)
+
+        return _loaded_functions[function]
+
+    return function
+
+
+def propagate_task(prop, eom_func, quad_func, task, eom_func_jac=None, event_func=None):
+    r"""
+    Propagates a single trajectory. Meant to be mapped over a process pool with the first three arguments bound.
+
+    :param prop: The propagator.
+    :param eom_func: Equations of motion, or a reference to them. See `load_function`.
+    :param quad_func: Quadrature equations, or a reference to them. See `load_function`.
+    :param task: Tuple of ``(tspan, y0, q0, *args)``.
+    :param eom_func_jac: Jacobian of the equations of motion for implicit steppers, or a reference to it.
+    :param event_func: Events the propagator restarts at, or a reference to them.
+    :return: :math:`(t, y, q)` of the reconstructed trajectory as plain arrays, which are cheap to send back.
+    """
+    tspan, y0, q0 = task[:3]
+    gamma = prop(load_function(eom_func), load_function(quad_func), tspan, y0, q0, *task[3:],
+                 eom_func_jac=load_function(eom_func_jac), event_func=load_function(event_func))
+    return gamma.t, gamma.y, gamma.q
+
+
+def propagate_endpoint_task(prop, eom_func, quad_func, task, eom_func_jac=None, event_func=None):
+    r"""
+    Same as `propagate_task`, but only returns the terminal point of the trajectory. The steps in between are never
+    stored.
+
+    A propagation that stops short of the end of `tspan`, typically because the solution blows up, has no terminal
+    point. It is reported at infinity, so a residual built from it is rejected.
+
+    :return: :math:`(y_f, q_f)` as plain arrays. :math:`q_f` is empty without quads.
+    """
+    tspan, y0, q0 = task[:3]
+    gamma = prop(load_function(eom_func), load_function(quad_func), tspan, y0, q0, *task[3:],
+                 eom_func_jac=load_function(eom_func_jac), event_func=load_function(event_func),
+                 t_eval=[tspan[0], tspan[-1]])
+    if gamma.t[-1] != tspan[-1]:
+        return np.full(gamma.y.shape[1], np.inf), np.full(np.shape(gamma.q)[1] if len(gamma.q) > 0 else 0, np.inf)
+
+    if len(gamma.q) > 0:
+        return gamma.y[-1], gamma.q[-1]
+
+    return gamma.y[-1], np.empty((0,))
+
+
+class WorkerPool(object):
+    """
+    Pool of worker processes that keep a set of functions resident.
+
+    The functions are pickled once and loaded by every worker when it starts. Tasks then refer to them by name, see
+    `ship_function`, so only their numerical arguments are sent over.
+    """
+
+    def __init__(self, n_cpus, **functions):
+        """
+        Starts the worker processes.
+
+        :param n_cpus: Number of worker processes.
+        :param functions: Functions to keep resident in the workers, keyed by name. Entries that are None are skipped.
+        """
+        self.n_cpus = n_cpus
+        self.functions = {name: func for name, func in functions.items() if func is not None}
+        pickled_functions = {name: pickle.dumps(func) for name, func in self.functions.items()}
+        self.pool = pathos.multiprocessing.Pool(processes=n_cpus, initializer=_init_worker,
+                                                initargs=(pickled_functions,))
+
+    def name_of(self, function):
+        """
+        Returns the name of a resident function, or None if the function is not resident.
+        """
+        for name, func in self.functions.items():
+            if func is function:
+                return name
+
+        return None
+
+    def map(self, func, iterable):
+        """
+        Maps a function over an iterable. The work is split into one chunk per worker, so a bound function is only
+        pickled once per worker.
+        """
+        iterable = list(iterable)
+        chunksize = max(int(np.ceil(len(iterable) / self.n_cpus)), 1)
+        return self.pool.map(func, iterable, chunksize=chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def ship_function(pool, function):
+    """
+    Returns what to send to the workers of a pool in place of a function.
+
+    :param pool: A `WorkerPool`, or any other process pool.
+    :param function: The function, which may be None.
+    :return: The name of the function if the pool keeps it resident, otherwise its pickled bytes.
+    """
+    if function is None:
+        return None
+
+    if isinstance(pool, WorkerPool):
+        name = pool.name_of(function)
+        if name is not None:
+            return name
+
+    return pickle.dumps(function)
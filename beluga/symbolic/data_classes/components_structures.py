@@ -286,6 +286,9 @@ class SwitchStruct(NamedStruct):
         if self.sym_func is None:
             self.sympify_self()
         self.sym_func = self.sym_func.subs(old, new)
+        self.functions = [function.subs(old, new) for function in self.functions]
+        self.conditions = [[condition.subs(old, new) for condition in conditions_for_function]
+                           for conditions_for_function in self.conditions]
 
 
 class SymmetryStruct(DimensionalStruct):
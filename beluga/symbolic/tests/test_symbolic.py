@@ -5,7 +5,8 @@ import numpy as np
 import sympy
 
 from beluga import Problem
-from beluga.symbolic.data_classes.mapping_functions import make_indirect_method, make_preprocessor
+from beluga.symbolic.data_classes.mapping_functions import make_indirect_method, make_preprocessor, \
+    make_postprocessor
 from beluga.symbolic.differential_geometry import exterior_derivative, make_standard_symplectic_form, is_symplectic
 from beluga.numeric.data_classes import Trajectory
 
@@ -79,6 +80,54 @@ def test_composable_functors(method):
     assert (g2.nondynamical_parameters - gamma.nondynamical_parameters < tol).all()
 
 
+def test_switch_events():
+    # The switch condition goes through a quantity, which is only substituted after the switch is sympified
+    problem = Problem()
+    problem.independent('t', 's')
+    problem.state('x', 'v*cos(theta)', 'm')
+    problem.state('y', 'v*sin(theta)', 'm')
+    problem.state('v', 'g*sin(theta)', 'm/s')
+
+    problem.control('theta', 'rad')
+
+    problem.constant('g_0', -9.81, 'm/s^2')
+    problem.constant('g_1', -5, 'm/s^2')
+    problem.constant('x_s', 0.5, 'm')
+    problem.constant('x_f', 1, 'm')
+    problem.constant('y_f', -1, 'm')
+    problem.constant('eps', 1e-3, 'm')
+
+    problem.quantity('dx', 'x - x_s')
+    problem.switch('g', ['g_0', 'g_1'], [['dx'], ['-dx']], 'eps')
+
+    problem.path_cost('1', '1')
+    problem.initial_constraint('x', 'm')
+    problem.initial_constraint('y', 'm')
+    problem.initial_constraint('v', 'm/s')
+    problem.terminal_constraint('x - x_f', 'm')
+    problem.terminal_constraint('y - y_f', 'm')
+
+    problem.scale(m='y', s='y/v', kg=1, rad=1, nd=1)
+
+    preprocessor = make_preprocessor()
+    indirect_method = make_indirect_method(problem, control_method='algebraic')
+    postprocessor = make_postprocessor()
+    bvp = postprocessor(indirect_method(preprocessor(problem)))
+
+    switch = bvp.switches[0]
+    assert all(condition.free_symbols <= {sympy.Symbol('x'), sympy.Symbol('x_s')}
+               for conditions in switch.conditions for condition in conditions)
+
+    # Conditions that only differ by their sign share one event
+    event_func = bvp.functional_problem.switch_event_func
+    y = np.array([0.75, -0.5, 2, 0.1, -1, -1, -1, -1])
+    k = np.array([-9.81, -5, 0.5, 1, -1, 1e-3])
+    events = event_func(y, np.array([1.]), k)
+    assert hasattr(event_func, 'py_func')
+    assert events.shape == (1,)
+    assert abs(abs(events[0]) - 0.25) < tol
+
+
 def test_exterior_derivative():
     basis = [sympy.Symbol('x'), sympy.Symbol('y')]
 
@@ -189,3 +238,54 @@ def test_is_symplectic():
 #     result = make_augmented_cost(cost, constraints, location)
 #     assert result == lambdas[0] * constraints['terminal'][0] + cost
 #     assert len(lambdas) == 1
+
+
+def test_batch_funcs():
+    # The batch functions are only compiled on request, and match the node by node functions on every node
+    problem = Problem()
+    problem.independent('t', 's')
+    problem.state('x', 'v*cos(theta)', 'm')
+    problem.state('y', 'v*sin(theta)', 'm')
+    problem.state('v', 'g*sin(theta)', 'm/s')
+
+    problem.control('theta', 'rad')
+
+    problem.constant('g', -9.81, 'm/s^2')
+    problem.constant('x_f', 1, 'm')
+    problem.constant('y_f', -1, 'm')
+
+    problem.path_cost('1', '1')
+    problem.initial_constraint('x', 'm')
+    problem.initial_constraint('y', 'm')
+    problem.initial_constraint('v', 'm/s')
+    problem.terminal_constraint('x - x_f', 'm')
+    problem.terminal_constraint('y - y_f', 'm')
+
+    problem.scale(m='y', s='y/v', kg=1, rad=1, nd=1)
+
+    preprocessor = make_preprocessor()
+    indirect_method = make_indirect_method(problem, analytical_jacobian=True)
+    postprocessor = make_postprocessor()
+    functional_problem = postprocessor(indirect_method(preprocessor(problem))).functional_problem
+
+    assert functional_problem.deriv_func_batch is None
+    assert functional_problem.deriv_func_jac_batch is None
+
+    deriv_func_batch, _, deriv_func_jac_batch = functional_problem.compile_batch_funcs()
+    assert deriv_func_batch is not None and deriv_func_jac_batch is not None
+    assert functional_problem.compile_batch_funcs()[0] is deriv_func_batch
+
+    n_y, n_p = len(functional_problem._state_syms), len(functional_problem._parameter_syms)
+    y = np.random.rand(n_y, 5)
+    p = np.random.rand(n_p)
+    k = np.array([-9.81, 1, -1])
+
+    f = deriv_func_batch(y, p, k)
+    assert f.shape == y.shape
+    df_dy, df_dp = np.zeros((n_y, n_y, 5)), np.zeros((n_y, n_p, 5))
+    deriv_func_jac_batch(y, p, k, df_dy, df_dp)
+    for i in range(y.shape[1]):
+        assert np.allclose(f[:, i], functional_problem.deriv_func(y[:, i], p, k), atol=tol)
+        df_dy_i, df_dp_i = functional_problem.deriv_func_jac(y[:, i], p, k)
+        assert np.allclose(df_dy[:, :, i], df_dy_i, atol=tol)
+        assert np.allclose(df_dp[:, :, i], df_dp_i, atol=tol)